@@ -0,0 +1,151 @@
+"""
+End-to-end cost of convert on a synthetic library from benchmarks.library, compared against a
+baseline to catch regressions, e.g. after upgrading Pillow.
+
+The run with the lowest wall time of --repeat runs is kept. Its wall time, and the CPU time of
+each stage from the run report, are compared against the baseline, and any of them slower by
+more than --threshold is reported as a regression, with exit status 1.
+
+Usage: python -m benchmarks.e2e [-c CONFIG] [-r REPEAT] [--baseline FILE] [--save-baseline]
+       [--threshold 0.15] [library options of benchmarks.library]
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+from typing import Dict, List, Optional
+from comicpacker.config import MyConfig
+from comicpacker.convert import convert
+from .library import LibrarySpec, add_arguments, generate, spec_from_args
+
+SETTINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'settings.toml')
+
+# what a nightly pack typically enables, over the shipped settings and under the config file
+DEFAULT_SETTINGS = {
+    'enable_image_pipeline': True,
+    'enable_crop': True,
+    'crop_upper_threshold': 250,
+    'enable_downsample': True,
+    'screen_height': 1200,
+    'screen_width': 848,
+    'enable_dedup': True,
+    'page_threads': 4,
+}
+
+
+def bench_config(config: Optional[str], spec: LibrarySpec, source_path: str,
+                 workdir: str) -> MyConfig:
+    cfg = MyConfig()
+    cfg.parse_file(SETTINGS)
+    cfg.__dict__.update(DEFAULT_SETTINGS)
+    if config is not None:
+        cfg.parse_file(config)
+    cfg.source_format = spec.source_format
+    cfg.source_path = source_path
+    cfg.output_path = os.path.join(workdir, 'output')
+    cfg.logging_path = workdir
+    cfg.report_path = os.path.join(workdir, 'report.json')
+    cfg.prometheus_path = ''
+    cfg.enable_cache = False
+    return cfg
+
+
+def run_once(cfg: MyConfig) -> dict:
+    shutil.rmtree(cfg.output_path, ignore_errors=True)
+    try:
+        convert(cfg)
+    finally:
+        # convert adds its handlers on every call
+        logger = logging.getLogger('main')
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+    with open(cfg.report_path, 'r', encoding='utf-8') as f:
+        report = json.load(f)
+    return {
+        'wall_time': report['wall_time'],
+        'cpu_time': report['cpu_time'],
+        'pages': report['pages'],
+        'pages_per_s': report['pages_per_s'],
+        'stages': {name: stage['cpu'] for name, stage in report['stages'].items()},
+    }
+
+
+def compare(result: dict, baseline: dict, threshold: float, min_time: float) -> List[str]:
+    """
+    :param min_time: stages taking less CPU time in the baseline are too noisy to compare
+    :return: description of each regression
+    """
+    checks: Dict[str, tuple] = {'wall time': (baseline['wall_time'], result['wall_time'])}
+    for name, before in baseline['stages'].items():
+        if before >= min_time:
+            checks[f'stage {name} CPU time'] = (before, result['stages'].get(name, 0.0))
+    regressions = []
+    for name, (before, after) in checks.items():
+        change = after / before - 1 if before > 0 else 0.0
+        line = f'{name:40s} {before:8.3f}s -> {after:8.3f}s {change:+7.1%}'
+        if change > threshold:
+            regressions.append(line)
+            line += '  REGRESSION'
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default=None,
+                        help='settings file applied over the benchmark settings')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--library', default=None,
+                        help='existing library to pack, generated from the options if not set')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the result as the baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='slowdown over the baseline reported as a regression')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='stages taking less CPU seconds in the baseline are not compared')
+    add_arguments(parser)
+    args = parser.parse_args()
+    spec = spec_from_args(args)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source_path = args.library
+        if source_path is None:
+            source_path = os.path.join(workdir, 'library')
+            generate(source_path, spec)
+        cfg = bench_config(args.config, spec, source_path, workdir)
+        runs = [run_once(cfg) for _ in range(args.repeat)]
+    result = min(runs, key=lambda run: run['wall_time'])
+    result['library'] = None if args.library is not None else vars(spec)
+    result['settings'] = {
+        key: value for key, value in vars(cfg).items()
+        if not key.endswith('_path') and key != 'targets'
+    }
+    print(f'{result["pages"]} pages in {result["wall_time"]:.2f}s '
+          f'({result["pages_per_s"]:.1f} pages/s, {result["cpu_time"]:.2f}s CPU)')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline first')
+        return
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline['library'] != result['library'] or baseline['settings'] != result['settings']:
+        print('Warning: library or settings differ from the baseline')
+    regressions = compare(result, baseline, args.threshold, args.min_time)
+    if len(regressions) > 0:
+        print(f'{len(regressions)} regressions over {args.threshold:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Synthetic source libraries in each source_format, for the benchmarks.
+
+Pages are noisy panels inside a white margin, so that crop, downsample and the encoders have
+real work to do, and the last page of every chapter is the same credits page, so that dedup
+finds duplicates.
+
+Usage: python -m benchmarks.library ROOT [-f FORMAT] [--comics N] [--chapters N] [--pages N]
+       [--size WxH] [--ext .jpg]
+"""
+import os
+import io
+import json
+import argparse
+from dataclasses import dataclass
+from typing import Dict, List
+import toml
+import numpy as np
+from PIL import Image
+
+SOURCE_FORMATS = ('general', 'tachiyomi', 'bcdown', 'dmzjbackup', 'zmhbackup')
+
+
+@dataclass(eq=False)
+class LibrarySpec:
+    source_format: str = 'general'
+    comics: int = 2
+    chapters: int = 4
+    pages: int = 10
+    width: int = 1200
+    height: int = 1700
+    ext: str = '.jpg'
+    seed: int = 0
+
+    @property
+    def total_pages(self) -> int:
+        """
+        Pages of the library, covers excluded.
+        """
+        return self.comics * self.chapters * self.pages
+
+
+def encode(array: np.ndarray, ext: str) -> bytes:
+    data = io.BytesIO()
+    img = Image.fromarray(array)
+    if ext == '.jpg':
+        img.save(data, 'JPEG', quality=90)
+    elif ext == '.png':
+        img.save(data, 'PNG', compress_level=1)
+    elif ext == '.webp':
+        img.save(data, 'WEBP', quality=90)
+    elif ext == '.avif':
+        img.save(data, 'AVIF', quality=80, speed=8)
+    else:
+        raise ValueError(f'Unsupported format {ext}')
+    return data.getvalue()
+
+
+def page_array(rng: np.random.Generator, width: int, height: int) -> np.ndarray:
+    array = np.full((height, width, 3), 255, np.uint8)
+    # panels inside a white margin of about 5%
+    top, left = height // 20, width // 20
+    bottom, right = height - top, width - left
+    rows = rng.integers(2, 5)
+    edges = np.linspace(top, bottom, rows + 1).astype(int)
+    # white gutters between panels, unless the page is too small for them
+    gutter = 4 if height >= 100 else 0
+    for y0, y1 in zip(edges[:-1] + gutter, edges[1:] - gutter):
+        tone = rng.integers(40, 220)
+        panel = rng.normal(tone, 30, (y1 - y0, right - left, 1))
+        array[y0:y1, left:right] = np.clip(panel, 0, 255).astype(np.uint8)
+    return array
+
+
+def credits_array(width: int, height: int) -> np.ndarray:
+    array = np.full((height, width, 3), 255, np.uint8)
+    array[height // 3:height * 2 // 3, width // 4:width * 3 // 4] = 30
+    return array
+
+
+def write_pages(folder: str, names: List[str], spec: LibrarySpec, rng: np.random.Generator,
+                credits: bytes):
+    os.makedirs(folder, exist_ok=True)
+    for name in names[:-1]:
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(encode(page_array(rng, spec.width, spec.height), spec.ext))
+    with open(os.path.join(folder, names[-1]), 'wb') as f:
+        f.write(credits)
+
+
+def write_json(path: str, value: dict):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, ensure_ascii=False)
+
+
+def write_toml(path: str, value: dict):
+    with open(path, 'w', encoding='utf-8') as f:
+        toml.dump(value, f)
+
+
+def generate(root: str, spec: LibrarySpec) -> List[str]:
+    """
+    Write a library to root, laid out as spec.source_format expects.
+
+    :return: folders of the comics
+    """
+    if spec.source_format not in SOURCE_FORMATS:
+        raise ValueError(f'Unknown source format {spec.source_format}')
+    rng = np.random.default_rng(spec.seed)
+    credits = encode(credits_array(spec.width, spec.height), spec.ext)
+    folders = []
+    for c in range(spec.comics):
+        title = f'comic{c}'
+        folder = os.path.join(root, title)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'cover' + spec.ext), 'wb') as f:
+            f.write(encode(page_array(rng, spec.width, spec.height), spec.ext))
+        details = {
+            'title': title,
+            'author': 'author0, author1',
+            'description': f'description of {title}',
+            'genre': ['comedy', 'slice of life'],
+        }
+        chapter_titles = [f'chapter{i + 1}' for i in range(spec.chapters)]
+        names = [f'{p + 1:03d}{spec.ext}' for p in range(spec.pages)]
+        chapter_ids: Dict[str, int] = {}
+        for i, chapter_title in enumerate(chapter_titles):
+            chapter_folder = os.path.join(folder, chapter_title)
+            write_pages(chapter_folder, names, spec, rng, credits)
+            if spec.source_format == 'bcdown':
+                write_toml(os.path.join(chapter_folder, 'meta.toml'),
+                           {'ord': i + 1, 'title': chapter_title, 'paths': names})
+            elif spec.source_format == 'zmhbackup':
+                chapter_ids[chapter_title] = 1000 + i
+                write_toml(os.path.join(chapter_folder, 'info.toml'),
+                           {'chapter_id': chapter_ids[chapter_title], 'img_list': names})
+        if spec.source_format == 'tachiyomi':
+            write_json(os.path.join(folder, 'details.json'), details)
+        elif spec.source_format == 'bcdown':
+            write_toml(os.path.join(folder, 'meta.toml'), {'title': title})
+        elif spec.source_format == 'dmzjbackup':
+            write_json(os.path.join(folder, 'details.json'), details)
+            write_toml(os.path.join(folder, 'info.toml'), {'chapter_list': chapter_titles})
+        elif spec.source_format == 'zmhbackup':
+            write_json(os.path.join(folder, 'details.json'), details)
+            write_toml(os.path.join(folder, 'info.toml'),
+                       {'chapter_id_list': [chapter_ids[t] for t in chapter_titles]})
+        folders.append(folder)
+    return folders
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('-f', '--format', dest='source_format', default='general',
+                        choices=SOURCE_FORMATS)
+    parser.add_argument('--comics', type=int, default=LibrarySpec.comics)
+    parser.add_argument('--chapters', type=int, default=LibrarySpec.chapters)
+    parser.add_argument('--pages', type=int, default=LibrarySpec.pages,
+                        help='pages per chapter, the last one is a duplicate credits page')
+    parser.add_argument('--size', default=f'{LibrarySpec.width}x{LibrarySpec.height}',
+                        help='size of the pages, WxH')
+    parser.add_argument('--ext', default=LibrarySpec.ext,
+                        choices=('.jpg', '.png', '.webp', '.avif'))
+    parser.add_argument('--seed', type=int, default=LibrarySpec.seed)
+
+
+def spec_from_args(args: argparse.Namespace) -> LibrarySpec:
+    width, height = (int(x) for x in args.size.lower().split('x'))
+    return LibrarySpec(args.source_format, args.comics, args.chapters, args.pages, width, height,
+                       args.ext, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    spec = spec_from_args(args)
+    generate(args.root, spec)
+    print(f'{spec.comics} {spec.source_format} comics, {spec.total_pages} pages in {args.root}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Per-call cost of the parsers, transformers, encoders, dedup and the EPUB/CBZ writers, on a
+synthetic library from benchmarks.library.
+
+Usage: python -m benchmarks.micro [-k PATTERN] [-r REPEAT] [--size WxH] [--ext .jpg]
+"""
+import io
+import os
+import fnmatch
+import argparse
+import tempfile
+import timeit
+from typing import Callable, Dict, List, Tuple, Type
+import numpy as np
+from PIL import Image, features
+from comicpacker.parser import (BaseParser, GeneralParser, TachiyomiParser, BcdownParser,
+                                DmzjBackupParser, ZMHBackupParser)
+from comicpacker.image_pipeline import ImagePipeline, ThresholdCrop, DownSample
+from comicpacker.comic_pipeline import ImageDedup
+from comicpacker._comicepub import ComicEpub
+from comicpacker.comiccbz import ComicCbz
+from .library import LibrarySpec, generate, page_array
+
+PARSERS: Dict[str, Type[BaseParser]] = {
+    'general': GeneralParser,
+    'tachiyomi': TachiyomiParser,
+    'bcdown': BcdownParser,
+    'dmzjbackup': DmzjBackupParser,
+    'zmhbackup': ZMHBackupParser,
+}
+
+# name -> setup(workdir, args), which returns the function to time and the number of items,
+# e.g. pages, it handles per call
+BENCHMARKS: Dict[str, Callable[[str, argparse.Namespace], Tuple[Callable[[], object], int]]] = {}
+
+
+def benchmark(name: str):
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+def source_image(args: argparse.Namespace) -> Image.Image:
+    return Image.fromarray(page_array(np.random.default_rng(0), args.width, args.height))
+
+
+def source_data(args: argparse.Namespace) -> bytes:
+    data = io.BytesIO()
+    source_image(args).save(data, 'JPEG', quality=90)
+    return data.getvalue()
+
+
+def parser_benchmark(source_format: str):
+    def setup(workdir: str, args: argparse.Namespace):
+        # parsers only list folders and read metadata, tiny pages keep the setup fast
+        spec = LibrarySpec(source_format, comics=1, chapters=50, pages=20, width=16, height=16)
+        folder = generate(os.path.join(workdir, 'parse-' + source_format), spec)[0]
+        parser = PARSERS[source_format]
+        return lambda: parser.parse(folder), spec.total_pages
+
+    return setup
+
+
+for source_format in PARSERS:
+    benchmark(f'parse.{source_format}')(parser_benchmark(source_format))
+
+
+@benchmark('transform.ThresholdCrop')
+def crop(workdir, args):
+    img = source_image(args)
+    transform = ThresholdCrop(0, 250)
+    return lambda: transform(img), 1
+
+
+@benchmark('transform.ThresholdCrop.coarse')
+def crop_coarse(workdir, args):
+    img = source_image(args)
+    transform = ThresholdCrop(0, 250, coarse_step=8)
+    return lambda: transform(img), 1
+
+
+@benchmark('transform.DownSample')
+def downsample(workdir, args):
+    img = source_image(args)
+    transform = DownSample(args.height * 2 // 3, args.width * 2 // 3, 'cubic')
+    return lambda: transform(img), 1
+
+
+def encoder_benchmark(method: str, **kwargs):
+    def setup(workdir: str, args: argparse.Namespace):
+        img = source_image(args)
+        pipeline = ImagePipeline(**kwargs)
+        save = getattr(pipeline, method)
+        return lambda: save(img), 1
+
+    return setup
+
+
+benchmark('encode.save_jpeg')(encoder_benchmark('save_jpeg', jpeg_quality=90))
+benchmark('encode.save_jpeg_fixed')(encoder_benchmark('save_jpeg_fixed', jpeg_quality=90))
+benchmark('encode.save_png')(encoder_benchmark('save_png'))
+benchmark('encode.save_webp')(encoder_benchmark('save_webp'))
+benchmark('encode.save_avif')(encoder_benchmark('save_avif'))
+
+
+@benchmark('dedup')
+def dedup(workdir, args):
+    spec = LibrarySpec(comics=1, chapters=4, pages=10, width=args.width, height=args.height,
+                       ext=args.ext)
+    folder = generate(os.path.join(workdir, 'dedup'), spec)[0]
+    handler = ImageDedup('phash')
+    # parsed again on each call, as dedup keeps the hashes in the pages
+    return lambda: handler(GeneralParser.parse(folder)), spec.total_pages
+
+
+def writer_benchmark(writer: str):
+    def setup(workdir: str, args: argparse.Namespace):
+        data = source_data(args)
+        filename = os.path.join(workdir, 'book.' + writer)
+        pages = 40
+
+        def run():
+            if writer == 'epub':
+                book = ComicEpub(filename, ('title', 'title'))
+            else:
+                book = ComicCbz(filename, 'title')
+            for i in range(pages):
+                book.add_comic_page(data, '.jpg', f'chapter{i // 10}', f'{i:04d}',
+                                    nav_label=f'chapter{i // 10}' if i % 10 == 0 else None)
+            book.save()
+
+        return run, pages
+
+    return setup
+
+
+benchmark('write.epub')(writer_benchmark('epub'))
+benchmark('write.cbz')(writer_benchmark('cbz'))
+
+
+def available(name: str) -> bool:
+    if name == 'encode.save_avif':
+        return features.check('avif') or 'AVIF' in Image.SAVE
+    if name == 'encode.save_webp':
+        return features.check('webp')
+    return True
+
+
+def run(names: List[str], args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            if not available(name):
+                print(f'{name:34s} skipped, not supported by this Pillow')
+                continue
+            fn, items = BENCHMARKS[name](workdir, args)
+            fn()  # warm up
+            seconds = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+            print(f'{name:34s} {seconds * 1e3:9.2f} ms/call {seconds / items * 1e3:9.3f} ms/item')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--pattern', default='*',
+                        help='run the benchmarks whose name matches this glob pattern')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--size', default=f'{LibrarySpec.width}x{LibrarySpec.height}',
+                        help='size of the pages, WxH')
+    parser.add_argument('--ext', default=LibrarySpec.ext, choices=('.jpg', '.png', '.webp'),
+                        help='format of the pages hashed by dedup')
+    args = parser.parse_args()
+    args.width, args.height = (int(x) for x in args.size.lower().split('x'))
+
+    names = [name for name in BENCHMARKS if fnmatch.fnmatch(name, args.pattern)]
+    if len(names) == 0:
+        parser.error(f'no benchmark matches {args.pattern}')
+    run(names, args)
+
+
+if __name__ == '__main__':
+    main()
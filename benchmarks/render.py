@@ -0,0 +1,49 @@
+"""
+Per-page render cost of ComicEpub templates, before and after the compiled template cache.
+
+Usage: python -m benchmarks.render [-n PAGES]
+"""
+import os
+import argparse
+import timeit
+from jinja2 import Environment
+from comicpacker._comicepub import render
+
+
+def legacy_render_xhtml(title, image_id, image_ext, page_name, view_width, view_height,
+                        cover=False):
+    # what render_xhtml did before templates were cached: read and compile on every page
+    with open(os.path.join(render.TEMPLATE_DIR, 'p.xhtml'), 'r', encoding='utf-8') as f:
+        template = f.read()
+    return Environment().from_string(template).render(
+        title=title,
+        image_id=image_id,
+        image_ext=image_ext,
+        page_name=page_name,
+        view_width=view_width,
+        view_height=view_height,
+        cover=cover,
+    )
+
+
+def bench(fn, pages: int) -> float:
+    def run():
+        for i in range(pages):
+            fn('title', 'i-%05d' % i, '.jpg', 'chapter/%d' % i, 1264, 1680)
+
+    return min(timeit.repeat(run, number=1, repeat=3)) / pages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--pages', type=int, default=2000)
+    args = parser.parse_args()
+
+    before = bench(legacy_render_xhtml, args.pages)
+    after = bench(render.render_xhtml, args.pages)
+    print(f'render_xhtml before: {before * 1e6:9.1f} us/page')
+    print(f'render_xhtml after:  {after * 1e6:9.1f} us/page ({before / after:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Startup cost of the CLI: import time of comicpacker.convert measured with -X importtime, and
+wall time of `python main.py --help`, which imports everything a run does before any work.
+
+Modules that only some configs need must not be imported at startup, any of LAZY_MODULES
+imported is reported as a regression, as is import or wall time slower than the baseline by
+more than --threshold.
+
+Usage: python -m benchmarks.startup [-r REPEAT] [--baseline FILE] [--save-baseline]
+       [--threshold 0.2]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported on first use: dedup and cropping, AVIF images, rendering of the outputs
+LAZY_MODULES = ('numpy', 'pillow_avif', 'jinja2', 'imagededup')
+
+_IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times() -> Tuple[float, Dict[str, float]]:
+    """
+    :return: cumulative import time of comicpacker.convert in seconds, and the cumulative
+        time of each top level package imported with it
+    """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import comicpacker.convert'],
+                            cwd=ROOT, capture_output=True, text=True, check=True).stderr
+    total = 0.0
+    packages: Dict[str, float] = {}
+    for line in output.splitlines():
+        match = _IMPORT_TIME.match(line)
+        if match is None: continue
+        cumulative, indent, name = int(match[2]) / 1e6, len(match[3]), match[4]
+        if name == 'comicpacker.convert':
+            total = cumulative
+        # one space of indent per level, the first import of a package is its slowest
+        package = name.split('.')[0]
+        if indent <= 3 and package != 'comicpacker':
+            packages[package] = max(packages.get(package, 0.0), cumulative)
+    return total, packages
+
+
+def cli_time() -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'main.py', '--help'], cwd=ROOT, capture_output=True,
+                   check=True)
+    return time.perf_counter() - start
+
+
+def measure(repeat: int) -> dict:
+    runs = [import_times() for _ in range(repeat)]
+    total, packages = min(runs, key=lambda run: run[0])
+    return {
+        'import_time': total,
+        'cli_time': min(cli_time() for _ in range(repeat)),
+        'packages': dict(sorted(packages.items(), key=lambda item: -item[1])),
+    }
+
+
+def check(result: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    :return: description of each regression
+    """
+    regressions = [f'{name} imported at startup' for name in LAZY_MODULES
+                   if name in result['packages']]
+    for key in ('import_time', 'cli_time'):
+        if key not in baseline: continue
+        before, after = baseline[key], result[key]
+        change = after / before - 1 if before > 0 else 0.0
+        line = f'{key:12s} {before * 1e3:8.1f}ms -> {after * 1e3:8.1f}ms {change:+7.1%}'
+        if change > threshold:
+            regressions.append(line)
+            line += '  REGRESSION'
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default='startup_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the result as the baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown over the baseline reported as a regression')
+    parser.add_argument('--top', type=int, default=10, help='number of packages listed')
+    args = parser.parse_args()
+
+    result = measure(args.repeat)
+    print(f'import comicpacker.convert: {result["import_time"] * 1e3:.1f}ms, '
+          f'main.py --help: {result["cli_time"] * 1e3:.1f}ms')
+    for name, seconds in list(result['packages'].items())[:args.top]:
+        print(f'  {name:24s} {seconds * 1e3:8.1f}ms')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = check(result, baseline, args.threshold)
+    for regression in regressions:
+        print('Regression: ' + regression)
+    if len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 import os
+import re
+import json
 import zipfile
 import uuid
 import datetime
@@ -6,10 +8,20 @@ from typing import Tuple, List, Set, Optional
 from mimetypes import MimeTypes
 from .render import render_mimetype
 from .render import render_container_xml
-from .render import render_navigation_documents_xhtml
-from .render import render_standard_opf
+from .render import generate_navigation_documents_xhtml
+from .render import generate_standard_opf
 from .render import render_xhtml
 from .render import get_fixed_layout_jp_css
+from .. import metrics
+from ..ziputil import CompressionPolicy, EntryWriter, copy_raw, write_raw
+
+# entries generated by save(), everything else is content
+METADATA_ENTRIES = {
+    "mimetype", "META-INF/container.xml", "item/standard.opf", "item/navigation-documents.xhtml",
+    "item/style/fixed-layout-jp.css"
+}
+# state of the pages of a fragment, see save_fragment()
+FRAGMENT_ENTRY = "fragment.json"
 
 
 class ComicEpub:
@@ -30,6 +42,10 @@ class ComicEpub:
         view_width: int = 848,
         view_height: int = 1200,
         reading_order: str = 'ltr',
+        append: bool = False,
+        first_index: int = 0,
+        compression: Optional[CompressionPolicy] = None,
+        compress_threads: int = 1,
     ):
         """
         Create a zip file as an EPUB container, which is only epub-valid after calling the save() method.
@@ -44,6 +60,12 @@ class ComicEpub:
         :param updated_date: epub updated_date - Default: current time
         :param view_width: epub view_width - Default: 848
         :param view_height: epub view_height - Default: 1200
+        :param append: if an epub generated by ComicEpub exists at filename, keep its pages and add
+            new pages after them - Default: False
+        :param first_index: index of the first page added, for fragments - Default: 0
+        :param compression: how entries are compressed - Default: CompressionPolicy()
+        :param compress_threads: number of threads compressing entries, 0 to compress them on
+            the calling thread - Default: 1
         """
         self.title = title
         self.subjects = subjects
@@ -57,6 +79,8 @@ class ComicEpub:
         self.view_width = view_width
         self.view_height = view_height
         self.reading_order = reading_order
+        self.first_index = first_index
+        self.compression = compression if compression is not None else CompressionPolicy()
 
         self.manifest_images: List[Tuple[str, str, str, str]] = []
         self.manifest_xhtmls: List[Tuple[str, str]] = []
@@ -66,6 +90,9 @@ class ComicEpub:
         self.nav_items: List[Tuple[str, str]] = []
 
         self.epub = self.__open(filename)
+        self.entries = EntryWriter(self.epub, self.compression, compress_threads)
+        if append and os.path.exists(self.filename):
+            self.__load(self.filename)
 
         self.mime = MimeTypes()
 
@@ -78,10 +105,69 @@ class ComicEpub:
         path = os.path.split(full_file_name)[0]
         if not os.path.exists(path):
             os.makedirs(path)
-        return zipfile.ZipFile(full_file_name, 'w', allowZip64=True)
+        # written under a temporary name, so that an unfinished file is never taken for an epub
+        self.filename = full_file_name
+        self.part_filename = full_file_name + '.part'
+        # entries streamed by ZipFile itself are text, the rest is compressed by self.entries
+        epub = zipfile.ZipFile(self.part_filename, 'w', compression=self.compression.compression(),
+                               compresslevel=self.compression.level, allowZip64=True)
+        # mimetype has to be the first entry, stored uncompressed
+        zinfo, data = self.compression.compress("mimetype", render_mimetype().encode('utf-8'))
+        write_raw(epub, zinfo, (data, ))
+        return epub
+
+    def __load(self, filename):
+        """
+        copy the pages of an existing epub as raw compressed entries, and rebuild the manifest,
+        spine and navigation from its OPF and navigation document.
+        """
+        with zipfile.ZipFile(filename, 'r') as old:
+            opf = old.read("item/standard.opf").decode('utf-8')
+            nav = old.read("item/navigation-documents.xhtml").decode('utf-8')
+            for info in old.infolist():
+                if info.filename not in METADATA_ENTRIES:
+                    copy_raw(old, info, self.epub)
+        identifier = re.search(r'<dc:identifier id="unique-id">(.*?)</dc:identifier>', opf)
+        if identifier is not None:
+            self.epubid = identifier.group(1)
+        for mimetype, image_id, href in re.findall(
+                r'<item media-type="([^"]*)" id="([^"]*)" href="image/([^"]*)"', opf):
+            name, ext = os.path.splitext(href)
+            self.manifest_images.append((image_id, name, ext, mimetype))
+        for xhtml_id, image_id in re.findall(
+                r'<item media-type="application/xhtml\+xml" id="([^"]*)" href="xhtml/[^"]*" '
+                r'properties="svg" fallback="([^"]*)"', opf):
+            self.manifest_xhtmls.append((xhtml_id, image_id))
+        self.manifest_spines.extend(re.findall(r'<itemref linear="yes" idref="([^"]*)"', opf))
+        self.nav_items.extend(
+            re.findall(r'<li><a href="xhtml/(.*?)\.xhtml">(.*?)</a></li>', nav, re.DOTALL))
 
     def __close(self):
+        self.entries.close()
+        self.epub.close()
+        os.replace(self.part_filename, self.filename)
+
+    def discard(self):
+        """
+        close and remove the unfinished epub file.
+        """
+        self.entries.close(discard=True)
         self.epub.close()
+        if os.path.exists(self.part_filename):
+            os.remove(self.part_filename)
+
+    def __write_chunks(self, path: str, chunks, buffer_size: int = 1 << 16):
+        self.entries.flush()
+        # timed as a whole, as the text is written to the entry while it is rendered
+        with metrics.stage('render'), self.epub.open(path, 'w') as f:
+            buffer, size = [], 0
+            for chunk in chunks:
+                buffer.append(chunk)
+                size += len(chunk)
+                if size >= buffer_size:
+                    f.write(''.join(buffer).encode('utf-8'))
+                    buffer, size = [], 0
+            f.write(''.join(buffer).encode('utf-8'))
 
     def __add_image(self, index: int, image_data, image_ext, page_name: str, cover: bool = False):
         if cover:
@@ -90,7 +176,7 @@ class ComicEpub:
             image_id = "i-" + "%05d" % index
 
         path = "item/image/" + page_name + image_ext
-        self.epub.writestr(path, image_data)
+        self.entries.write(path, image_data)
 
         mimetype = self.mime.guess_type('test' + image_ext)
         if mimetype[0] is None:
@@ -106,9 +192,10 @@ class ComicEpub:
         else:
             xhtml_id = "p-" + "%05d" % index
 
-        content = render_xhtml(title, image_id, image_ext, page_name, self.view_width,
-                               self.view_height, cover)
-        self.epub.writestr("item/xhtml/" + xhtml_id + ".xhtml", content)
+        with metrics.stage('render'):
+            content = render_xhtml(title, image_id, image_ext, page_name, self.view_width,
+                                   self.view_height, cover)
+        self.entries.write("item/xhtml/" + xhtml_id + ".xhtml", content)
         return xhtml_id
 
     def add_comic_page(self, image_data, image_ext, chapter: Optional[str] = None,
@@ -123,7 +210,7 @@ class ComicEpub:
         :param cover: true if image is cover
         :param nav_label: if not None, create a navigation label at this page
         """
-        index = len(self.manifest_xhtmls)
+        index = self.first_index + len(self.manifest_xhtmls)
         if chapter is None: chapter = ''
         else: chapter = chapter + '/'
         if page is None: page = str(index)
@@ -144,11 +231,10 @@ class ComicEpub:
         """
         generate epub required files, then close and save epub file.
         """
-        self.epub.writestr("mimetype", render_mimetype())
-        self.epub.writestr("META-INF/container.xml", render_container_xml())
-        self.epub.writestr(
+        self.entries.write("META-INF/container.xml", render_container_xml())
+        self.__write_chunks(
             "item/standard.opf",
-            render_standard_opf(
+            generate_standard_opf(
                 uuid=self.epubid,
                 title=self.title,
                 subjects=self.subjects,
@@ -164,12 +250,41 @@ class ComicEpub:
                 manifest_xhtmls=self.manifest_xhtmls,
                 manifest_spines=self.manifest_spines,
             ))
-        self.epub.writestr(
+        self.__write_chunks(
             "item/navigation-documents.xhtml",
-            render_navigation_documents_xhtml(
+            generate_navigation_documents_xhtml(
                 title=self.nav_title,
                 nav_items=self.nav_items,
             ))
-        self.epub.writestr("item/style/fixed-layout-jp.css", get_fixed_layout_jp_css())
+        self.entries.write("item/style/fixed-layout-jp.css", get_fixed_layout_jp_css())
+
+        self.__close()
 
+    def save_fragment(self):
+        """
+        close and save the pages added as a fragment, to be merged into an epub by add_fragment().
+        """
+        state = {
+            "manifest_images": self.manifest_images,
+            "manifest_xhtmls": self.manifest_xhtmls,
+            "manifest_spines": self.manifest_spines,
+            "nav_items": self.nav_items,
+        }
+        self.entries.write(FRAGMENT_ENTRY, json.dumps(state))
         self.__close()
+
+    def add_fragment(self, filename):
+        """
+        add the pages of a fragment saved by save_fragment() after the pages added so far,
+        copying its entries as raw compressed data.
+        """
+        self.entries.flush()
+        with zipfile.ZipFile(filename, 'r') as fragment:
+            state = json.loads(fragment.read(FRAGMENT_ENTRY))
+            for info in fragment.infolist():
+                if info.filename not in METADATA_ENTRIES and info.filename != FRAGMENT_ENTRY:
+                    copy_raw(fragment, info, self.epub)
+        self.manifest_images.extend(tuple(item) for item in state["manifest_images"])
+        self.manifest_xhtmls.extend(tuple(item) for item in state["manifest_xhtmls"])
+        self.manifest_spines.extend(state["manifest_spines"])
+        self.nav_items.extend(tuple(item) for item in state["nav_items"])
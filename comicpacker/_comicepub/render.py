@@ -1,13 +1,32 @@
 import os
-from jinja2 import Environment
-from typing import List, Tuple, Set, Optional
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterator, List, Tuple, Set, Optional
 
+if TYPE_CHECKING:
+    from jinja2 import Environment, Template
 
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'template')
+
+
+@lru_cache(maxsize=None)
+def _environment() -> 'Environment':
+    # Templates are loaded and compiled once per process and kept in the environment's cache;
+    # the files are shipped with the package, so there is no need to check them for changes.
+    # jinja2 is imported on the first render, runs with nothing to pack never need it.
+    from jinja2 import Environment, FileSystemLoader
+    return Environment(loader=FileSystemLoader(TEMPLATE_DIR), auto_reload=False)
+
+
+@lru_cache(maxsize=None)
 def get_content_from_file(path):
     with open(os.path.join(os.path.dirname(__file__), path), 'r', encoding='utf-8') as f:
         return f.read()
 
 
+def get_template(name: str) -> 'Template':
+    return _environment().get_template(name)
+
+
 def render_mimetype():
     return get_content_from_file('./template/mimetype')
 
@@ -16,7 +35,7 @@ def render_container_xml():
     return get_content_from_file('./template/container.xml')
 
 
-def render_standard_opf(
+def generate_standard_opf(
     uuid: str,
     title: Tuple[str, str],
     subjects: Optional[Set[str]],
@@ -31,9 +50,12 @@ def render_standard_opf(
     manifest_images: List[Tuple[str, str, str, str]],
     manifest_xhtmls: List[Tuple[str, str]],
     manifest_spines: List[str],
-) -> str:
-    template = get_content_from_file('./template/standard.opf')
-    return Environment().from_string(template).render(
+) -> Iterator[str]:
+    """
+    Render standard.opf chunk by chunk, so that the manifest and spine of large books
+    never have to be held as one string.
+    """
+    return get_template('standard.opf').generate(
         uuid=uuid,
         title=title,
         subjects=subjects,
@@ -51,17 +73,24 @@ def render_standard_opf(
     )
 
 
-def render_navigation_documents_xhtml(
+def render_standard_opf(**kwargs) -> str:
+    return ''.join(generate_standard_opf(**kwargs))
+
+
+def generate_navigation_documents_xhtml(
     title: str,
     nav_items: List[Tuple[str, str]],
-) -> str:
-    template = get_content_from_file('./template/navigation-documents.xhtml')
-    return Environment().from_string(template).render(
+) -> Iterator[str]:
+    return get_template('navigation-documents.xhtml').generate(
         title=title,
         nav_items=nav_items,
     )
 
 
+def render_navigation_documents_xhtml(**kwargs) -> str:
+    return ''.join(generate_navigation_documents_xhtml(**kwargs))
+
+
 def render_xhtml(
     title: str,
     image_id: str,
@@ -71,8 +100,7 @@ def render_xhtml(
     view_height: int,
     cover: bool = False,
 ) -> str:
-    template = get_content_from_file('./template/p.xhtml')
-    return Environment().from_string(template).render(
+    return get_template('p.xhtml').render(
         title=title,
         image_id=image_id,
         image_ext=image_ext,
@@ -0,0 +1,158 @@
+import os
+import zipfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+from .const import ARCHIVE_EXT
+
+# Pages inside a zip/cbz archive are referred to by the path of the archive joined with the name
+# of the member, as if the archive were a folder, e.g. raw/comic/chapter1.cbz/001.jpg. Pages are
+# keyed by path everywhere, so the stats, hashes and records of members work like those of files.
+
+
+@dataclass(eq=False)
+class _OpenArchive:
+    archive: zipfile.ZipFile
+    # number of with blocks of open_archive using it
+    readers: int = 0
+    evicted: bool = False
+
+
+_MAX_OPEN = 32
+_archives: 'OrderedDict[str, _OpenArchive]' = OrderedDict()
+_lock = threading.Lock()
+
+
+def _reset():
+    # a forked worker must not share the file positions of the archives opened by its parent
+    global _archives, _lock
+    _archives = OrderedDict()
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
+
+
+def is_archive(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in ARCHIVE_EXT
+
+
+def member_path(archive: str, member: str) -> str:
+    return os.path.join(archive, *member.split('/'))
+
+
+def split_member(path: str) -> Optional[Tuple[str, str]]:
+    """
+    :return: path of the archive and name of the member, None if path is not inside an archive
+    """
+    parts = path.split(os.sep)
+    for i in range(len(parts) - 1, 0, -1):
+        if not is_archive(parts[i - 1]): continue
+        archive = os.sep.join(parts[:i])
+        if os.path.isfile(archive):
+            return archive, '/'.join(parts[i:])
+    return None
+
+
+@contextmanager
+def open_archive(path: str) -> Iterator[zipfile.ZipFile]:
+    """
+    Open an archive for reading in the with block, archives opened recently in this process are
+    reused. ZipFile reads members under a lock, so the same archive can be read by several threads.
+    Archives evicted from the recently opened ones are closed once no with block uses them.
+    """
+    with _lock:
+        entry = _archives.get(path)
+        if entry is not None:
+            _archives.move_to_end(path)
+            entry.readers += 1
+    if entry is None:
+        # opened outside the lock, threads opening the same archive at once keep the first one
+        archive = zipfile.ZipFile(path, 'r')
+        with _lock:
+            entry = _archives.setdefault(path, _OpenArchive(archive))
+            entry.readers += 1
+            while len(_archives) > _MAX_OPEN:
+                _, evicted = _archives.popitem(last=False)
+                evicted.evicted = True
+                if evicted.readers == 0:
+                    evicted.archive.close()
+        if entry.archive is not archive:
+            archive.close()
+    try:
+        yield entry.archive
+    finally:
+        with _lock:
+            entry.readers -= 1
+            if entry.evicted and entry.readers == 0:
+                entry.archive.close()
+
+
+def list_members(path: str) -> List[str]:
+    """
+    :return: names of the files in an archive
+    """
+    with open_archive(path) as archive:
+        return [info.filename for info in archive.infolist() if not info.is_dir()]
+
+
+def stat_page(path: str) -> Tuple[int, int]:
+    """
+    :return: size and mtime_ns of a page, for a member its size and the mtime_ns of its archive
+    :raise OSError: if the page does not exist
+    """
+    member = split_member(path)
+    if member is None:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    archive, name = member
+    try:
+        with open_archive(archive) as f:
+            info = f.getinfo(name)
+    except (KeyError, zipfile.BadZipFile) as e:
+        raise FileNotFoundError(f'{name} not found in {archive}: {e}')
+    return info.file_size, os.stat(archive).st_mtime_ns
+
+
+def read_page(path: str) -> bytes:
+    member = split_member(path)
+    if member is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    archive, name = member
+    try:
+        with open_archive(archive) as f:
+            return f.read(name)
+    except (KeyError, zipfile.BadZipFile) as e:
+        raise UserWarning(f'Cannot read {name} in {archive}: {e}')
+
+
+@dataclass(eq=False)
+class RawMember:
+    """
+    A stored member of a source archive, written to the output as it is by EntryWriter.
+    """
+    archive: str
+    info: zipfile.ZipInfo
+
+
+def raw_member(path: str) -> Optional[RawMember]:
+    """
+    :return: the member at path, if it is stored and can be copied without decompressing,
+        None if it is compressed or not a member
+    """
+    member = split_member(path)
+    if member is None: return None
+    archive, name = member
+    try:
+        with open_archive(archive) as f:
+            info = f.getinfo(name)
+    except (KeyError, zipfile.BadZipFile):
+        return None
+    # encrypted members cannot be read anyway
+    if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+        return None
+    return RawMember(archive, info)
@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import sqlite3
+import zipfile
+import threading
+from typing import Dict, List, Optional, Tuple
+from .comic import Comic
+
+
+def comic_digests(comic: Comic, page_stats: Dict[str, Tuple[int, int]]) -> List[str]:
+    """
+    Digests of everything in a comic that ends up in its output: metadata, chapters, and the
+    path, size and modification time of every page.
+
+    :param page_stats: path -> (size, mtime_ns) of the pages, from stat_pages
+    :return: digest of the metadata and cover, followed by the digest of the comic up to and
+        including each chapter; the last one is the digest of the whole comic
+    """
+    def page_key(path: Optional[str]):
+        if path is None: return None
+        return (path, *page_stats.get(path, (-1, -1)))
+
+    values = {
+        'title': comic.title,
+        'authors': comic.authors,
+        'publisher': comic.publisher,
+        'subjects': None if comic.subjects is None else sorted(comic.subjects),
+        'description': comic.description,
+        'cover': page_key(comic.cover_path),
+    }
+    digest = hashlib.sha1(json.dumps(values).encode('utf-8'))
+    digests = [digest.hexdigest()]
+    for chapter in comic.chapters:
+        pages = [(page.order, page.title, page_key(page.path)) for page in chapter.pages]
+        digest.update(json.dumps((chapter.order, chapter.title, pages)).encode('utf-8'))
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def is_complete(filename: str) -> bool:
+    """
+    Whether an output file is a readable archive, i.e. it was not cut short while being written.
+    """
+    try:
+        with zipfile.ZipFile(filename) as archive:
+            names = archive.namelist()
+    except (OSError, zipfile.BadZipFile):
+        return False
+    return 'mimetype' in names or 'ComicInfo.xml' in names
+
+
+class BuildRecords:
+    """
+    Records of the outputs built, in a SQLite database, so that an output is rebuilt only when
+    its sources or the settings that affect it changed.
+
+    Each record holds the fingerprint of the settings and the digest of the comic the output
+    was built from. Records are only read and written by the main process.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        # records are written from the result handler thread of the pool
+        self.lock = threading.Lock()
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS builds ('
+                              'output TEXT PRIMARY KEY, fingerprint TEXT, digest TEXT, '
+                              'chapter_digests TEXT)')
+        return self.conn
+
+    def get(self, output: str) -> Optional[Tuple[str, List[str]]]:
+        """
+        :return: fingerprint and digests from comic_digests the output was built with,
+            None if it has no record
+        """
+        with self.lock:
+            row = self.__connect().execute(
+                'SELECT fingerprint, chapter_digests FROM builds WHERE output=?',
+                (output, )).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def put(self, output: str, fingerprint: str, digests: List[str]):
+        with self.lock:
+            conn = self.__connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?)',
+                             (output, fingerprint, digests[-1], json.dumps(digests)))
+
+    def up_to_date(self, output: str, fingerprint: str, digests: List[str]) -> bool:
+        """
+        Whether output exists and was built from the same sources with the same settings.
+        An existing complete output without a record, e.g. from before records were kept, is
+        adopted as up to date.
+        """
+        if not os.path.exists(output): return False
+        record = self.get(output)
+        if record is None:
+            if not is_complete(output): return False
+            self.put(output, fingerprint, digests)
+            return True
+        return record[0] == fingerprint and record[1][-1] == digests[-1]
+
+    def appendable(self, output: str, fingerprint: str, digests: List[str]) -> int:
+        """
+        Whether the comic only has new chapters at its end since output was built.
+
+        :return: number of chapters of the comic already in output, 0 if it has to be rebuilt
+        """
+        record = self.get(output)
+        if record is None or record[0] != fingerprint or not os.path.exists(output): return 0
+        num_chapters = len(record[1]) - 1
+        if num_chapters < len(digests) - 1 and digests[num_chapters] == record[1][-1]:
+            return num_chapters
+        return 0
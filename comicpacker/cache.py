@@ -0,0 +1,111 @@
+import os
+import hashlib
+import logging
+import tempfile
+from typing import Optional, Tuple
+from .utils import safe_makedirs
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of processed page images.
+
+    Entries are keyed by the hash of the source image, its extension and a fingerprint of the
+    image settings, so renamed or moved pages still hit and changed settings never do.
+    Entries are shared by all worker processes; the least recently used ones are evicted by
+    evict() once the total size exceeds max_size. Entries encoded faster than the settings ask
+    for, to keep up with a deadline, are marked as degraded and only used by runs with one.
+    """
+    def __init__(self, path: str, fingerprint: str, max_size: int) -> None:
+        """
+        :param path: cache directory
+        :param fingerprint: fingerprint of the settings that affect the processed image
+        :param max_size: max total size of entries in bytes
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        safe_makedirs(path)
+
+    def key(self, data: bytes, ext: str) -> str:
+        h = hashlib.blake2b(data, digest_size=20)
+        h.update(ext.lower().encode('utf-8'))
+        h.update(self.fingerprint.encode('utf-8'))
+        return h.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key: str, degraded: bool = False) -> Optional[Tuple[Optional[bytes], str]]:
+        """
+        :param degraded: also return entries marked as degraded
+        :return: None on miss, otherwise (data, ext), where data is None if the source image
+            is to be used as it is
+        """
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        header, _, data = content.partition(b'\n')
+        # "<passthrough> <ext>", followed by " degraded" for degraded entries
+        passthrough, ext, *flags = header.decode('utf-8').split(' ')
+        if 'degraded' in flags and not degraded:
+            return None
+        return (None if passthrough == '1' else data), ext
+
+    def put(self, key: str, data: Optional[bytes], ext: str, degraded: bool = False):
+        """
+        :param degraded: True if data was encoded faster than the settings ask for
+        """
+        path = self.entry_path(key)
+        folder = os.path.dirname(path)
+        safe_makedirs(folder)
+        header = ('1' if data is None else '0') + ' ' + ext + (' degraded' if degraded else '') \
+            + '\n'
+        # other workers may be writing the same entry, only complete files are renamed in place
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header.encode('utf-8'))
+                if data is not None:
+                    f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.getLogger('main.Cache').warning(f'Failed to write cache entry {key}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def remove(self, key: str):
+        try:
+            os.remove(self.entry_path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size.
+
+        :return: number of entries removed
+        """
+        entries = []
+        total = 0
+        for folder in os.scandir(self.path):
+            if not folder.is_dir(): continue
+            for entry in os.scandir(folder.path):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_size: break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
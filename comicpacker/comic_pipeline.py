@@ -1,8 +1,14 @@
+import io
 import logging
 from abc import abstractmethod
-from typing import Dict
-from imagededup.methods import PHash, DHash, WHash, AHash
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+from PIL import Image
 from .comic import Comic, Chapter, Page
+from .hash_store import HashStore
+from .image_pipeline import ImagePipeline
+from .archive import stat_page
 
 
 class BaseFilter:
@@ -74,38 +80,75 @@ class ChapterFilter(BaseFilter):
 
 # multiprocessing
 class ImageDedup(BaseHandler):
-    def __init__(self, method: str) -> None:
-        if method == 'phash':
-            self.image_hash = PHash(verbose=False)
-        elif method == 'dhash':
-            self.image_hash = DHash(verbose=False)
-        elif method == 'whash':
-            self.image_hash = WHash(verbose=False)
-        elif method == 'ahash':
-            self.image_hash = AHash(verbose=False)
-        else:
-            raise ValueError(f'Invalid hash method {method}')
+    def __init__(self, method: str, store: Optional[HashStore] = None, threads: int = 1,
+                 max_distance: int = 0) -> None:
+        """
+        :param store: if not None, reuse hashes of unchanged files from previous runs
+        :param threads: number of threads to hash pages with
+        :param max_distance: pages whose hashes differ in at most this many bits are duplicates
+        """
+        self.method = method
+        self.max_distance = max_distance
+        self.store = store
+        self.threads = threads
+        self.batch_size = 256
+        from .image_hash import get_hasher
+        self.image_hash = get_hasher(method)
+
+    def hash_pages(self, pages: List[Page]):
+        """
+        Set the hash_code of pages whose hash_code is not set yet.
+        """
+        files = []
+        for page in pages:
+            if page.hash_code is not None: continue
+            try:
+                files.append((page.path, *stat_page(page.path)))
+            except OSError:
+                files.append((page.path, -1, -1))
+        known = {} if self.store is None else self.store.get_many(self.method, files)
+        missing = [file for file in files if file[0] not in known]
+        hashes = []
+        executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        # thumbnails are decoded in parallel, then each batch is hashed in one vectorized pass
+        for i in range(0, len(missing), self.batch_size):
+            paths = [file[0] for file in missing[i:i + self.batch_size]]
+            if executor is not None:
+                thumbnails = list(executor.map(self.image_hash.load_thumbnail, paths))
+            else:
+                thumbnails = [self.image_hash.load_thumbnail(path) for path in paths]
+            hashes.extend(self.image_hash.encode_arrays(thumbnails))
+        if executor is not None:
+            executor.shutdown()
+        new_rows = []
+        for (path, size, mtime), hash_code in zip(missing, hashes):
+            known[path] = hash_code
+            if hash_code is not None:
+                new_rows.append((path, size, mtime, hash_code))
+        if self.store is not None and len(new_rows) > 0:
+            self.store.put_many(self.method, new_rows)
+        for page in pages:
+            if page.hash_code is None:
+                page.hash_code = known[page.path]
 
     def __call__(self, comic):
-        hash_dict: Dict[str, int] = {}
-        for chapter in comic.chapters:
-            for page in chapter.pages:
-                page.hash_code = self.image_hash.encode_image(page.path)
-                if page.hash_code not in hash_dict:
-                    hash_dict[page.hash_code] = 1
-                else:
-                    hash_dict[page.hash_code] += 1
-        dup_hashes = set()
+        from .hamming import group_hashes
+        pages = [page for chapter in comic.chapters for page in chapter.pages]
+        self.hash_pages(pages)
+        groups = dict(zip(pages, group_hashes([page.hash_code for page in pages],
+                                              self.max_distance)))
+        group_size = Counter(groups.values())
+        dup_groups = set()
         copyright_chapter = Chapter(float('inf'), 'copyright', [])
         # All duplicate pages are considered copyright pages
         for chapter in comic.chapters:
             page_list = []
             for page in chapter.pages:
-                if hash_dict[page.hash_code] > 1:  # type: ignore
-                    if page.hash_code not in dup_hashes:
-                        dup_hashes.add(page.hash_code)
-                        new_page = Page(order=len(dup_hashes),
-                                        title='{:04d}'.format(len(dup_hashes)), path=page.path)
+                if group_size[groups[page]] > 1:
+                    if groups[page] not in dup_groups:
+                        dup_groups.add(groups[page])
+                        new_page = Page(order=len(dup_groups),
+                                        title='{:04d}'.format(len(dup_groups)), path=page.path)
                         copyright_chapter.pages.append(new_page)
                 else:
                     page_list.append(page)
@@ -114,6 +157,87 @@ class ImageDedup(BaseHandler):
         return comic
 
 
+class DecodedHashes:
+    """
+    Dedup hashes of pages computed from the images decoded for packing, so that each page is
+    read and decoded only once.
+
+    A JPEG the image pipeline decodes at reduced scale is hashed at that scale, which may differ
+    in a few bits from its full scale hash, so such hashes are stored under a key of their own.
+    """
+    def __init__(self, dedup: ImageDedup, image_pipeline: Optional[ImagePipeline]) -> None:
+        """
+        :param image_pipeline: pipeline the pages are decoded with, None if they are not decoded
+        """
+        self.dedup = dedup
+        self.image_pipeline = image_pipeline
+        self.hashes: Dict[str, Optional[str]] = {}
+        self.new_rows: Dict[str, List[Tuple[str, int, int, str]]] = defaultdict(list)
+
+    def method(self, data: bytes) -> str:
+        if self.image_pipeline is not None:
+            try:
+                probe = self.image_pipeline.probe(data)
+                size = self.image_pipeline.draft_size(probe.format, probe.size)
+                if size is not None:
+                    return f'{self.dedup.method}@{size[0]}x{size[1]}'
+            except UserWarning:
+                pass
+        return self.dedup.method
+
+    def lookup(self, path: str, data: bytes) -> Optional[Callable[[Image.Image], None]]:
+        """
+        :return: None if the hash of the page is known, otherwise a function to be called with
+            the decoded page
+        """
+        if path in self.hashes: return None
+        method = self.method(data)
+        try:
+            file = (path, *stat_page(path))
+        except OSError:
+            file = (path, -1, -1)
+        if self.dedup.store is not None:
+            found = self.dedup.store.get_many(method, [file])
+            if path in found:
+                self.hashes[path] = found[path]
+                return None
+
+        def inspect(img: Image.Image):
+            hash_code = self.dedup.image_hash.hash_image(img)
+            self.hashes[path] = hash_code
+            if hash_code is not None and file[1] != -1:
+                self.new_rows[method].append((*file, hash_code))
+
+        return inspect
+
+    def finish(self, path: str, data: bytes, inspect: Callable[[Image.Image], None]):
+        """
+        Hash the page if it was not decoded while being processed.
+        """
+        if path in self.hashes: return
+        try:
+            if self.image_pipeline is None:
+                img = Image.open(io.BytesIO(data))
+                img.load()
+            else:
+                img, _, _ = self.image_pipeline.decode(data)
+        except (UserWarning, OSError, Image.UnidentifiedImageError):
+            self.hashes[path] = None
+            return
+        inspect(img)
+
+    def save(self):
+        if self.dedup.store is not None:
+            for method, rows in self.new_rows.items():
+                self.dedup.store.put_many(method, rows)
+        self.new_rows.clear()
+
+    def apply(self, comic: Comic):
+        for chapter in comic.chapters:
+            for page in chapter.pages:
+                page.hash_code = self.hashes.get(page.path)
+
+
 class ComicFilterPipeline:
     def __init__(self, *filters: BaseFilter) -> None:
         self.filters = list(filters)
@@ -1,9 +1,16 @@
 import os
+import re
+import json
 import zipfile
 import itertools
 from typing import Optional
+from functools import lru_cache
 from dataclasses import dataclass
-from jinja2 import Environment
+from .. import metrics
+from ..ziputil import CompressionPolicy, EntryWriter, copy_raw
+
+# state of the pages of a fragment, see save_fragment()
+FRAGMENT_ENTRY = 'fragment.json'
 
 
 @dataclass(eq=False)
@@ -12,6 +19,14 @@ class ComicInfoPage:
     bookmark: str
 
 
+@lru_cache(maxsize=None)
+def _template():
+    # jinja2 is imported on the first cbz saved, runs with nothing to pack never need it
+    from jinja2 import Environment, FileSystemLoader
+    env = Environment(loader=FileSystemLoader(os.path.dirname(__file__)), auto_reload=False)
+    return env.get_template('ComicInfo.xml')
+
+
 def safestr(s: str):
     return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace(
         '\"', '&quot;').replace('\'', '&apos;')
@@ -27,7 +42,19 @@ class ComicCbz:
         genre: Optional[str] = None,
         summary: Optional[str] = None,
         language: Optional[str] = "zh",
+        append: bool = False,
+        first_index: int = 0,
+        compression: Optional[CompressionPolicy] = None,
+        compress_threads: int = 1,
     ):
+        """
+        :param append: if a cbz generated by ComicCbz exists at filename, keep its pages and add
+            new pages after them
+        :param first_index: index of the first page added, for fragments
+        :param compression: how entries are compressed, default CompressionPolicy()
+        :param compress_threads: number of threads compressing entries, 0 to compress them on
+            the calling thread
+        """
         if '.cbz' not in filename:
             filename += '.cbz'
 
@@ -35,9 +62,17 @@ class ComicCbz:
         path = os.path.split(full_file_name)[0]
         if not os.path.exists(path):
             os.makedirs(path)
-        self.cbz = zipfile.ZipFile(full_file_name, 'w', allowZip64=True)
-        self.index = itertools.count()
+        # written under a temporary name, so that an unfinished file is never taken for a cbz
+        self.filename = full_file_name
+        self.part_filename = full_file_name + '.part'
+        self.cbz = zipfile.ZipFile(self.part_filename, 'w', allowZip64=True)
+        self.entries = EntryWriter(self.cbz,
+                                   compression if compression is not None else CompressionPolicy(),
+                                   compress_threads)
+        self.index = itertools.count(first_index)
         self.pages = None
+        if append and os.path.exists(full_file_name):
+            self.__load(full_file_name)
 
         self.title = safestr(title)
         self.writer = safestr(writer) if writer is not None else None
@@ -46,6 +81,23 @@ class ComicCbz:
         self.summary = safestr(summary) if summary is not None else None
         self.language = language
 
+    def __load(self, filename):
+        """
+        Copy the pages of an existing cbz as raw compressed entries, and rebuild the bookmarks
+        from its ComicInfo.xml.
+        """
+        num_pages = 0
+        with zipfile.ZipFile(filename, 'r') as old:
+            comicinfo = old.read('ComicInfo.xml').decode('utf-8')
+            for info in old.infolist():
+                if info.filename == 'ComicInfo.xml': continue
+                copy_raw(old, info, self.cbz)
+                num_pages += 1
+        self.index = itertools.count(num_pages)
+        for image, bookmark in re.findall(r'<Page Image="(\d+)" Bookmark="(.*?)"/>', comicinfo):
+            if self.pages is None: self.pages = []
+            self.pages.append(ComicInfoPage(int(image), bookmark))
+
     def add_comic_page(self, image_data, image_ext, chapter: Optional[str] = None,
                        page: Optional[str] = None, nav_label: Optional[str] = None):
         index = next(self.index)
@@ -53,23 +105,54 @@ class ComicCbz:
         else: chapter = chapter + '/'
         if page is None: page = str(index)
         page_name = chapter + page + image_ext
-        self.cbz.writestr(page_name, image_data)
+        self.entries.write(page_name, image_data)
         if nav_label is not None:
             if self.pages is None: self.pages = []
             self.pages.append(ComicInfoPage(index, safestr(nav_label)))
 
     def save(self):
-        with open(os.path.join(os.path.dirname(__file__), './ComicInfo.xml'), 'r',
-                  encoding='utf-8') as f:
-            template = f.read()
-        comicinfo = Environment().from_string(template).render(
-            title=self.title,
-            writer=self.writer,
-            publisher=self.publisher,
-            genre=self.genre,
-            summary=self.summary,
-            language=self.language,
-            pages=self.pages,
-        )
-        self.cbz.writestr('ComicInfo.xml', comicinfo)
+        with metrics.stage('render'):
+            comicinfo = _template().render(
+                title=self.title,
+                writer=self.writer,
+                publisher=self.publisher,
+                genre=self.genre,
+                summary=self.summary,
+                language=self.language,
+                pages=self.pages,
+            )
+        self.entries.write('ComicInfo.xml', comicinfo)
+        self.entries.close()
         self.cbz.close()
+        os.replace(self.part_filename, self.filename)
+
+    def discard(self):
+        self.entries.close(discard=True)
+        self.cbz.close()
+        if os.path.exists(self.part_filename):
+            os.remove(self.part_filename)
+
+    def save_fragment(self):
+        """
+        Close and save the pages added as a fragment, to be merged into a cbz by add_fragment().
+        """
+        pages = [] if self.pages is None else [(page.image, page.bookmark) for page in self.pages]
+        self.entries.write(FRAGMENT_ENTRY, json.dumps({'pages': pages}))
+        self.entries.close()
+        self.cbz.close()
+        os.replace(self.part_filename, self.filename)
+
+    def add_fragment(self, filename):
+        """
+        Add the pages of a fragment saved by save_fragment() after the pages added so far,
+        copying its entries as raw compressed data.
+        """
+        self.entries.flush()
+        with zipfile.ZipFile(filename, 'r') as fragment:
+            state = json.loads(fragment.read(FRAGMENT_ENTRY))
+            for info in fragment.infolist():
+                if info.filename not in ('ComicInfo.xml', FRAGMENT_ENTRY):
+                    copy_raw(fragment, info, self.cbz)
+        for image, bookmark in state['pages']:
+            if self.pages is None: self.pages = []
+            self.pages.append(ComicInfoPage(image, bookmark))
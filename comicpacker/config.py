@@ -1,5 +1,29 @@
+import os
+import copy
+import json
 import toml
-from dataclasses import dataclass
+import hashlib
+from dataclasses import dataclass, field
+from typing import List
+
+# settings that change the content of processed images
+IMAGE_FIELDS = (
+    'fixed_ext', 'jpeg_quality', 'avif_quality', 'avif_speed', 'webp_quality', 'webp_method',
+    'webp_lossless', 'png_compression', 'enable_crop', 'crop_lower_threshold',
+    'crop_upper_threshold', 'enable_downsample', 'screen_height', 'screen_width', 'interpolation')
+
+# settings that change the content of outputs
+OUTPUT_FIELDS = IMAGE_FIELDS + (
+    'output_format', 'chapter_format', 'page_format', 'view_height', 'view_width', 'reading_order',
+    'min_chapters', 'min_pages', 'min_pages_ratio', 'min_total_pages', 'max_pages', 'enable_dedup',
+    'dedup_method', 'dedup_max_distance', 'dedup_single_decode', 'enable_image_pipeline')
+
+# settings each output target may set for itself, the rest is shared by all targets
+TARGET_FIELDS = (
+    'output_format', 'chapter_format', 'page_format', 'view_height', 'view_width', 'fixed_ext',
+    'jpeg_quality', 'avif_quality', 'avif_speed', 'webp_quality', 'webp_method', 'webp_lossless',
+    'png_compression', 'enable_downsample', 'screen_height', 'screen_width', 'interpolation',
+    'deflate_level', 'deflate_images')
 
 
 @dataclass(eq=False)
@@ -8,10 +32,18 @@ class MyConfig:
     logging_path: str = './logs'
     output_path: str = './epubs'
     source_path: str = './raw'
+    enable_manifest: bool = True
+    incremental_build: bool = True
+    append_chapters: bool = True
+    report_path: str = ""
+    prometheus_path: str = ""
     # format
     source_format: str = "general"
     secondary_source_format: str = ""
     output_format: str = "epub"
+    deflate_level: int = 6
+    deflate_images: bool = False
+    targets: List[dict] = field(default_factory=list)
     chapter_format: str = r"{title}"
     page_format: str = r"{title}"
     # epub
@@ -39,6 +71,10 @@ class MyConfig:
     # dedup
     enable_dedup: bool = False
     dedup_method: str = 'phash'
+    dedup_max_distance: int = 0
+    enable_hash_store: bool = True
+    dedup_single_decode: bool = False
+    dedup_spill_memory: int = 512
     # image pipeline
     enable_image_pipeline = False
     fixed_ext = ""
@@ -49,17 +85,68 @@ class MyConfig:
     webp_method = 4
     webp_lossless = False
     png_compression = 1
+    deadline: str = ""
+    target_pages_per_s: float = 0
     # crop
     enable_crop: bool = False
     crop_lower_threshold: int = 0
     crop_upper_threshold: int = 255
+    crop_coarse_step: int = 0
     # downsample
     enable_downsample = False
     screen_height = 1680
     screen_width = 1264
     interpolation = "area"
+    # parallelism
+    processes: int = 0
+    scan_threads: int = 8
+    page_threads: int = 1
+    encoder_threads: int = 0
+    max_tasks_per_child: int = 0
+    read_ahead_pages: int = 4
+    max_inflight_mb: int = 256
+    max_task_pages: int = 1000
+    pack_fragments: bool = True
+    max_queued_tasks: int = 0
+    report_interval: float = 30
+    # cache
+    enable_cache: bool = False
+    cache_path: str = './cache'
+    cache_size: int = 10240
+
+    def fingerprint(self, fields) -> str:
+        values = {field: getattr(self, field) for field in fields}
+        return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def target_configs(self) -> List['MyConfig']:
+        """
+        :return: config of each output target, with its settings applied and output_path set to
+            its folder, or only this config if there are no targets
+        """
+        if len(self.targets) == 0: return [self]
+        configs = []
+        outputs = set()
+        for target in self.targets:
+            target = dict(target)
+            name = target.pop('name', '')
+            invalid = set(target) - set(TARGET_FIELDS)
+            if len(invalid) > 0:
+                raise ValueError(f'Invalid target settings {", ".join(sorted(invalid))}')
+            cfg = copy.copy(self)
+            cfg.__dict__.update(target)
+            cfg.targets = []
+            cfg.output_path = os.path.join(self.output_path, name)
+            output = (os.path.normpath(cfg.output_path), cfg.output_format)
+            if output in outputs:
+                raise ValueError(f'Targets with the same output {cfg.output_format} in '
+                                 f'{cfg.output_path}, give them different names')
+            outputs.add(output)
+            configs.append(cfg)
+        return configs
 
     def parse_file(self, path: str):
         cfg = toml.load(path)
         for dic in cfg.values():
             self.__dict__.update(dic)
+        # inline tables of toml are of a local class, which cannot be pickled for workers
+        self.targets = [dict(target) for target in self.targets]
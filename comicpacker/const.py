@@ -1 +1,2 @@
 IMAGE_EXT = {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG', '.webp', '.WEBP', '.avif', '.AVIF'}
+ARCHIVE_EXT = {'.zip', '.cbz'}
@@ -1,119 +1,724 @@
 import os
+import time
 import toml
+import shutil
+import datetime
+import tempfile
 import logging
 import natsort
-from typing import Dict, List, Tuple
-from multiprocessing import Pool
+import functools
+import itertools
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union
+from PIL import Image
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from ._comicepub import ComicEpub
 from .comiccbz import ComicCbz
-from .config import MyConfig
-from .comic import Comic
-from .utils import safe_makedirs, setup_logger, read_img
-from .parser import GeneralParser, TachiyomiParser, BcdownParser, DmzjBackupParser, ZMHBackupParser
+from .config import MyConfig, IMAGE_FIELDS, OUTPUT_FIELDS
+from .cache import ImageCache
+from .hash_store import HashStore
+from .manifest import Manifest
+from .build_records import BuildRecords, comic_digests
+from .spill import SpillStore
+from .scheduler import Scheduler, Task, estimate_cost, stat_pages, PAGE_COST
+from . import effort, metrics, report
+from .comic import Comic, Page
+from .ziputil import CompressionPolicy
+from .archive import RawMember, is_archive, raw_member, stat_page
+from .cpus import plan_workers
+from .utils import safe_makedirs, setup_logger, read_img, ordered_map, stream_map, set_encoder_threads
+from .parser import BaseParser, GeneralParser, TachiyomiParser, BcdownParser, DmzjBackupParser, ZMHBackupParser, ArchiveParser
 from .split import fixed_split, manual_split
-from .comic_pipeline import ComicFilter, ChapterFilter, ImageDedup, ComicFilterPipeline, ComicProcessPipeline
-from .image_pipeline import ImagePipeline, ThresholdCrop, DownSample
+from .comic_pipeline import ComicFilter, ChapterFilter, ImageDedup, DecodedHashes, ComicFilterPipeline, ComicProcessPipeline
+from .image_pipeline import ImagePipeline, MultiPipeline, ThresholdCrop, DownSample
 
 
-def pack_epub(
-    filename: str,
-    comic: Comic,
+# a page as read by fetch_page
+Source = Tuple[Optional[RawMember], Optional[bytes]]
+# path -> cache key and source size of the pages of a split comic its range tasks processed
+Handover = Dict[str, Tuple[str, int]]
+
+
+@dataclass(eq=False)
+class Processed:
+    """
+    A page of a split comic processed by its range task, as found in the cache.
+    """
+    data: bytes
+    ext: str
+    # size of the source
+    size: int
+
+
+def fetch_page(path: str, cfg: MyConfig, hashes: Optional[DecodedHashes] = None) -> Source:
+    """
+    Read the source of a page, the part of load_page waiting on the disk.
+
+    :return: the page as a stored member of an archive, None if it is not one, and its data,
+        None if the member is written unchanged without reading it
+    """
+    member = raw_member(path)
+    if member is not None and not cfg.enable_image_pipeline and hashes is None:
+        return member, None
+    return member, read_img(path)[0]
+
+
+def load_page(path: str, image_pipeline: Union[ImagePipeline, MultiPipeline], cache,
+              cfg: MyConfig, stats: Counter, hashes: Optional[DecodedHashes] = None,
+              source: Optional[Source] = None, keys: Optional[Handover] = None):
+    """
+    :param cache: Optional[ImageCache], or a list of them for the pipelines of a MultiPipeline
+    :param source: the page as read by fetch_page, read here if None
+    :param keys: if not None, the cache key and source size of the page are added to it
+    :return: (data, ext), a list of them for a MultiPipeline, where data is a RawMember for a
+        stored member of an archive that is written unchanged
+    """
+    multi = isinstance(image_pipeline, MultiPipeline)
+    member, data = fetch_page(path, cfg, hashes) if source is None else source
+    ext = os.path.splitext(path)[1]
+    if data is None:
+        # copied as it is by the writer, no need to read it
+        stats['pages'] += 1
+        stats['bytes_in'] += member.info.file_size  # type: ignore
+        return [(member, ext)] * len(image_pipeline.pipelines) if multi else (member, ext)
+    stats['pages'] += 1
+    stats['bytes_in'] += len(data)
+    process = process_targets if multi else process_page
+    pipelines = image_pipeline.pipelines if multi else [image_pipeline]
+    inspect = None if hashes is None else hashes.lookup(path, data)
+    key = None
+    if keys is not None and cache is not None and not multi:
+        key = cache.key(data, ext)
+        keys[path] = key, len(data)
+    try:
+        with effort.page(sum(pipeline.adaptive_effort for pipeline in pipelines)):
+            if key is not None:
+                result = process_page(data, ext, image_pipeline, cache, cfg, stats, inspect, key)
+            else:
+                result = process(data, ext, image_pipeline, cache, cfg, stats, inspect)
+    finally:
+        if inspect is not None:
+            hashes.finish(path, data, inspect)  # type: ignore
+    if member is None:
+        return result
+
+    def raw(page: Tuple[bytes, str]):
+        # pages passed through are the source data itself
+        return (member, page[1]) if page[0] is data else page
+
+    return [raw(page) for page in result] if multi else raw(result)
+
+
+def process_page(data: bytes, ext: str, image_pipeline: ImagePipeline,
+                 cache: Optional[ImageCache], cfg: MyConfig, stats: Counter,
+                 inspect: Optional[Callable[[Image.Image], None]] = None,
+                 key: Optional[str] = None):
+    """
+    :param key: cache key of the page, computed here if None
+    """
+    if not cfg.enable_image_pipeline:
+        return data, ext
+    if cache is not None:
+        key = cache.key(data, ext) if key is None else key
+        cached = cache.get(key, image_pipeline.adaptive_effort)
+        if cached is not None:
+            stats['cache_hit'] += 1
+            if cached[0] is None:
+                stats['passthrough'] += 1
+                return data, ext
+            stats['cache_bytes'] += len(cached[0])
+            return cached
+        stats['cache_miss'] += 1
+    new_data, new_ext, passthrough = image_pipeline.process(data, ext, inspect)
+    stats['passthrough'] += passthrough
+    if cache is not None:
+        cache.put(key, None if passthrough else new_data, new_ext, effort.degraded())
+    return new_data, new_ext
+
+
+def load_pages(
+    paths: List[str],
+    image_pipeline: Union[ImagePipeline, MultiPipeline],
+    cache,
+    cfg: MyConfig,
+    stats: Counter,
+    hashes: Optional[DecodedHashes] = None,
+    keys: Optional[Handover] = None,
+    handover: Optional[Handover] = None,
+    page_stats: Optional[Dict[str, Tuple[int, int]]] = None,
+) -> Iterator[Union[Tuple[bytes, str], UserWarning]]:
+    """
+    Load and process pages in order, on page_threads threads if configured.
+
+    With read_ahead_pages, the next pages are read on I/O threads while the current ones are
+    processed, and the source size of the pages read or processed ahead of the writer is kept
+    within max_inflight_mb, whatever the size of the comic. Their decoded images and encoded
+    results come on top of it, for the pages being processed.
+
+    :param cache: cache as taken by load_page
+    :param hashes: if not None, also hash the pages for dedup
+    :param keys: as taken by load_page, for the range tasks of a split comic
+    :param handover: keys of the pages processed by the range tasks, which are taken from cache
+        without reading the source, except for pages used as they are
+    :param page_stats: stats of the pages from the scan, to budget the read ahead by, each page
+        is stat again if None
+    :return: iterator of (data, ext), a list of them for a MultiPipeline, or the UserWarning
+        raised by the page
+    """
+    def size(path: str) -> int:
+        if page_stats is not None:
+            # a page missing from the scan fails when it is read
+            return page_stats[path][0] if path in page_stats else 0
+        try:
+            return stat_page(path)[0]
+        except OSError:
+            return 0
+
+    def fetch(path: str):
+        try:
+            if handover is not None and path in handover:
+                key, source_size = handover[path]
+                cached = cache.get(key, True)
+                if cached is not None and cached[0] is not None:
+                    return Processed(cached[0], cached[1], source_size)
+            return fetch_page(path, cfg, hashes)
+        except UserWarning as e:
+            return e
+
+    def load(path: str, source=None):
+        page_stats: Counter = Counter()
+        try:
+            if source is None and handover is not None:
+                source = fetch(path)
+            if isinstance(source, UserWarning):
+                raise source
+            if isinstance(source, Processed):
+                page_stats.update(pages=1, bytes_in=source.size, cache_hit=1,
+                                  cache_bytes=len(source.data))
+                return (source.data, source.ext), page_stats
+            return load_page(path, image_pipeline, cache, cfg, page_stats, hashes,
+                             source, keys), page_stats
+        except UserWarning as e:
+            return e, page_stats
+
+    with ExitStack() as stack:
+        executor = None
+        if cfg.page_threads > 1:
+            executor = stack.enter_context(ThreadPoolExecutor(cfg.page_threads))
+        if cfg.read_ahead_pages > 0:
+            # as many reads at a time as before, for sources where latency dominates
+            io_executor = stack.enter_context(ThreadPoolExecutor(max(cfg.page_threads, 1)))
+            # the pages being processed, besides those read ahead
+            processing = cfg.page_threads * 2 if executor is not None else 1
+            results = stream_map(io_executor, fetch, load, paths, size,
+                                 cfg.read_ahead_pages + processing, cfg.max_inflight_mb << 20,
+                                 executor)
+        elif executor is not None:
+            # at most 2 pages per thread are held in memory ahead of the writer
+            results = ordered_map(executor, load, paths, cfg.page_threads * 2)
+        else:
+            results = map(load, paths)
+        for result, page_stats in results:
+            stats.update(page_stats)
+            yield result
+
+
+def process_targets(data: bytes, ext: str, pipeline: MultiPipeline,
+                    caches: List[Optional[ImageCache]], cfg: MyConfig, stats: Counter,
+                    inspect: Optional[Callable[[Image.Image], None]] = None):
+    """
+    process_page for each pipeline of a MultiPipeline, decoding the page at most once.
+
+    :param caches: cache of each pipeline
+    :return: list of (data, ext) of each pipeline
+    """
+    if not cfg.enable_image_pipeline:
+        return [(data, ext)] * len(pipeline.pipelines)
+    results: List[Optional[Tuple[bytes, str]]] = [None] * len(pipeline.pipelines)
+    keys: List[Optional[str]] = [None] * len(pipeline.pipelines)
+    # a page is counted as unchanged if it is unchanged for every pipeline
+    passthrough = True
+    for i, cache in enumerate(caches):
+        if cache is None: continue
+        keys[i] = cache.key(data, ext)
+        cached = cache.get(keys[i], pipeline.pipelines[i].adaptive_effort)  # type: ignore
+        if cached is None:
+            stats['cache_miss'] += 1
+            continue
+        stats['cache_hit'] += 1
+        if cached[0] is None:
+            results[i] = (data, ext)
+        else:
+            stats['cache_bytes'] += len(cached[0])
+            results[i] = cached  # type: ignore
+            passthrough = False
+    missing = [i for i, result in enumerate(results) if result is None]
+    if len(missing) > 0:
+        processed = pipeline.process(data, ext, inspect, missing)
+        degraded = effort.degraded()
+        for i, (new_data, new_ext, unchanged) in zip(missing, processed):
+            passthrough = passthrough and unchanged
+            if caches[i] is not None:
+                caches[i].put(keys[i], None if unchanged else new_data, new_ext,  # type: ignore
+                              degraded)
+            results[i] = (new_data, new_ext)
+    stats['passthrough'] += passthrough
+    return results
+
+
+def page_paths(comic: Comic, first_chapter: int = 0) -> List[str]:
+    """
+    :param first_chapter: index of the first chapter to include, the cover is included if 0
+    """
+    paths = [] if comic.cover_path is None or first_chapter > 0 else [comic.cover_path]
+    for chapter in comic.chapters[first_chapter:]:
+        paths.extend(page.path for page in chapter.pages)
+    return paths
+
+
+def decoded_hashes(comic_processing: ComicProcessPipeline, image_pipeline: ImagePipeline,
+                   cfg: MyConfig) -> Optional[DecodedHashes]:
+    """
+    :return: DecodedHashes for the dedup handler of comic_processing, None if there is none or
+        dedup_single_decode is disabled
+    """
+    if not cfg.dedup_single_decode: return None
+    for handler in comic_processing.handlers:
+        if isinstance(handler, ImageDedup):
+            return DecodedHashes(handler, image_pipeline if cfg.enable_image_pipeline else None)
+    return None
+
+
+@metrics.task
+def warm_pages(
+    paths: List[str],
     comic_processing: ComicProcessPipeline,
     image_pipeline: ImagePipeline,
+    cache: ImageCache,
     cfg: MyConfig,
+    page_stats: Optional[Dict[str, Tuple[int, int]]] = None,
 ):
+    """
+    Process a range of pages of a large comic into the cache, ahead of packing it.
+    Dedup hashes are computed on the way if they can be handed over through the hash store.
+
+    :return: keys of the pages in the cache, to be handed over to the pack task, and stats
+    """
+    stats: Counter = Counter()
+    keys: Handover = {}
+    hashes = decoded_hashes(comic_processing, image_pipeline, cfg)
+    if hashes is not None and hashes.dedup.store is None:
+        hashes = None
+    for _ in load_pages(paths, image_pipeline, cache, cfg, stats, hashes, keys,
+                        page_stats=page_stats):
+        pass
+    if hashes is not None:
+        hashes.save()
+    return keys, stats
+
+
+def load_comic(
+    comic: Comic,
+    comic_processing: ComicProcessPipeline,
+    image_pipeline: Union[ImagePipeline, MultiPipeline],
+    cache,
+    cfg: MyConfig,
+    stats: Counter,
+    handover: Optional[Handover] = None,
+    page_stats: Optional[Dict[str, Tuple[int, int]]] = None,
+) -> Tuple[Comic, Iterator[Union[Tuple[bytes, str], UserWarning]]]:
+    """
+    Run the comic pipeline and load the pages of the processed comic.
+
+    With dedup_single_decode, the pages are loaded before dedup and hashed from the images
+    decoded for packing, then held in a SpillStore until dedup has moved the duplicate pages
+    to the copyright chapter.
+
+    :param handover: as taken by load_pages
+    :param page_stats: as taken by load_pages
+    :return: processed comic, iterator of its pages as returned by load_pages
+    """
+    hashes = decoded_hashes(comic_processing, image_pipeline, cfg)
+    if hashes is None:
+        comic = comic_processing(comic)
+        return comic, load_pages(page_paths(comic), image_pipeline, cache, cfg, stats,
+                                 handover=handover, page_stats=page_stats)
+    spill = SpillStore(cfg.dedup_spill_memory << 20, cfg.output_path)
+    paths = page_paths(comic)
+    pages = load_pages(paths, image_pipeline, cache, cfg, stats, hashes, handover=handover,
+                       page_stats=page_stats)
+    for path, result in zip(paths, pages):
+        spill.put(path, result)
+    hashes.save()
+    hashes.apply(comic)
     comic = comic_processing(comic)
-    epub = ComicEpub(
-        filename,
-        title=(comic.title, comic.title),
-        subjects=comic.subjects,
-        authors=(None if (comic.authors is None) else [(a, a) for a in comic.authors]),
-        description=comic.description,
-        view_width=cfg.view_width,
-        view_height=cfg.view_height,
-        reading_order=cfg.reading_order,
-    )
-    errls = []
-    if comic.cover_path is not None:
-        data, ext = read_img(comic.cover_path)
+
+    def pages():
         try:
-            if cfg.enable_image_pipeline:
-                data, ext = image_pipeline(data, ext)
-            epub.add_comic_page(data, ext, page='cover', cover=True)
-        except UserWarning as e:
-            errls.append(str(e) + f': cover in {comic.title}')
-    for chapter_index, chapter in enumerate(comic.chapters):
-        for page_index, page in enumerate(chapter.pages):
-            data, ext = read_img(page.path)
+            for path in page_paths(comic):
+                yield spill.get(path)
+        finally:
+            spill.close()
+
+    return comic, pages()
+
+
+def new_book(filename: str, comic: Comic, cfg: MyConfig, **kwargs) -> Union[ComicEpub, ComicCbz]:
+    """
+    :param kwargs: passed on to ComicEpub or ComicCbz
+    """
+    kwargs.update(compression=CompressionPolicy(cfg.deflate_level, cfg.deflate_images),
+                  compress_threads=max(cfg.page_threads, 1))
+    if cfg.output_format == 'epub':
+        return ComicEpub(
+            filename,
+            title=(comic.title, comic.title),
+            subjects=comic.subjects,
+            authors=(None if (comic.authors is None) else [(a, a) for a in comic.authors]),
+            description=comic.description,
+            view_width=cfg.view_width,
+            view_height=cfg.view_height,
+            reading_order=cfg.reading_order,
+            **kwargs,
+        )
+    elif cfg.output_format == 'cbz':
+        return ComicCbz(
+            filename,
+            title=comic.title,
+            writer=(None if (comic.authors is None) else ','.join(comic.authors)),
+            publisher=comic.publisher,
+            genre=(None if (comic.subjects is None) else ','.join(comic.subjects)),
+            summary=comic.description,
+            **kwargs,
+        )
+    else:
+        raise ValueError('Invalid output format ' + cfg.output_format)
+
+
+def book_pages(comic: Comic, first_chapter: int = 0) -> List[Tuple[int, int, Page]]:
+    """
+    :return: (chapter index, page index in the chapter, page) of the pages from first_chapter on
+    """
+    return [(chapter_index, page_index, page)
+            for chapter_index, chapter in enumerate(comic.chapters)
+            if chapter_index >= first_chapter
+            for page_index, page in enumerate(chapter.pages)]
+
+
+def add_pages(
+    books: Sequence[Union[ComicEpub, ComicCbz]],
+    cfgs: Sequence[MyConfig],
+    comic: Comic,
+    cover: bool,
+    entries: List[Tuple[int, int, Page]],
+    pages: Iterator[Union[List[Tuple[bytes, str]], UserWarning]],
+    errls: List[str],
+    stats: Counter,
+):
+    """
+    Add the cover if cover is True, then the pages of entries from book_pages to each book,
+    taking the data of each page for each book from pages. The unfinished books are discarded
+    if anything but a page fails.
+
+    :param cfgs: config of the target of each book
+    """
+    try:
+        if cover:
+            try:
+                result = next(pages)
+                if isinstance(result, UserWarning): raise result
+                start = time.perf_counter()
+                for book, (data, ext) in zip(books, result):
+                    if isinstance(book, ComicEpub):
+                        book.add_comic_page(data, ext, page='cover', cover=True)
+                    else:
+                        book.add_comic_page(data, ext, '000-cover', 'cover')
+                stats['write_time'] += time.perf_counter() - start
+            except UserWarning as e:
+                errls.append(str(e) + f': cover in {comic.title}')
+        for chapter_index, page_index, page in entries:
+            chapter = comic.chapters[chapter_index]
             try:
-                if cfg.enable_image_pipeline:
-                    data, ext = image_pipeline(data, ext)
-                epub.add_comic_page(
-                    data, ext,
-                    cfg.chapter_format.format(title=chapter.title, index=chapter_index + 1),
-                    cfg.page_format.format(title=page.title, index=page_index),
-                    nav_label=(chapter.title if page_index == 0 else None))
+                result = next(pages)
+                if isinstance(result, UserWarning): raise result
+                start = time.perf_counter()
+                for book, cfg, (data, ext) in zip(books, cfgs, result):
+                    book.add_comic_page(
+                        data, ext,
+                        cfg.chapter_format.format(title=chapter.title, index=chapter_index + 1),
+                        cfg.page_format.format(title=page.title, index=page_index),
+                        nav_label=(chapter.title if page_index == 0 else None))
+                stats['write_time'] += time.perf_counter() - start
             except UserWarning as e:
                 errls.append(str(e) + f': {page.title} in {chapter.title} {comic.title}')
-    epub.save()
-    return os.path.split(filename)[1], errls
+    except BaseException:
+        for book in books:
+            book.discard()
+        raise
+
 
+def single(pages: Iterator[Union[Tuple[bytes, str], UserWarning]]):
+    """
+    Pages of load_pages for a single book, as taken by add_pages.
+    """
+    for result in pages:
+        yield result if isinstance(result, UserWarning) else [result]
 
-def pack_cbz(
+
+@metrics.task
+def pack_comic(
     filename: str,
     comic: Comic,
     comic_processing: ComicProcessPipeline,
     image_pipeline: ImagePipeline,
+    cache: Optional[ImageCache],
     cfg: MyConfig,
+    append_chapters: int = 0,
+    fragments: Optional[List[str]] = None,
+    handover: Optional[Handover] = None,
+    remove_handover: bool = False,
+    page_stats: Optional[Dict[str, Tuple[int, int]]] = None,
 ):
-    comic = comic_processing(comic)
-    cbz = ComicCbz(
-        filename,
-        title=comic.title,
-        writer=(None if (comic.authors is None) else ','.join(comic.authors)),
-        publisher=comic.publisher,
-        genre=(None if (comic.subjects is None) else ','.join(comic.subjects)),
-        summary=comic.description,
-    )
+    """
+    :param append_chapters: if > 0, the output exists with this many chapters of the comic,
+        only the chapters after them are packed and appended to it
+    :param fragments: if not None, all pages were packed into these fragments by pack_fragment,
+        which are merged in order and removed
+    :param handover: keys of the pages the range tasks processed into cache, see load_pages
+    :param remove_handover: remove the entries of handover from cache once packed
+    :param page_stats: stats of the pages from the scan, see load_pages
+    """
     errls = []
-    if comic.cover_path is not None:
-        data, ext = read_img(comic.cover_path)
+    stats: Counter = Counter()
+    if fragments is not None:
+        start = time.perf_counter()
+        book = new_book(filename, comic, cfg)
         try:
-            if cfg.enable_image_pipeline:
-                data, ext = image_pipeline(data, ext)
-            cbz.add_comic_page(data, ext, '000-cover', 'cover')
-        except UserWarning as e:
-            errls.append(str(e) + f': cover in {comic.title}')
-    for chapter_index, chapter in enumerate(comic.chapters):
-        for page_index, page in enumerate(chapter.pages):
-            data, ext = read_img(page.path)
-            try:
-                if cfg.enable_image_pipeline:
-                    data, ext = image_pipeline(data, ext)
-                cbz.add_comic_page(
-                    data, ext,
-                    cfg.chapter_format.format(title=chapter.title, index=chapter_index + 1),
-                    cfg.page_format.format(title=page.title, index=page_index),
-                    nav_label=(chapter.title if page_index == 0 else None))
-            except UserWarning as e:
-                errls.append(str(e) + f': {page.title} in {chapter.title} {comic.title}')
-    cbz.save()
-    return os.path.split(filename)[1], errls
+            for fragment in fragments:
+                book.add_fragment(fragment)
+        except BaseException:
+            book.discard()
+            raise
+        finally:
+            for fragment in fragments:
+                if os.path.exists(fragment):
+                    os.remove(fragment)
+        stats['write_time'] += time.perf_counter() - start
+    else:
+        try:
+            if append_chapters > 0:
+                comic = comic_processing(comic)
+                pages = load_pages(page_paths(comic, append_chapters), image_pipeline, cache,
+                                   cfg, stats, handover=handover, page_stats=page_stats)
+                stats['appended_chapters'] = len(comic.chapters) - append_chapters
+            else:
+                comic, pages = load_comic(comic, comic_processing, image_pipeline, cache, cfg,
+                                          stats, handover, page_stats)
+            book = new_book(filename, comic, cfg, append=append_chapters > 0)
+            add_pages([book], [cfg], comic, comic.cover_path is not None and append_chapters == 0,
+                      book_pages(comic, append_chapters), single(pages), errls, stats)
+        finally:
+            if remove_handover and handover is not None:
+                for key, _ in handover.values():
+                    cache.remove(key)  # type: ignore
+    start = time.perf_counter()
+    book.save()
+    stats['write_time'] += time.perf_counter() - start
+    stats['output_bytes'] = os.path.getsize(book.filename)
+    return os.path.split(filename)[1], errls, stats
 
 
-def callback(x: Tuple[str, List[str]]):
-    logger = logging.getLogger('main')
-    filename, errls = x
-    logger.info(f'Packed {filename}')
-    for err in errls:
-        logger.warning(err)
-    return
+@metrics.task
+def pack_fragment(
+    fragment: str,
+    comic: Comic,
+    start: int,
+    stop: int,
+    image_pipeline: ImagePipeline,
+    cache: Optional[ImageCache],
+    cfg: MyConfig,
+    page_stats: Optional[Dict[str, Tuple[int, int]]] = None,
+):
+    """
+    Pack a range of pages of a large comic into a fragment, to be merged by pack_comic.
+    The comic has to need no processing, as its chapters are fixed before packing.
+
+    :param start: index of the first page of the range, where the cover, if any, is page 0
+    :param stop: index after the last page of the range
+    :param page_stats: stats of the pages from the scan, see load_pages
+    """
+    errls = []
+    stats: Counter = Counter()
+    offset = 0 if comic.cover_path is None else 1
+    cover = offset == 1 and start == 0
+    entries = book_pages(comic)[max(start - offset, 0):stop - offset]
+    paths = ([comic.cover_path] if cover else []) + [page.path for _, _, page in entries]
+    pages = load_pages(paths, image_pipeline, cache, cfg, stats,  # type: ignore
+                       page_stats=page_stats)
+    book = new_book(fragment, comic, cfg, first_index=start)
+    add_pages([book], [cfg], comic, cover, entries, single(pages), errls, stats)
+    write_start = time.perf_counter()
+    book.save_fragment()
+    stats['write_time'] += time.perf_counter() - write_start
+    return f'{comic.title} pages {start}-{stop}', errls, stats
 
 
-def errback(e: BaseException):
+@metrics.task
+def pack_targets(
+    outputs: List[Tuple[str, MyConfig, int]],
+    comic: Comic,
+    comic_processing: ComicProcessPipeline,
+    image_pipeline: MultiPipeline,
+    caches: List[Optional[ImageCache]],
+    cfg: MyConfig,
+    page_stats: Optional[Dict[str, Tuple[int, int]]] = None,
+):
+    """
+    Pack a comic for several targets at once, each page is read and decoded once for all of
+    them, and encoded once for the targets sharing a pipeline.
+
+    :param outputs: path, config and index of the pipeline in image_pipeline of each target
+    :param caches: cache of each pipeline of image_pipeline
+    :param page_stats: stats of the pages from the scan, see load_pages
+    """
+    errls = []
+    stats: Counter = Counter()
+    comic, pages = load_comic(comic, comic_processing, image_pipeline, caches, cfg, stats,
+                              page_stats=page_stats)
+    books = [new_book(filename, comic, target) for filename, target, _ in outputs]
+    results = (result if isinstance(result, UserWarning) else [result[i] for _, _, i in outputs]
+               for result in pages)
+    add_pages(books, [target for _, target, _ in outputs], comic, comic.cover_path is not None,
+              book_pages(comic), results, errls, stats)
+    start = time.perf_counter()
+    for book in books:
+        book.save()
+        stats['output_bytes'] += os.path.getsize(book.filename)
+    stats['write_time'] += time.perf_counter() - start
+    return ', '.join(os.path.relpath(filename, cfg.output_path)
+                     for filename, _, _ in outputs), errls, stats
+
+
+@metrics.timed('scan')
+def scan_comic(path: str, parser: Type[BaseParser], secondary_parser: Optional[Type[BaseParser]],
+               manifest: Optional[Manifest] = None, restat: bool = False):
+    """
+    Parse a comic folder and stat its pages, on a scan thread.
+
+    :param manifest: if not None, reuse the comic parsed by a previous run if it is unchanged
+    :param restat: stat the pages of a comic reused from the manifest again, which notices pages
+        modified in place, without their folder changing
+    :return: comic, None if it cannot be parsed, and stats of its pages from stat_pages
+    """
     logger = logging.getLogger('main')
-    logger.error(str(e))
-    return
+    parser_name = parser.__name__ + ('' if secondary_parser is None else
+                                     '/' + secondary_parser.__name__)
+    reader = None
+    if manifest is not None:
+        cached = manifest.get_comic(path, parser_name)
+        if cached is not None:
+            if restat:
+                return cached[0], stat_pages(page_paths(cached[0]))
+            return cached
+        reader = manifest.reader()
+    try:
+        comic = parser.parse(path, reader)
+    except UserWarning as e:
+        logger.warning(f'Primary source format parsing failed: {e}')
+        if secondary_parser is None:
+            logger.error('No secondary source format provided, skipping')
+            return None, {}
+        else:
+            logger.warning('Switching to secondary source format')
+            try:
+                comic = secondary_parser.parse(path, reader)
+            except Exception as e:
+                logger.error(f'Secondary source format parsing failed: {e}, path: {path}')
+                return None, {}
+    except Exception as e:
+        logger.error(f'Parsing failed: {e}, path: {path}')
+        return None, {}
+    page_stats = stat_pages(page_paths(comic))
+    if manifest is not None:
+        manifest.put_comic(path, parser_name, reader, comic, page_stats)  # type: ignore
+    return comic, page_stats
+
+
+def init_worker(encoder_threads: int, progress: Optional[effort.Progress]):
+    set_encoder_threads(encoder_threads)
+    effort.set_progress(progress)
+
+
+class Callback:
+    def __init__(self, records: Optional[BuildRecords] = None,
+                 progress: Optional[effort.Progress] = None) -> None:
+        """
+        :param records: if not None, record the outputs packed
+        :param progress: if not None, count the pages packed
+        """
+        self.stats: Counter = Counter()
+        # name of the job -> stats of its tasks
+        self.jobs: Dict[str, Counter] = defaultdict(Counter)
+        self.records = records
+        self.progress = progress
+
+    def __call__(self, x: Tuple[str, List[str], Counter],
+                 outputs: Sequence[Tuple[str, str, Optional[List[str]]]] = (), name: str = ''):
+        """
+        :param outputs: path of each output packed, with the fingerprint of its settings and the
+            digests of its comic from comic_digests
+        :param name: name of the job in the run report
+        """
+        logger = logging.getLogger('main')
+        filename, errls, stats = x
+        self.stats.update(stats)
+        self.jobs[name or filename].update(stats)
+        if self.progress is not None:
+            self.progress.reconcile(self.stats['pages'])
+        if self.records is not None:
+            for output, fingerprint, digests in outputs:
+                if digests is not None:
+                    self.records.put(output, fingerprint, digests)
+        details = (f'{stats["output_bytes"] / (1 << 20):.1f} MB, '
+                   f'written in {stats["write_time"]:.1f}s')
+        if stats['passthrough'] > 0:
+            details = f'{stats["passthrough"]}/{stats["pages"]} pages unchanged, ' + details
+        if stats['appended_chapters'] > 0:
+            logger.info(
+                f'Appended {stats["appended_chapters"]} chapters to {filename} ({details})')
+        else:
+            logger.info(f'Packed {filename} ({details})')
+        for err in errls:
+            logger.warning(err)
+        return
+
+    def warmed(self, x: Tuple[Handover, Counter], handover: Handover, name: str):
+        """
+        Callback of the range tasks running warm_pages, whose cache keys are added to handover.
+        """
+        handover.update(x[0])
+        self.range_task(x[1], name, count_pages=False)
+
+    def range_task(self, x: Union[Tuple[str, List[str], Counter], Counter], name: str,
+                   count_pages: bool = True):
+        """
+        Callback of the range tasks of a job, the output is logged by the job's own task.
+
+        :param count_pages: False if the pages are counted again by the job's own task, only
+            the time spent is counted then
+        """
+        errls, stats = (x[1], x[2]) if isinstance(x, tuple) else ([], x)
+        if not count_pages:
+            stats = Counter({key: value for key, value in stats.items()
+                             if key.startswith('stage:') or key in ('wall_time', 'cpu_time')})
+        self.stats.update(stats)
+        self.jobs[name].update(stats)
+        if self.progress is not None:
+            self.progress.reconcile(self.stats['pages'])
+        for err in errls:
+            logging.getLogger('main').warning(err)
 
 
 def convert(cfg: MyConfig):
@@ -127,6 +732,8 @@ def convert(cfg: MyConfig):
         parser = DmzjBackupParser
     elif cfg.source_format == 'zmhbackup':
         parser = ZMHBackupParser
+    elif cfg.source_format == 'archive':
+        parser = ArchiveParser
     else:
         raise ValueError(f'Invalid source format: {cfg.source_format}')
 
@@ -142,6 +749,8 @@ def convert(cfg: MyConfig):
         secondary_parser = DmzjBackupParser
     elif cfg.secondary_source_format == 'zmhbackup':
         secondary_parser = ZMHBackupParser
+    elif cfg.secondary_source_format == 'archive':
+        secondary_parser = ArchiveParser
     else:
         raise ValueError(f'Invalid secondary source format: {cfg.secondary_source_format}')
 
@@ -156,7 +765,10 @@ def convert(cfg: MyConfig):
     )
     comic_processing = ComicProcessPipeline()
     if cfg.enable_dedup:
-        comic_processing.append(ImageDedup(cfg.dedup_method))
+        store = HashStore(os.path.join(cfg.output_path, '.hashes.sqlite')) \
+            if cfg.enable_hash_store else None
+        comic_processing.append(
+            ImageDedup(cfg.dedup_method, store, cfg.page_threads, cfg.dedup_max_distance))
 
     # manual split
     manual_breakpoints: Dict[str, List] = {}
@@ -169,85 +781,274 @@ def convert(cfg: MyConfig):
             if 'replace_cover' in dic:
                 manual_replace_cover[dic['title']] = dic['replace_cover']
 
-    # image pipeline
-    image_pipeline = ImagePipeline(cfg.fixed_ext, cfg.jpeg_quality, cfg.avif_quality,
-                                   cfg.avif_speed, cfg.webp_quality, cfg.webp_method,
-                                   cfg.webp_lossless, cfg.png_compression)
+    # encoder effort chosen per page to finish by the deadline or keep the page rate
+    deadline = None if cfg.deadline == '' else effort.parse_deadline(cfg.deadline)
+    adaptive_effort = cfg.enable_image_pipeline and (deadline is not None
+                                                     or cfg.target_pages_per_s > 0)
+
+    # image pipeline of each target, targets with the same image settings share one
+    targets = cfg.target_configs()
+    crop = None
     if cfg.enable_crop:
-        image_pipeline.append(ThresholdCrop(cfg.crop_lower_threshold, cfg.crop_upper_threshold))
-    if cfg.enable_downsample:
-        image_pipeline.append(DownSample(cfg.screen_height, cfg.screen_width, cfg.interpolation))
+        crop = ThresholdCrop(cfg.crop_lower_threshold, cfg.crop_upper_threshold,
+                             cfg.crop_coarse_step)
+    # fingerprint of image settings -> index in image_pipelines
+    pipeline_index: Dict[str, int] = {}
+    image_pipelines: List[ImagePipeline] = []
+    for target in targets:
+        fingerprint = target.fingerprint(IMAGE_FIELDS)
+        if fingerprint in pipeline_index: continue
+        pipeline_index[fingerprint] = len(image_pipelines)
+        image_pipeline = ImagePipeline(target.fixed_ext, target.jpeg_quality, target.avif_quality,
+                                       target.avif_speed, target.webp_quality, target.webp_method,
+                                       target.webp_lossless, target.png_compression,
+                                       adaptive_effort)
+        if crop is not None:
+            image_pipeline.append(crop)
+        if target.enable_downsample:
+            image_pipeline.append(
+                DownSample(target.screen_height, target.screen_width, target.interpolation))
+        image_pipelines.append(image_pipeline)
+    # pages of comics packed for several targets at once are cropped once for all of them
+    multi_pipeline = MultiPipeline(image_pipelines, 0 if crop is None else 1)
+
+    # cache
+    caches: List[Optional[ImageCache]] = [None] * len(image_pipelines)
+    if cfg.enable_image_pipeline and cfg.enable_cache:
+        caches = [ImageCache(cfg.cache_path, fingerprint, cfg.cache_size << 20)
+                  for fingerprint in pipeline_index]
+    # pages packed for several targets at once are decoded at the size every target can be made
+    # from, so their crops may differ from those of a target packed alone, keep them apart
+    multi_caches = caches
+    if caches[0] is not None and len(image_pipelines) > 1:
+        shared = ' '.join(pipeline_index)
+        multi_caches = [ImageCache(cfg.cache_path, f'{fingerprint} with {shared}',
+                                   cfg.cache_size << 20) for fingerprint in pipeline_index]
 
-    pool = Pool()
+    # pages of comics split into range tasks are handed over to the pack task through a cache
+    split_caches = caches
+    if cfg.enable_image_pipeline and cfg.max_task_pages > 0 and not cfg.enable_cache:
+        split_path = tempfile.mkdtemp(prefix='.cache-', dir=cfg.output_path)
+        split_caches = [ImageCache(split_path, fingerprint, 0) for fingerprint in pipeline_index]
+
+    # range tasks of comics split with pack_fragments write fragments merged by the pack task
+    fragment_dir = None
+    if cfg.pack_fragments and cfg.max_task_pages > 0:
+        fragment_dir = tempfile.mkdtemp(prefix='.fragments-', dir=cfg.output_path)
+    fragment_ids = itertools.count()
+
+    layout = plan_workers(cfg.processes, cfg.page_threads, cfg.encoder_threads)
+    logger.info(f'Workers: {layout}')
+    progress = None
+    if adaptive_effort:
+        progress = effort.Progress(layout.processes * layout.page_threads, cfg.target_pages_per_s,
+                                   deadline)
+        if deadline is not None:
+            logger.info('Adaptive encoder effort, deadline '
+                        f'{datetime.datetime.fromtimestamp(deadline):%Y-%m-%d %H:%M}')
+        else:
+            logger.info(f'Adaptive encoder effort, target {cfg.target_pages_per_s:g} pages/s')
+    scheduler = Scheduler(layout.processes, cfg.max_queued_tasks, cfg.report_interval,
+                          cfg.max_tasks_per_child if cfg.max_tasks_per_child > 0 else None,
+                          init_worker, (layout.encoder_threads, progress))
+    records = BuildRecords(os.path.join(cfg.output_path, '.builds.sqlite')) \
+        if cfg.incremental_build else None
+    callback = Callback(records, progress)
 
     logger.info('Start packing')
+    start = time.perf_counter()
 
-    for comic_folder in natsort.os_sorted(os.listdir(cfg.source_path)):
-        path = os.path.join(cfg.source_path, comic_folder)
-        if not os.path.isdir(path): continue
-        # parse
-        try:
-            comic = parser.parse(path)
-        except UserWarning as e:
-            logger.warning(f'Primary source format parsing failed: {e}')
-            if secondary_parser is None:
-                logger.error('No secondary source format provided, skipping')
-                continue
+    # a comic may also be a single archive
+    archives = ArchiveParser in (parser, secondary_parser)
+    with os.scandir(cfg.source_path) as it:
+        comic_folders = natsort.os_sorted(
+            entry.name for entry in it
+            if entry.is_dir() or (archives and is_archive(entry.name) and entry.is_file()))
+    manifest = Manifest(os.path.join(cfg.output_path, '.manifest.sqlite')) \
+        if cfg.enable_manifest else None
+    scan_executor = ThreadPoolExecutor(cfg.scan_threads)
+    try:
+        # comics are parsed ahead on scan_threads threads, packing starts as soon as the first is
+        # ready
+        scanned = ordered_map(
+            scan_executor,
+            lambda comic_folder: scan_comic(os.path.join(cfg.source_path, comic_folder), parser,
+                                            secondary_parser, manifest, cfg.incremental_build),
+            comic_folders, cfg.scan_threads * 2)
+        for comic, page_stats in scanned:
+            if comic is None: continue
+            # split
+            if comic.title in manual_breakpoints:
+                comics = manual_split(
+                    comic,
+                    manual_breakpoints[comic.title],
+                    manual_replace_cover[comic.title],
+                    cfg.manual_title_format,
+                )
+                split = cfg.manual_separate_folder
+            elif cfg.fixed_split != -1:
+                comics = fixed_split(
+                    comic,
+                    cfg.fixed_split,
+                    cfg.fixed_replace_cover,
+                    cfg.fixed_title_format,
+                )
+                split = cfg.fixed_separate_folder
             else:
-                logger.warning('Switching to secondary source format')
-                try:
-                    comic = secondary_parser.parse(path)
-                except Exception as e:
-                    logger.error(f'Secondary source format parsing failed: {e}, path: {path}')
+                comics = [comic]
+                split = False
+            original_title = comic.title
+            for comic in comics:
+                digests = None if records is None else comic_digests(comic, page_stats)
+                # (target, path, chapters of the comic in the output already) of the outputs to pack
+                outputs: List[Tuple[MyConfig, str, set]] = []
+                for target in targets:
+                    if split:
+                        filefolder = os.path.join(target.output_path, original_title)
+                        safe_makedirs(filefolder)
+                        filename = os.path.join(filefolder,
+                                                comic.title + '.' + target.output_format)
+                    else:
+                        filename = os.path.join(target.output_path,
+                                                comic.title + '.' + target.output_format)
+                    name = os.path.relpath(filename, cfg.output_path)
+                    packed_chapters = set()
+                    if records is not None:
+                        fingerprint = target.fingerprint(OUTPUT_FIELDS)
+                        if records.up_to_date(filename, fingerprint, digests):  # type: ignore
+                            logger.info(f'{name} is up to date')
+                            continue
+                        # dedup moves pages of new chapters to the copyright chapter, which is
+                        # the last
+                        if cfg.append_chapters and not cfg.enable_dedup:
+                            num_packed = records.appendable(filename, fingerprint,
+                                                            digests)  # type: ignore
+                            packed_chapters = set(comic.chapters[:num_packed])
+                        if len(packed_chapters) == 0 and os.path.exists(filename):
+                            logger.info(f'{name} changed, rebuilding')
+                    elif os.path.exists(filename):
+                        logger.info(f'{name} exists')
+                        continue
+                    outputs.append((target, filename, packed_chapters))
+                if len(outputs) == 0: continue
+                if not comic_filter(comic): continue
+                num_pages, num_bytes = estimate_cost(comic, page_stats)
+                cost = num_bytes + num_pages * PAGE_COST
+                if progress is not None:
+                    progress.submit(num_pages)
+                # one job per comic, for all its targets, in the run report
+                job = os.path.join(original_title, comic.title) if split else comic.title
+                on_packed = functools.partial(
+                    callback,
+                    name=job,
+                    outputs=[(filename, target.fingerprint(OUTPUT_FIELDS), digests)
+                             for target, filename, _ in outputs])
+                if len(outputs) > 1:
+                    # several targets are packed in full by one task, decoding each page once
+                    name = ', '.join(os.path.relpath(filename, cfg.output_path)
+                                     for _, filename, _ in outputs)
+                    if 0 < cfg.max_task_pages < num_pages:
+                        logger.info(f'{comic.title} is packed for {len(outputs)} targets by one '
+                                    f'task, not split into tasks of {cfg.max_task_pages} pages')
+                    scheduler.submit(
+                        Task(name, cost, pack_targets,
+                             ([(filename, target, pipeline_index[target.fingerprint(IMAGE_FIELDS)])
+                               for target, filename, _ in outputs], comic, comic_processing,
+                              multi_pipeline, multi_caches, cfg, page_stats), on_packed))
                     continue
-        except Exception as e:
-            logger.error(f'Parsing failed: {e}, path: {path}')
-            continue
-        # split
-        if comic.title in manual_breakpoints:
-            comics = manual_split(
-                comic,
-                manual_breakpoints[comic.title],
-                manual_replace_cover[comic.title],
-                cfg.manual_title_format,
-            )
-            split = cfg.manual_separate_folder
-        elif cfg.fixed_split != -1:
-            comics = fixed_split(
-                comic,
-                cfg.fixed_split,
-                cfg.fixed_replace_cover,
-                cfg.fixed_title_format,
-            )
-            split = cfg.fixed_separate_folder
-        else:
-            comics = [comic]
-            split = False
-        original_title = comic.title
-        for comic in comics:
-            if split:
-                filefolder = os.path.join(cfg.output_path, original_title)
-                safe_makedirs(filefolder)
-                filename = os.path.join(filefolder, comic.title + '.' + cfg.output_format)
-            else:
-                filename = os.path.join(cfg.output_path, comic.title + '.' + cfg.output_format)
-            if os.path.exists(filename):
-                logger.info(f'{os.path.split(filename)[1]} exists')
-                continue
-            if not comic_filter(comic): continue
-            # logger.info(f'Packing {os.path.split(filename)[1]}')
-            if cfg.output_format == 'epub':
-                pool.apply_async(pack_epub,
-                                 (filename, comic, comic_processing, image_pipeline, cfg),
-                                 callback=callback, error_callback=errback)
-            elif cfg.output_format == 'cbz':
-                pool.apply_async(pack_cbz, (filename, comic, comic_processing, image_pipeline, cfg),
-                                 callback=callback, error_callback=errback)
-            else:
-                raise ValueError('Invalid output format ' + cfg.output_format)
+                target, filename, packed_chapters = outputs[0]
+                name = os.path.relpath(filename, cfg.output_path)
+                index = pipeline_index[target.fingerprint(IMAGE_FIELDS)]
+                image_pipeline, cache, split_cache = \
+                    image_pipelines[index], caches[index], split_caches[index]
+                # chapters in the output already, after the chapter filter
+                append_chapters = sum(chapter in packed_chapters for chapter in comic.chapters)
+                # logger.info(f'Packing {os.path.split(filename)[1]}')
+                if fragment_dir is not None and num_pages > cfg.max_task_pages \
+                        and append_chapters == 0 and len(comic_processing.handlers) == 0:
+                    bounds = list(range(0, num_pages, cfg.max_task_pages)) + [num_pages]
+                    fragments = [
+                        os.path.join(fragment_dir, f'{next(fragment_ids)}.{target.output_format}')
+                        for _ in bounds[1:]]
+                    ranges = [
+                        Task(f'{name} pages {i}-{j}', cost, pack_fragment,
+                             (fragment, comic, i, j, image_pipeline, cache, target, page_stats),
+                             functools.partial(callback.range_task, name=job))
+                        for fragment, i, j in zip(fragments, bounds[:-1], bounds[1:])]
+                    scheduler.submit(
+                        Task(name, cost, pack_comic,
+                             (filename, comic, comic_processing, image_pipeline, cache, target, 0,
+                              fragments), on_packed, count_throughput=False), ranges)
+                elif split_cache is not None and num_pages > cfg.max_task_pages:
+                    paths = page_paths(comic, append_chapters)
+                    # filled by the range tasks before the pack task is started, with its arguments
+                    handover: Handover = {}
+                    ranges = [
+                        Task(f'{name} pages {i}-{i + cfg.max_task_pages}', cost, warm_pages,
+                             (paths[i:i + cfg.max_task_pages], comic_processing, image_pipeline,
+                              split_cache, target, page_stats),
+                             functools.partial(callback.warmed, handover=handover, name=job))
+                        for i in range(0, num_pages, cfg.max_task_pages)]
+                    scheduler.submit(
+                        Task(name, cost, pack_comic,
+                             (filename, comic, comic_processing, image_pipeline, split_cache,
+                              target, append_chapters, None, handover, split_cache is not cache,
+                              page_stats),
+                             on_packed, count_throughput=False), ranges)
+                else:
+                    scheduler.submit(
+                        Task(name, cost, pack_comic,
+                             (filename, comic, comic_processing, image_pipeline, cache, target,
+                              append_chapters, None, None, False, page_stats), on_packed))
+    finally:
+        # scans submitted ahead are cancelled if packing stopped on an error
+        scan_executor.shutdown(cancel_futures=True)
+    if manifest is not None:
+        manifest.prune(os.path.join(cfg.source_path, folder) for folder in comic_folders)
+    scheduler.join()
+    if split_caches is not caches:
+        shutil.rmtree(split_caches[0].path, ignore_errors=True)  # type: ignore
+    if fragment_dir is not None:
+        shutil.rmtree(fragment_dir, ignore_errors=True)
 
-    pool.close()
-    pool.join()
+    stats = callback.stats
+    # stages run in this process, i.e. scanning
+    stats.update(metrics.collect())
+    elapsed = time.perf_counter() - start
+    logger.info(f'{stats["output_bytes"] / (1 << 20):.1f} MB written, '
+                f'{stats["write_time"]:.1f}s spent writing')
+    if cfg.enable_image_pipeline:
+        logger.info(f'{stats["passthrough"]}/{stats["pages"]} pages copied without re-encoding')
+    if caches[0] is not None:
+        # caches of all targets share one directory
+        removed = caches[0].evict()
+        logger.info(f'Cache: {stats["cache_hit"]} hits, {stats["cache_miss"]} misses, '
+                    f'{stats["cache_bytes"] / (1 << 20):.1f} MB reused, {removed} entries evicted')
+    usage = effort.usage(stats)
+    for encoder, levels in usage.items():
+        logger.info(f'{encoder}: ' + ', '.join(f'{pages} pages at {level}'
+                                               for level, pages in sorted(levels.items())))
+    if progress is not None:
+        rate = f'{stats["pages"] / elapsed:.2f} pages/s'
+        if deadline is not None:
+            margin = deadline - time.time()
+            logger.info(f'{rate}, finished {abs(margin) / 60:.1f} min '
+                        f'{"before" if margin >= 0 else "after"} the deadline')
+        else:
+            logger.info(f'{rate}, target {cfg.target_pages_per_s:g} pages/s')
+    if cfg.report_path != '' or cfg.prometheus_path != '':
+        run_report = report.build_report(stats, elapsed, callback.jobs)
+        if progress is not None:
+            run_report['effort'] = {
+                'deadline': cfg.deadline,
+                'target_pages_per_s': cfg.target_pages_per_s,
+                'pages': usage,
+            }
+        if cfg.report_path != '':
+            report.write_report(cfg.report_path, run_report)
+            logger.info(f'Report written to {cfg.report_path}')
+        if cfg.prometheus_path != '':
+            report.write_prometheus(cfg.prometheus_path, run_report)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+import os
+import math
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+
+# CPUs available to this process, which may be far fewer than os.cpu_count() in a container:
+# the affinity mask limits which CPUs it may run on, and the CPU quota of its cgroup how much
+# CPU time it may use.
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _ancestors(root: str, cgroup: str) -> Iterator[str]:
+    """
+    :return: folders of cgroup and of its parents, in the hierarchy mounted at root
+    """
+    parts = [part for part in cgroup.split('/') if part != '']
+    for i in range(len(parts), -1, -1):
+        yield os.path.join(root, *parts[:i])
+
+
+def _quota_v2(cgroup: str) -> Optional[float]:
+    limits = []
+    for folder in _ancestors(CGROUP_ROOT, cgroup):
+        value = _read(os.path.join(folder, 'cpu.max'))
+        if value is None: continue
+        # "max 100000" if unlimited
+        quota, period = (value.split() + ['100000'])[:2]
+        if quota != 'max' and int(period) > 0:
+            limits.append(int(quota) / int(period))
+    return min(limits, default=None)
+
+
+def _quota_v1(cgroup: str) -> Optional[float]:
+    limits = []
+    for root in (os.path.join(CGROUP_ROOT, 'cpu,cpuacct'), os.path.join(CGROUP_ROOT, 'cpu')):
+        for folder in _ancestors(root, cgroup):
+            quota = _read(os.path.join(folder, 'cpu.cfs_quota_us'))
+            period = _read(os.path.join(folder, 'cpu.cfs_period_us'))
+            if quota is None or period is None: continue
+            # -1 if unlimited
+            if int(quota) > 0 and int(period) > 0:
+                limits.append(int(quota) / int(period))
+        if len(limits) > 0: break
+    return min(limits, default=None)
+
+
+def cgroup_quota() -> Optional[float]:
+    """
+    :return: CPU quota of the cgroup of this process and its parents in CPUs, None if there is
+        none or it cannot be read, e.g. not on Linux
+    """
+    cgroups = _read('/proc/self/cgroup')
+    if cgroups is None: return None
+    limits: List[float] = []
+    for line in cgroups.splitlines():
+        try:
+            _, controllers, cgroup = line.split(':', 2)
+            # the path of the cgroup may not exist in a container without a cgroup namespace,
+            # whose own cgroup is then mounted at the root
+            limit = _quota_v2(cgroup) if controllers == '' else \
+                _quota_v1(cgroup) if 'cpu' in controllers.split(',') else None
+        except ValueError:
+            continue
+        if limit is not None:
+            limits.append(limit)
+    return min(limits, default=None)
+
+
+def affinity_cpus() -> int:
+    """
+    :return: number of CPUs this process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@dataclass(eq=False)
+class WorkerLayout:
+    """
+    How the CPUs of a run are shared: each of the worker processes packs a comic at a time, on
+    page_threads threads, and each AVIF encoder or decoder runs on encoder_threads threads.
+    """
+    cpus: int
+    processes: int
+    page_threads: int
+    encoder_threads: int
+    affinity: int
+    quota: Optional[float]
+
+    def __str__(self) -> str:
+        limits = f'affinity {self.affinity}' + (
+            '' if self.quota is None else f', cgroup quota {self.quota:g}')
+        return (f'{self.processes} processes x {self.page_threads} page threads x '
+                f'{self.encoder_threads} encoder threads on {self.cpus} CPUs ({limits})')
+
+
+def plan_workers(processes: int = 0, page_threads: int = 1,
+                 encoder_threads: int = 0) -> WorkerLayout:
+    """
+    Split the CPUs available to this process between worker processes, page threads and
+    encoder threads, so that they do not run more threads than CPUs.
+
+    :param processes: number of worker processes, 0 for as many as the CPUs left to them
+    :param encoder_threads: threads of each encoder, 0 for as many as the CPUs left to them
+    """
+    affinity = affinity_cpus()
+    quota = cgroup_quota()
+    cpus = affinity if quota is None else max(1, min(affinity, math.ceil(quota)))
+    page_threads = max(page_threads, 1)
+    if processes <= 0:
+        processes = max(1, cpus // (page_threads * max(encoder_threads, 1)))
+    if encoder_threads <= 0:
+        encoder_threads = max(1, cpus // (processes * page_threads))
+    return WorkerLayout(cpus, processes, page_threads, encoder_threads, affinity, quota)
@@ -0,0 +1,249 @@
+import time
+import datetime
+import threading
+import multiprocessing
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+from . import metrics
+
+# With a deadline or a page rate to keep, the AVIF speed and WebP method of each page are chosen
+# as it is encoded: the slowest effort, i.e. the smallest output, whose encoding time measured so
+# far fits the time left to the page for the run to keep up. Efforts are chosen by the worker
+# processes, from the Progress of the run shared with the parent.
+
+# weight of a new measurement in the moving averages
+ALPHA = 0.2
+# an effort not measured yet is assumed this much slower than the next faster effort
+STEP = 1.5
+# prefix of the stages timing the encoding at each effort, see usage()
+STAGE = 'effort.'
+
+
+def parse_deadline(text: str, now: Optional[datetime.datetime] = None) -> float:
+    """
+    :param text: "HH:MM" for the next time it is that time of day, or "YYYY-MM-DD HH:MM"
+    :return: timestamp of the deadline
+    """
+    now = now or datetime.datetime.now()
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M').timestamp()
+    except ValueError:
+        pass
+    try:
+        clock = datetime.datetime.strptime(text, '%H:%M')
+    except ValueError:
+        raise ValueError(f'Invalid deadline {text}, expected HH:MM or YYYY-MM-DD HH:MM')
+    deadline = now.replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0)
+    if deadline <= now:
+        deadline += datetime.timedelta(days=1)
+    return deadline.timestamp()
+
+
+class Progress:
+    """
+    Pages of the run and the page rate it has to keep, shared by the parent process, which
+    counts the pages submitted, and the worker processes, which count the pages they process.
+    """
+    def __init__(self, slots: int, pages_per_s: float = 0.0,
+                 deadline: Optional[float] = None) -> None:
+        """
+        :param slots: number of pages processed at once by all workers
+        :param pages_per_s: page rate to keep from now on, if there is no deadline
+        :param deadline: timestamp by which the pages submitted have to be processed
+        """
+        self.slots = slots
+        self.pages_per_s = pages_per_s
+        self.deadline = deadline
+        self.start = time.time()
+        # pages submitted, pages processed
+        self.counts = multiprocessing.Array('d', 2)
+
+    def submit(self, pages: int):
+        with self.counts.get_lock():
+            self.counts[0] += pages
+
+    def processed(self, pages: int = 1):
+        with self.counts.get_lock():
+            self.counts[1] += pages
+
+    def reconcile(self, pages: int):
+        """
+        :param pages: pages of the tasks finished so far, which also counts the pages not
+            processed by an image pipeline, e.g. found in the cache
+        """
+        with self.counts.get_lock():
+            self.counts[1] = max(self.counts[1], pages)
+
+    def rate(self) -> Optional[float]:
+        """
+        A page rate to keep is a deadline moving with the pages submitted, so that the time lost
+        to what the encoders cannot see, e.g. reading and writing, is made up for in both cases.
+
+        :return: pages per second to keep from now on, inf past the deadline, None if there is
+            nothing left to process or no deadline
+        """
+        if self.deadline is None and self.pages_per_s <= 0: return None
+        with self.counts.get_lock():
+            submitted, processed = self.counts[0], self.counts[1]
+        if submitted <= processed: return None
+        deadline = self.deadline if self.deadline is not None else \
+            self.start + submitted / self.pages_per_s
+        left = deadline - time.time()
+        return (submitted - processed) / left if left > 0 else float('inf')
+
+    def page_time(self) -> Optional[float]:
+        """
+        :return: seconds a page may take to process, None if there is no limit
+        """
+        rate = self.rate()
+        if rate is None: return None
+        return self.slots / rate
+
+
+class EffortController:
+    """
+    Choose the effort of an encoder for each page from the time it took at each effort so far.
+    """
+    def __init__(self, levels: Sequence[int]) -> None:
+        """
+        :param levels: efforts of the encoder, from slowest to fastest
+        """
+        self.levels = list(levels)
+        # effort -> moving average of the encoding time in seconds per megapixel
+        self.costs: Dict[int, float] = {}
+        self.lock = threading.Lock()
+
+    def estimate(self, index: int) -> float:
+        """
+        :return: seconds per megapixel at the effort levels[index], 0 if nothing is measured
+        """
+        level = self.levels[index]
+        if level in self.costs: return self.costs[level]
+        measured = [i for i, level in enumerate(self.levels) if level in self.costs]
+        if len(measured) == 0: return 0.0
+        nearest = min(measured, key=lambda i: abs(i - index))
+        return self.costs[self.levels[nearest]] * STEP ** (nearest - index)
+
+    def choose(self, megapixels: float, budget: Optional[float]) -> int:
+        """
+        :param budget: seconds the encoding may take, None if unlimited
+        :return: slowest effort expected to encode the page within budget, the fastest if none
+        """
+        if budget is None: return self.levels[0]
+        with self.lock:
+            for i, level in enumerate(self.levels):
+                if self.estimate(i) * megapixels <= budget:
+                    return level
+        return self.levels[-1]
+
+    def record(self, level: int, megapixels: float, seconds: float):
+        cost = seconds / max(megapixels, 1e-3)
+        with self.lock:
+            old = self.costs.get(level)
+            self.costs[level] = cost if old is None else old + ALPHA * (cost - old)
+
+
+# state of the worker process
+_progress: Optional[Progress] = None
+_controllers: Dict[Tuple[str, Tuple[int, ...]], EffortController] = {}
+# moving average of the seconds spent on a page besides adaptive encoding
+_overhead = 0.0
+_lock = threading.Lock()
+# seconds spent, number of adaptive encoders left and whether an encoder used less than its
+# slowest effort, for the page of each thread
+_local = threading.local()
+
+
+def set_progress(progress: Optional[Progress]):
+    """
+    Set the progress the adaptive encoders of this process keep up with, called when a worker
+    starts. Encoders use their slowest effort if None.
+    """
+    global _progress
+    _progress = progress
+
+
+def controller(name: str, levels: Sequence[int]) -> EffortController:
+    key = (name, tuple(levels))
+    with _lock:
+        if key not in _controllers:
+            _controllers[key] = EffortController(levels)
+        return _controllers[key]
+
+
+@contextmanager
+def page(encoders: int) -> Iterator[None]:
+    """
+    Time the processing of a page by the image pipelines, whose adaptive encoders share the time
+    left to the page.
+
+    :param encoders: number of adaptive encoders the page may go through
+    """
+    global _overhead
+    _local.degraded = False
+    if _progress is None or encoders == 0:
+        yield
+        return
+    _local.spent, _local.encoders = 0.0, encoders
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        overhead = time.perf_counter() - start - _local.spent
+        _local.encoders = 0
+        with _lock:
+            _overhead += ALPHA * (overhead - _overhead)
+        _progress.processed()
+
+
+@contextmanager
+def adapt(name: str, levels: Sequence[int], pixels: int) -> Iterator[int]:
+    """
+    Choose the effort of an encoder for a page, and time its encoding at that effort.
+
+    :param name: name of the encoder and its setting, e.g. avif.speed
+    :param levels: efforts of the encoder, from slowest to fastest
+    :return: the effort to encode with
+    """
+    if _progress is None:
+        yield levels[0]
+        return
+    encoders = getattr(_local, 'encoders', 0)
+    budget = None
+    page_time = _progress.page_time()
+    if page_time is not None:
+        spent = _local.spent if encoders > 0 else 0.0
+        budget = (page_time - _overhead - spent) / max(encoders, 1)
+    effort = controller(name, levels)
+    level = effort.choose(pixels / 1e6, budget)
+    if level != levels[0]:
+        _local.degraded = True
+    start = time.perf_counter()
+    with metrics.stage(f'{STAGE}{name}.{level}'):
+        yield level
+    seconds = time.perf_counter() - start
+    effort.record(level, pixels / 1e6, seconds)
+    if encoders > 0:
+        _local.spent += seconds
+        _local.encoders = encoders - 1
+
+
+def degraded() -> bool:
+    """
+    :return: True if an encoder of the page of this thread used less than its slowest effort, so
+        that the page is not what its settings give without a deadline, e.g. to be cached
+    """
+    return getattr(_local, 'degraded', False)
+
+
+def usage(stats: Counter) -> Dict[str, Dict[int, int]]:
+    """
+    :return: name of each adaptive encoder -> effort -> pages encoded at that effort
+    """
+    result: Dict[str, Dict[int, int]] = {}
+    for name, totals in metrics.stages(stats).items():
+        if not name.startswith(STAGE): continue
+        encoder, level = name[len(STAGE):].rsplit('.', 1)
+        result.setdefault(encoder, {})[int(level)] = int(totals['calls'])
+    return result
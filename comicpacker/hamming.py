@@ -0,0 +1,80 @@
+import itertools
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+
+_POPCOUNT_8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    """
+    Number of set bits of each element of a uint64 array.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return _POPCOUNT_8[x.reshape(x.shape + (1, )).view(np.uint8)].sum(axis=-1)
+
+
+def near_pairs(values: np.ndarray, max_distance: int, block: int = 256):
+    """
+    Find all pairs of 64-bit values within max_distance bits, by multi-index hashing:
+    split the bits into max_distance + 1 chunks, two values within max_distance bits must agree
+    on at least one of them, so only values sharing a chunk are compared.
+
+    :return: iterator of index arrays (i, j) of the pairs found, a pair may be found repeatedly
+    """
+    num_chunks = min(max_distance + 1, 64)
+    bounds = np.linspace(0, 64, num_chunks + 1).astype(np.uint64)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        mask = np.uint64((1 << int(hi - lo)) - 1)
+        chunks = (values >> lo) & mask
+        order = np.argsort(chunks, kind='stable')
+        sorted_chunks = chunks[order]
+        starts = np.flatnonzero(np.r_[True, sorted_chunks[1:] != sorted_chunks[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            if end - start < 2: continue
+            members = order[start:end]
+            bucket = values[members]
+            for row in range(0, len(members), block):
+                distance = popcount(bucket[row:row + block, None] ^ bucket[None, :])
+                i, j = np.nonzero(distance <= max_distance)
+                keep = i + row < j
+                yield members[i[keep] + row], members[j[keep]]
+
+
+def group_hashes(hashes: Sequence[Optional[str]], max_distance: int) -> List[int]:
+    """
+    Group hex hash strings whose Hamming distance is within max_distance, transitively.
+
+    :return: group id of each hash, None hashes are each in a group of their own
+    """
+    unique = sorted(set(h for h in hashes if h is not None))
+    index = {h: i for i, h in enumerate(unique)}
+    parent = list(range(len(unique)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if max_distance > 0 and len(unique) > 1:
+        values = np.array([int(h, 16) for h in unique], dtype=np.uint64)
+        for i, j in near_pairs(values, max_distance):
+            for a, b in zip(i.tolist(), j.tolist()):
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parent[root_b] = root_a
+
+    group_ids: Dict[int, int] = {}
+    new_id = itertools.count()
+    groups = []
+    for h in hashes:
+        if h is None:
+            groups.append(next(new_id))
+            continue
+        root = find(index[h])
+        if root not in group_ids:
+            group_ids[root] = next(new_id)
+        groups.append(group_ids[root])
+    return groups
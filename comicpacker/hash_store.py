@@ -0,0 +1,64 @@
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class HashStore:
+    """
+    Persistent index of image hashes in a SQLite database.
+
+    A hash is valid as long as the size and modification time of its file are unchanged.
+    The database is opened lazily, so the store can be pickled to worker processes, each of
+    which opens its own connection, shared by the threads of the process.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conn'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            # workers write concurrently, WAL lets them read while another one writes
+            self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                              'path TEXT, method TEXT, size INTEGER, mtime INTEGER, hash TEXT, '
+                              'PRIMARY KEY (path, method))')
+        return self.conn
+
+    def get_many(self, method: str,
+                 files: Iterable[Tuple[str, int, int]]) -> Dict[str, str]:
+        """
+        :param files: (path, size, mtime_ns) of each file
+        :return: path -> hash of the files with a valid hash
+        """
+        found = {}
+        with self.lock:
+            conn = self.__connect()
+            for path, size, mtime in files:
+                row = conn.execute('SELECT size, mtime, hash FROM hashes WHERE path=? AND method=?',
+                                   (path, method)).fetchone()
+                if row is not None and row[0] == size and row[1] == mtime:
+                    found[path] = row[2]
+        return found
+
+    def put_many(self, method: str, rows: List[Tuple[str, int, int, str]]):
+        """
+        :param rows: (path, size, mtime_ns, hash) of each file
+        """
+        with self.lock:
+            conn = self.__connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                                 [(path, method, size, mtime, h)
+                                  for path, size, mtime, h in rows])
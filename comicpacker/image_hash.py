@@ -0,0 +1,149 @@
+import io
+import logging
+import numpy as np
+from abc import abstractmethod
+from typing import List, Optional, Sequence, Tuple
+from PIL import Image
+from . import metrics
+from .archive import read_page, split_member
+from .utils import enable_avif
+
+# Batched reimplementation of the hashing methods of imagededup
+# (https://github.com/idealo/imagededup), producing the same 16 hex digit hashes.
+
+
+class BaseHash:
+    # (width, height) of the grayscale thumbnail the hash is computed from
+    target_size: Tuple[int, int]
+
+    def __init__(self, verbose: bool = False) -> None:
+        # verbose is accepted for compatibility with imagededup
+        self.logger = logging.getLogger('main.Dedup')
+
+    def thumbnail(self, img: Image.Image) -> np.ndarray:
+        with metrics.stage('dedup_hash'):
+            if img.mode != 'RGB':
+                img = img.convert('RGBA').convert('RGB')
+            img = img.resize(self.target_size, Image.Resampling.LANCZOS)
+            return np.asarray(img.convert('L'), dtype=np.uint8)
+
+    def load_thumbnail(self, image_file) -> Optional[np.ndarray]:
+        """
+        :param image_file: path or bytes of the image, the path may be inside an archive
+        :return: thumbnail, None if the image cannot be read
+        """
+        try:
+            if isinstance(image_file, str):
+                if image_file.lower().endswith('.avif'):
+                    enable_avif()
+                if split_member(image_file) is not None:
+                    image_file = read_page(image_file)
+            if isinstance(image_file, bytes):
+                image_file = io.BytesIO(image_file)
+            return self.thumbnail(Image.open(image_file))
+        except Exception as e:
+            self.logger.warning(f'Invalid image file {image_file}: {e}')
+            return None
+
+    @abstractmethod
+    def hash_arrays(self, arrays: np.ndarray) -> np.ndarray:
+        """
+        :param arrays: [N, H, W] thumbnails
+        :return: [N, 64] bits
+        """
+        raise NotImplementedError
+
+    def encode_arrays(self, arrays: Sequence[Optional[np.ndarray]]) -> List[Optional[str]]:
+        """
+        Hash a batch of thumbnails at once.
+
+        :return: hex hash of each thumbnail, None for None thumbnails
+        """
+        valid = [i for i, array in enumerate(arrays) if array is not None]
+        hashes: List[Optional[str]] = [None] * len(arrays)
+        if len(valid) == 0:
+            return hashes
+        start = metrics.clock()
+        bits = self.hash_arrays(np.stack([arrays[i] for i in valid]).astype(np.float64))
+        # the thumbnails of the batch were counted as calls by thumbnail()
+        metrics.add_since('dedup_hash', start, calls=0)
+        for i, row in zip(valid, np.packbits(bits.reshape(len(valid), -1), axis=1)):
+            hashes[i] = row.tobytes().hex()
+        return hashes
+
+    def encode_image(self, image_file) -> Optional[str]:
+        return self.encode_arrays([self.load_thumbnail(image_file)])[0]
+
+    def hash_image(self, img: Image.Image) -> Optional[str]:
+        """
+        Hash an image that is already decoded.
+        """
+        try:
+            thumbnail = self.thumbnail(img)
+        except Exception as e:
+            self.logger.warning(f'Invalid image: {e}')
+            return None
+        return self.encode_arrays([thumbnail])[0]
+
+
+class PHash(BaseHash):
+    target_size = (32, 32)
+
+    def __init__(self, verbose: bool = False) -> None:
+        super().__init__(verbose)
+        # first 8 rows of the unnormalized DCT-II matrix, same as scipy.fftpack.dct
+        n = np.arange(32)
+        k = np.arange(8)[:, None]
+        self.dct = 2 * np.cos(np.pi * k * (2 * n + 1) / 64)
+
+    def hash_arrays(self, arrays):
+        coef = (self.dct @ arrays @ self.dct.T).reshape(len(arrays), -1)
+        # coefficients that are zero in exact arithmetic come out as rounding noise,
+        # snap them to zero so that flat images hash consistently
+        coef = np.round(coef, 6)
+        # median of coefficients excluding the DC term
+        median = np.median(coef[:, 1:], axis=1, keepdims=True)
+        return coef >= median
+
+
+class AHash(BaseHash):
+    target_size = (8, 8)
+
+    def hash_arrays(self, arrays):
+        return arrays >= arrays.mean(axis=(1, 2), keepdims=True)
+
+
+class DHash(BaseHash):
+    target_size = (9, 8)
+
+    def hash_arrays(self, arrays):
+        return arrays[:, :, 1:] > arrays[:, :, :-1]
+
+
+class WHash(BaseHash):
+    target_size = (256, 256)
+    # coefficient of the haar filters
+    haar = np.float64(0.7071067811865476)
+
+    def hash_arrays(self, arrays):
+        # LL coefficients of a 5 level haar decomposition, computed in the same order as
+        # pywt.wavedec2, as block sums rounded differently flip bits of near-median coefficients
+        ll = arrays / 255
+        for _ in range(5):
+            ll = ll[:, 0::2, :] * self.haar + ll[:, 1::2, :] * self.haar
+            ll = ll[:, :, 0::2] * self.haar + ll[:, :, 1::2] * self.haar
+        median = np.median(ll.reshape(len(arrays), -1), axis=1)
+        return ll >= median[:, None, None]
+
+
+def get_hasher(method: str) -> BaseHash:
+    if method == 'phash':
+        return PHash()
+    elif method == 'dhash':
+        return DHash()
+    elif method == 'whash':
+        return WHash()
+    elif method == 'ahash':
+        return AHash()
+    else:
+        raise ValueError(f'Invalid hash method {method}')
@@ -1,48 +1,178 @@
 import logging
 import io
-from typing import Optional
-import numpy as np
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, List, Optional, Sequence, Tuple
 import PIL
-from PIL import Image
-import pillow_avif
+from PIL import ExifTags, Image
 from abc import abstractmethod
-from .utils import get_jpg_quality
+from contextlib import nullcontext
+from . import effort, metrics
+from .utils import enable_avif, get_jpg_quality
 from PIL.JpegImagePlugin import get_sampling
 
+if TYPE_CHECKING:
+    import numpy as np
+
+
+@dataclass(eq=False)
+class TransformPlan:
+    # crop box in source image coordinates
+    box: Tuple[float, float, float, float]
+    # output size
+    size: Tuple[int, int]
+    # resampling filter, None if the box is never resized
+    resample: Optional[int] = None
+
+    @classmethod
+    def identity(cls, size: Tuple[int, int]):
+        return cls((0, 0, size[0], size[1]), size)
+
+    @property
+    def box_size(self):
+        return self.box[2] - self.box[0], self.box[3] - self.box[1]
+
+    def is_identity(self, size: Tuple[int, int]):
+        return self.box == (0, 0, size[0], size[1]) and self.size == size
+
+
+@dataclass(eq=False)
+class ImageProbe:
+    format: Optional[str]
+    size: Tuple[int, int]
+    mode: str
+    qtables: Optional[dict] = None
+    quality: Optional[int] = None
+    subsampling: Optional[int] = None
+    # EXIF orientation, 1 if upright
+    orientation: int = 1
+    has_icc_profile: bool = False
+
 
 class BaseTransformer:
+    # True if the transformer implements plan()
+    plannable = False
+    # True if plan() has to look at the pixels, i.e. cannot be planned from the size alone
+    needs_pixels = False
+
     @abstractmethod
     def __call__(self, img):
         # [H, W, C]
         raise NotImplementedError
 
+    def plan(self, img: Optional[Image.Image], plan: TransformPlan, scale: float) -> TransformPlan:
+        """
+        Fold this transform into plan instead of producing a new image.
+
+        :param img: decoded source image, reduced by scale if it was draft-decoded,
+            or None if only the geometry is known yet
+        :param plan: geometry of the preceding transforms, in source coordinates
+        :param scale: ratio of source size to img size
+        """
+        raise NotImplementedError
+
 
 class ThresholdCrop(BaseTransformer):
-    def __init__(self, lower_threshold: int, upper_threshold: int) -> None:
+    plannable = True
+
+    def __init__(self, lower_threshold: int, upper_threshold: int, coarse_step: int = 0) -> None:
+        """
+        :param coarse_step: if > 1, locate the content on every coarse_step-th pixel first,
+            then search the margins outside it exactly
+        """
         self.lower = lower_threshold
         self.upper = upper_threshold
+        self.coarse_step = coarse_step
+
+    @property
+    def needs_pixels(self):
+        return self.lower > 0 or self.upper < 255
 
     def __call__(self, img: Image.Image):
-        if img.mode == 'L':
-            gray_img = img
+        bbox = self.bbox(img)
+        if bbox is None: return img
+        return img.crop(bbox)
+
+    def plan(self, img, plan, scale):
+        if img is None: return plan
+        region = tuple(round(c / scale) for c in plan.box)
+        if region != (0, 0, img.width, img.height):
+            img = img.crop(region)  # type: ignore
+        bbox = self.bbox(img)
+        if bbox is None: return plan
+        box = (plan.box[0] + bbox[0] * scale, plan.box[1] + bbox[1] * scale,
+               plan.box[0] + bbox[2] * scale, plan.box[1] + bbox[3] * scale)
+        box_width, box_height = plan.box_size
+        size = (max(1, round((box[2] - box[0]) * plan.size[0] / box_width)),
+                max(1, round((box[3] - box[1]) * plan.size[1] / box_height)))
+        return TransformPlan(box, size, plan.resample)
+
+    def bbox(self, img: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+        """
+        :return: box of the content within threshold, None if the image should not be cropped
+        """
+        if not self.needs_pixels:
+            # every pixel is content, no need to look at them
+            return None
+        mat = self.luminance(img)
+        if self.coarse_step > 1 and min(img.height, img.width) >= self.coarse_step * 4:
+            bounds = self.coarse_bounds(mat)
         else:
-            gray_img = img.convert('L')
-        mat = np.array(gray_img)
-        in_threshold = (mat >= self.lower) & (mat <= self.upper)  # type: ignore
-        if not np.any(in_threshold): return img
-        for h0 in range(in_threshold.shape[0]):
-            if np.any(in_threshold[h0, :]): break
-        for w0 in range(in_threshold.shape[1]):
-            if np.any(in_threshold[:, w0]): break
-        for h1 in range(in_threshold.shape[0] - 1, -1, -1):
-            if np.any(in_threshold[h1, :]): break
-        for w1 in range(in_threshold.shape[1] - 1, -1, -1):
-            if np.any(in_threshold[:, w1]): break
-        if w0 == w1 or h0 == h1: return img  # type: ignore
-        return img.crop((w0, h0, w1, h1))  # type: ignore
+            bounds = self.bounds(self.in_threshold(mat))
+        if bounds is None: return None
+        h0, w0, h1, w1 = bounds
+        if w0 == w1 or h0 == h1: return None
+        if (w0, h0, w1 + 1, h1 + 1) == (0, 0, img.width, img.height): return None
+        return w0, h0, w1 + 1, h1 + 1
+
+    @staticmethod
+    def luminance(img: Image.Image) -> 'np.ndarray':
+        # imported here, as only cropping needs NumPy
+        import numpy as np
+        if img.mode == 'L':
+            return np.asarray(img)
+        elif img.mode in ['LA', 'La']:
+            return np.asarray(img.getchannel('L'))
+        elif img.mode == 'YCbCr':
+            return np.asarray(img.getchannel('Y'))
+        return np.asarray(img.convert('L'))
+
+    def in_threshold(self, mat: 'np.ndarray') -> 'np.ndarray':
+        return (mat >= self.lower) & (mat <= self.upper)
+
+    @staticmethod
+    def bounds(mask: 'np.ndarray') -> Optional[Tuple[int, int, int, int]]:
+        """
+        :return: first row, first column, last row and last column containing True
+        """
+        rows = mask.any(axis=1)
+        if not rows.any(): return None
+        cols = mask.any(axis=0)
+        h0 = int(rows.argmax())
+        h1 = len(rows) - 1 - int(rows[::-1].argmax())
+        w0 = int(cols.argmax())
+        w1 = len(cols) - 1 - int(cols[::-1].argmax())
+        return h0, w0, h1, w1
+
+    def coarse_bounds(self, mat: 'np.ndarray') -> Optional[Tuple[int, int, int, int]]:
+        step = self.coarse_step
+        coarse = self.bounds(self.in_threshold(mat[::step, ::step]))
+        if coarse is None:
+            # content may still hide between the samples
+            return self.bounds(self.in_threshold(mat))
+        h0, w0, h1, w1 = (c * step for c in coarse)
+        # rows h0, h1 and columns w0, w1 are known to contain content,
+        # so the exact bounds can only lie in the margins outside them
+        top = self.in_threshold(mat[:h0 + 1]).any(axis=1)
+        bottom = self.in_threshold(mat[h1:]).any(axis=1)
+        left = self.in_threshold(mat[:, :w0 + 1]).any(axis=0)
+        right = self.in_threshold(mat[:, w1:]).any(axis=0)
+        return (int(top.argmax()), int(left.argmax()), h1 + len(bottom) - 1 -
+                int(bottom[::-1].argmax()), w1 + len(right) - 1 - int(right[::-1].argmax()))
 
 
 class DownSample(BaseTransformer):
+    plannable = True
+
     def __init__(self, screen_height: int, screen_width: int, interpolation: str = 'cubic') -> None:
         self.height = screen_height
         self.width = screen_width
@@ -55,14 +185,27 @@ class DownSample(BaseTransformer):
         else: raise ValueError(f'Invalid interpolation {interpolation}')
 
     def __call__(self, img: Image.Image):
-        if img.height > self.height or img.width > self.width:
-            scaled_height = int(img.height * self.width / img.width)
-            scaled_width = int(img.width * self.height / img.height)
-            if scaled_height > self.height: shape = (scaled_width, self.height)
-            else: shape = (self.width, scaled_height)
+        shape = self.target_size(img.width, img.height)
+        if shape is not None:
             img = img.resize(shape, resample=self.interpolation)
         return img
 
+    def plan(self, img, plan, scale):
+        shape = self.target_size(*plan.size)
+        if shape is None: return plan
+        return TransformPlan(plan.box, shape, self.interpolation)
+
+    def target_size(self, width: int, height: int) -> Optional[Tuple[int, int]]:
+        """
+        :return: size to fit the screen, None if the image already fits
+        """
+        if height > self.height or width > self.width:
+            scaled_height = int(height * self.width / width)
+            scaled_width = int(width * self.height / height)
+            if scaled_height > self.height: return scaled_width, self.height
+            else: return self.width, scaled_height
+        return None
+
 
 class ImagePipeline:
     def __init__(
@@ -75,7 +218,13 @@ class ImagePipeline:
         webp_method: int = 4,
         webp_lossless: bool = False,
         png_compression: int = 1,
+        adaptive_effort: bool = False,
     ) -> None:
+        """
+        :param adaptive_effort: choose the AVIF speed and WebP method of each page to keep up
+            with the progress of the run, see effort, avif_speed and webp_method being the
+            slowest used
+        """
         self.transforms = []
         self.fixed_ext = None if fixed_ext == '' else fixed_ext
         self.jpeg_quality = jpeg_quality
@@ -85,14 +234,142 @@ class ImagePipeline:
         self.webp_method = webp_method
         self.webp_lossless = webp_lossless
         self.png_compression = png_compression
+        self.adaptive_effort = adaptive_effort
 
     def append(self, transform: BaseTransformer):
         self.transforms.append(transform)
 
-    def transform(self, img: Image.Image):
-        for transform in self.transforms:
+    @property
+    def plannable(self):
+        return all(transform.plannable for transform in self.transforms)
+
+    def plan(self, img: Optional[Image.Image], source_size: Tuple[int, int], scale: float = 1.0,
+             base: Optional[TransformPlan] = None, start: int = 0) -> TransformPlan:
+        """
+        :param base: plan of the first start transforms, already folded
+        """
+        plan = base if base is not None else TransformPlan.identity(source_size)
+        for transform in self.transforms[start:]:
+            if img is None:
+                plan = transform.plan(img, plan, scale)
+                continue
+            with metrics.stage('transform.' + type(transform).__name__):
+                plan = transform.plan(img, plan, scale)
+        return plan
+
+    def probe(self, data: bytes) -> ImageProbe:
+        """
+        Read the image header without decoding any pixels.
+        """
+        try:
+            img = Image.open(io.BytesIO(data))
+        except PIL.UnidentifiedImageError:
+            raise UserWarning('Invalid image')
+        except OSError:
+            raise UserWarning('Truncated image')
+        probe = ImageProbe(img.format, img.size, img.mode)
+        if img.format == 'JPEG':
             try:
-                img = transform(img)
+                probe.qtables = img.quantization  # type: ignore
+                probe.quality = get_jpg_quality(probe.qtables)  # type: ignore
+                probe.subsampling = get_sampling(img)
+            except AttributeError:
+                pass
+            probe.orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+            probe.has_icc_profile = img.info.get('icc_profile') is not None
+        return probe
+
+    def can_passthrough(self, probe: ImageProbe, ext: str) -> bool:
+        """
+        True if encoding would keep the format, color space and quality of the source,
+        so the source is good as it is as long as the transforms leave it unchanged.
+        Encoding drops the EXIF orientation and ICC profile, so a source with either is
+        encoded too, for it to look the same as the other pages.
+        """
+        if ext not in ['.jpg', '.jpeg'] or self.fixed_ext not in [None, '.jpg', '.jpeg']:
+            return False
+        if probe.format != 'JPEG' or probe.mode not in ['RGB', 'L']:
+            return False
+        if probe.quality is None or probe.quality == -1:
+            return False
+        if probe.orientation != 1 or probe.has_icc_profile:
+            return False
+        if self.jpeg_quality != -1 and probe.quality > self.jpeg_quality:
+            return False
+        return self.plannable
+
+    def draft_size(self, image_format: Optional[str],
+                   source_size: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+        """
+        :return: size requested from the JPEG decoder by decode(), None if decoded at full size
+        """
+        if image_format != 'JPEG' or not self.plannable:
+            return None
+        # content is unknown before decoding, so assume nothing will be cropped
+        size = self.plan(None, source_size).size
+        if size[0] * 2 <= source_size[0] and size[1] * 2 <= source_size[1]:
+            return size
+        return None
+
+    def decode(
+        self,
+        data: bytes,
+        draft_size: Optional[Callable[[Optional[str], Tuple[int, int]],
+                                      Optional[Tuple[int, int]]]] = None,
+    ) -> Tuple[Image.Image, Tuple[int, int], float]:
+        """
+        Decode the image, at 1/2, 1/4 or 1/8 scale if it is a JPEG that will be downsampled
+        at least that much anyway.
+
+        :param draft_size: size requested from the JPEG decoder, default self.draft_size
+        :return: image, size of the source image, ratio of source size to decoded size
+        """
+        if draft_size is None:
+            draft_size = self.draft_size
+        try:
+            with metrics.stage('decode', len(data)):
+                img = Image.open(io.BytesIO(data))
+                source_size = img.size
+                scale = 1.0
+                size = draft_size(img.format, source_size)
+                if size is not None:
+                    draft = img.draft(img.mode, size)
+                    if draft is not None:
+                        scale = source_size[0] / draft[1][2]
+                img.load()
+        except PIL.UnidentifiedImageError:
+            raise UserWarning('Invalid image')
+        except OSError:
+            raise UserWarning('Truncated image')
+        return img, source_size, scale
+
+    def apply(self, img: Image.Image, source_size: Tuple[int, int], scale: float = 1.0,
+              plan: Optional[TransformPlan] = None) -> Optional[Image.Image]:
+        """
+        Run all transforms as one crop and at most one resize.
+
+        :param plan: plan of the transforms, planned from img if None
+        :return: transformed image, None if img was draft-decoded at too low a resolution
+        """
+        if plan is None:
+            plan = self.plan(img, source_size, scale)
+        box = tuple(c / scale for c in plan.box)
+        box_width, box_height = box[2] - box[0], box[3] - box[1]
+        if plan.size != (round(box_width), round(box_height)) or scale != 1:
+            if box_width < plan.size[0] or box_height < plan.size[1]: return None
+            resample = plan.resample if plan.resample is not None else Image.Resampling.BICUBIC
+            with metrics.stage('resample'):
+                return img.resize(plan.size, resample=resample, box=box)  # type: ignore
+        if box != (0, 0, img.width, img.height):
+            with metrics.stage('resample'):
+                return img.crop(tuple(round(c) for c in box))  # type: ignore
+        return img
+
+    def transform(self, img: Image.Image, start: int = 0):
+        for transform in self.transforms[start:]:
+            try:
+                with metrics.stage('transform.' + type(transform).__name__):
+                    img = transform(img)
             except UserWarning as e:
                 raise UserWarning(e)
         return img
@@ -131,41 +408,92 @@ class ImagePipeline:
         img.save(new_data, 'JPEG', quality=quality, optimize=True, subsampling=0)
         return new_data.getvalue(), '.jpg'
 
+    def __effort(self, name: str, levels: Sequence[int], img: Image.Image):
+        """
+        :param levels: efforts of the encoder, from slowest to fastest
+        :return: context giving the effort to encode img with, see effort.adapt
+        """
+        if not self.adaptive_effort:
+            return nullcontext(levels[0])
+        return effort.adapt(name, levels, img.width * img.height)
+
     def save_avif(self, img: Image.Image):
+        enable_avif()
         new_data = io.BytesIO()
-        img.save(new_data, 'AVIF', quality=self.avif_quality, speed=self.avif_speed)
+        # speed 10 is the fastest
+        with self.__effort('avif.speed', range(self.avif_speed, max(self.avif_speed, 10) + 1),
+                         img) as speed:
+            img.save(new_data, 'AVIF', quality=self.avif_quality, speed=speed)
         return new_data.getvalue(), '.avif'
 
     def save_webp(self, img: Image.Image):
         new_data = io.BytesIO()
-        img.save(new_data, 'WEBP', quality=self.webp_quality, method=self.webp_method,
-                 lossless=self.webp_lossless)
+        # method 0 is the fastest
+        with self.__effort('webp.method', range(self.webp_method, min(self.webp_method, 0) - 1, -1),
+                         img) as method:
+            img.save(new_data, 'WEBP', quality=self.webp_quality, method=method,
+                     lossless=self.webp_lossless)
         return new_data.getvalue(), '.webp'
 
+    def decode_and_transform(self, data: bytes,
+                             inspect: Optional[Callable[[Image.Image], None]] = None):
+        """
+        :param inspect: called with the image as returned by decode()
+        """
+        if not self.plannable:
+            img, _, _ = self.decode(data)
+            if inspect is not None: inspect(img)
+            return img, self.transform(img)
+        img, source_size, scale = self.decode(data)
+        if inspect is not None: inspect(img)
+        transformed = self.apply(img, source_size, scale)
+        if transformed is None:
+            # cropped too much for the draft resolution, decode again at full size
+            with metrics.stage('decode', len(data)):
+                img = Image.open(io.BytesIO(data))
+                img.load()
+            transformed = self.apply(img, source_size)
+        return img, transformed
+
     def __call__(self, data: bytes, ext: str):
-        try:
-            img = Image.open(io.BytesIO(data))
-            _ = img.getdata()
-        except PIL.UnidentifiedImageError:
-            raise UserWarning('Invalid image')
-        except OSError:
-            raise UserWarning('Truncated image')
+        data, ext, _ = self.process(data, ext)
+        return data, ext
+
+    def process(self, data: bytes, ext: str,
+                inspect: Optional[Callable[[Image.Image], None]] = None) -> Tuple[bytes, str, bool]:
+        """
+        :param inspect: called with the decoded source image, if the image has to be decoded
+        :return: image data, extension, and True if the source data is returned as it is
+        """
         ext = ext.lower()
+        probe = self.probe(data)
+        # a JPEG without EOI marker is truncated, leave it to the decoder to complain
+        if self.can_passthrough(probe, ext) and data.rstrip(b'\0').endswith(b'\xff\xd9'):
+            if not any(transform.needs_pixels for transform in self.transforms):
+                if self.plan(None, probe.size).is_identity(probe.size):
+                    return data, ext, True
+            else:
+                source, img = self.decode_and_transform(data, inspect)
+                if img is source:
+                    return data, ext, True
+                return (*self.encode(probe, img, ext), False)
+        source, img = self.decode_and_transform(data, inspect)
+        return (*self.encode(probe, img, ext), False)
+
+    def encode(self, probe: ImageProbe, img: Image.Image, ext: str) -> Tuple[bytes, str]:
+        with metrics.stage('encode') as span:
+            data, ext = self.__encode(probe, img, ext)
+            span.bytes_out = len(data)
+        return data, ext
+
+    def __encode(self, probe: ImageProbe, img: Image.Image, ext: str):
         try:
             if ext in ['.jpg', '.jpeg'] and self.fixed_ext in [None, '.jpg', '.jpeg']:
-                try:
-                    qtables = img.quantization  # type: ignore
-                    quality = get_jpg_quality(qtables)
-                    subsampling = get_sampling(img)
-                except AttributeError:
-                    qtables, quality, subsampling = None, None, None
-                img = self.transform(img)
                 img = self.convert(img)
-                return self.save_jpeg(img, quality, qtables, subsampling)
+                return self.save_jpeg(img, probe.quality, probe.qtables, probe.subsampling)
             else:
                 if self.fixed_ext is not None:
                     ext = self.fixed_ext
-                img = self.transform(img)
                 if ext in ['.jpg', '.jpeg']:
                     img = self.convert(img)
                     return self.save_jpeg_fixed(img)
@@ -179,3 +507,99 @@ class ImagePipeline:
                     raise NotImplementedError(f'Unsupported format {ext}')
         except UserWarning as e:
             raise UserWarning(e)
+
+
+class MultiPipeline:
+    """
+    Process each page for several output targets at once: the page is decoded and its shared
+    leading transforms, e.g. crop, are run once, then the transforms and encoding of each
+    target are run on the result.
+    """
+    def __init__(self, pipelines: Sequence[ImagePipeline], shared: int) -> None:
+        """
+        :param pipelines: pipelines of the targets, with distinct settings
+        :param shared: number of leading transforms that are the same objects in all pipelines
+        """
+        self.pipelines = list(pipelines)
+        self.shared = ImagePipeline()
+        self.shared.transforms = self.pipelines[0].transforms[:shared]
+        self.num_shared = shared
+
+    def probe(self, data: bytes) -> ImageProbe:
+        return self.shared.probe(data)
+
+    def draft_size(self, image_format: Optional[str],
+                   source_size: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+        """
+        :return: smallest size every pipeline can be run from, None if decoded at full size
+        """
+        sizes = [pipeline.draft_size(image_format, source_size) for pipeline in self.pipelines]
+        if any(size is None for size in sizes): return None
+        return max(size[0] for size in sizes), max(size[1] for size in sizes)  # type: ignore
+
+    def decode(self, data: bytes) -> Tuple[Image.Image, Tuple[int, int], float]:
+        return self.shared.decode(data, self.draft_size)
+
+    def process(self, data: bytes, ext: str,
+                inspect: Optional[Callable[[Image.Image], None]] = None,
+                indices: Optional[Sequence[int]] = None) -> List[Tuple[bytes, str, bool]]:
+        """
+        Same as ImagePipeline.process for each pipeline.
+
+        :param indices: indices of the pipelines to run, all if None
+        :return: result of each pipeline in indices
+        """
+        ext = ext.lower()
+        if indices is None:
+            indices = range(len(self.pipelines))
+        probe = self.probe(data)
+        # a JPEG without EOI marker is truncated, leave it to the decoder to complain
+        complete = data.rstrip(b'\0').endswith(b'\xff\xd9')
+        results = {}
+        pending = []
+        for i in indices:
+            pipeline = self.pipelines[i]
+            passthrough = pipeline.can_passthrough(probe, ext) and complete
+            needs_pixels = any(transform.needs_pixels for transform in pipeline.transforms)
+            if passthrough and not needs_pixels \
+                    and pipeline.plan(None, probe.size).is_identity(probe.size):
+                results[i] = (data, ext, True)
+            else:
+                pending.append((i, passthrough))
+        if len(pending) == 0:
+            return [results[i] for i in indices]
+
+        img, source_size, scale = self.decode(data)
+        if inspect is not None: inspect(img)
+        # shared transforms of img, and of the source decoded again at full size if the draft
+        # resolution is too low for some target
+        shared_img: Optional[Image.Image] = None
+        shared_plan: Optional[TransformPlan] = None
+        full: Optional[Image.Image] = None
+        full_plan: Optional[TransformPlan] = None
+        for i, passthrough in pending:
+            pipeline = self.pipelines[i]
+            source = img
+            if not pipeline.plannable:
+                if shared_img is None:
+                    shared_img = self.shared.transform(img)
+                transformed = pipeline.transform(shared_img, self.num_shared)
+            else:
+                if shared_plan is None:
+                    shared_plan = self.shared.plan(img, source_size, scale)
+                plan = pipeline.plan(img, source_size, scale, shared_plan, self.num_shared)
+                transformed = pipeline.apply(img, source_size, scale, plan)
+                if transformed is None:
+                    if full is None:
+                        with metrics.stage('decode', len(data)):
+                            full = Image.open(io.BytesIO(data))
+                            full.load()
+                        full_plan = self.shared.plan(full, source_size)
+                    source = full
+                    plan = pipeline.plan(full, source_size, 1.0, full_plan, self.num_shared)
+                    transformed = pipeline.apply(full, source_size, 1.0, plan)
+            if passthrough and transformed is source:
+                results[i] = (data, ext, True)
+            else:
+                results[i] = (*pipeline.encode(probe, transformed, ext), False)  # type: ignore
+        return [results[i] for i in indices]
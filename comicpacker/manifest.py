@@ -0,0 +1,162 @@
+import os
+import json
+import pickle
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .comic import Comic
+from .parser import SourceReader
+
+
+class Manifest:
+    """
+    Persistent manifest of the source library in a SQLite database.
+
+    Stores the parsed comics and the stats of their pages, together with the directories and
+    metadata files each of them was parsed from, as well as the listing of every directory and
+    the content of every metadata file read. A comic whose directories and metadata files are
+    unchanged is returned without parsing, a changed one is parsed again, reading only the
+    directories and files that changed. Directories are compared by mtime, metadata files by
+    size and mtime, then by content hash. Pages modified in place, without their directory
+    changing, are not noticed until the comic is parsed again.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conn'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS comics ('
+                              'path TEXT PRIMARY KEY, parser TEXT, deps TEXT, comic BLOB, '
+                              'sizes BLOB)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                              'path TEXT PRIMARY KEY, mtime INTEGER, listing TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                              'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT, '
+                              'content BLOB)')
+        return self.conn
+
+    def execute(self, sql: str, args: tuple = ()) -> List[tuple]:
+        with self.lock:
+            conn = self.__connect()
+            with conn:
+                return conn.execute(sql, args).fetchall()
+
+    def get_comic(self, path: str,
+                  parser: str) -> Optional[Tuple[Comic, Dict[str, Tuple[int, int]]]]:
+        """
+        :param parser: name of the parsers the comic is parsed with
+        :return: comic and page stats of the last parse, None if anything it depends on changed
+        """
+        rows = self.execute('SELECT parser, deps, comic, sizes FROM comics WHERE path=?', (path, ))
+        if len(rows) == 0 or rows[0][0] != parser: return None
+        for dep_path, size, mtime in json.loads(rows[0][1]):
+            try:
+                stat = os.stat(dep_path)
+            except OSError:
+                return None
+            if stat.st_mtime_ns != mtime or (size != -1 and stat.st_size != size):
+                return None
+        return pickle.loads(rows[0][2]), pickle.loads(rows[0][3])
+
+    def put_comic(self, path: str, parser: str, reader: 'ManifestReader', comic: Comic,
+                  page_stats: Dict[str, Tuple[int, int]]):
+        """
+        Store a parsed comic, with the directories and files read by reader, in one transaction.
+        """
+        with self.lock:
+            conn = self.__connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', reader.new_dirs)
+                conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                 reader.new_files)
+                conn.execute('INSERT OR REPLACE INTO comics VALUES (?, ?, ?, ?, ?)',
+                             (path, parser, json.dumps(reader.deps), pickle.dumps(comic),
+                              pickle.dumps(page_stats)))
+
+    def prune(self, paths: Iterable[str]):
+        """
+        Remove comics that are no longer in the library, with their directories and files.
+
+        :param paths: paths of the comics in the library
+        """
+        existing = set(paths)
+        for (path, ) in self.execute('SELECT path FROM comics'):
+            if path in existing: continue
+            prefix = os.path.join(path, '')
+            for table in ('comics', 'dirs', 'files'):
+                self.execute(
+                    f'DELETE FROM {table} WHERE path=? OR substr(path, 1, length(?))=?',
+                    (path, prefix, prefix))
+
+    def reader(self) -> 'ManifestReader':
+        return ManifestReader(self)
+
+
+class ManifestReader(SourceReader):
+    """
+    SourceReader that reads unchanged directories and metadata files from the manifest, and
+    records everything it reads as dependencies of the comic being parsed.
+    """
+    def __init__(self, manifest: Manifest) -> None:
+        self.manifest = manifest
+        # (path, size or -1 for directories, mtime_ns)
+        self.deps: List[Tuple[str, int, int]] = []
+        # rows read from disk, written by Manifest.put_comic
+        self.new_dirs: List[tuple] = []
+        self.new_files: List[tuple] = []
+
+    def scan_dir(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        self.deps.append((path, -1, mtime))
+        rows = self.manifest.execute('SELECT mtime, listing FROM dirs WHERE path=?', (path, ))
+        if len(rows) > 0 and rows[0][0] == mtime:
+            return json.loads(rows[0][1])
+        listing = super().scan_dir(path)
+        self.new_dirs.append((path, mtime, json.dumps(listing)))
+        return listing
+
+    def list_archive(self, path):
+        # the listing is read from the archive again, only its stat is recorded
+        stat = os.stat(path)
+        self.deps.append((path, stat.st_size, stat.st_mtime_ns))
+        return super().list_archive(path)
+
+    def load(self, path: str, load) -> Any:
+        stat = os.stat(path)
+        self.deps.append((path, stat.st_size, stat.st_mtime_ns))
+        rows = self.manifest.execute('SELECT size, mtime, digest, content FROM files WHERE path=?',
+                                     (path, ))
+        if len(rows) > 0 and rows[0][:2] == (stat.st_size, stat.st_mtime_ns):
+            return pickle.loads(rows[0][3])
+        with open(path, 'rb') as f:
+            digest = hashlib.blake2b(f.read(), digest_size=20).hexdigest()
+        if len(rows) > 0 and rows[0][2] == digest:
+            # touched but not modified
+            content = pickle.loads(rows[0][3])
+        else:
+            content = load(path)
+        self.new_files.append(
+            (path, stat.st_size, stat.st_mtime_ns, digest, pickle.dumps(content)))
+        return content
+
+    def load_json(self, path):
+        return self.load(path, super().load_json)
+
+    def load_toml(self, path):
+        return self.load(path, super().load_toml)
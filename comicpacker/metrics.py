@@ -0,0 +1,122 @@
+import time
+import functools
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+# Time spent in each stage of packing by the current process. Tasks run one at a time in each
+# worker process, a task decorated with task() returns the totals of its stages in its stats
+# Counter, under 'stage:<name>:<field>' keys, and the parent aggregates them with the stats.
+
+FIELDS = ('calls', 'wall', 'cpu', 'bytes_in', 'bytes_out')
+
+_totals: Counter = Counter()
+_lock = threading.Lock()
+
+
+class Span:
+    """
+    Bytes going in and out of a stage, to be set by the code being timed.
+    """
+    __slots__ = ('bytes_in', 'bytes_out')
+
+    def __init__(self, bytes_in: int = 0) -> None:
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+
+
+def clock() -> Tuple[float, float]:
+    """
+    :return: wall time and CPU time of the calling thread
+    """
+    return time.perf_counter(), time.thread_time()
+
+
+def add(name: str, wall: float, cpu: float, bytes_in: int = 0, bytes_out: int = 0,
+        calls: int = 1):
+    with _lock:
+        _totals[f'stage:{name}:calls'] += calls
+        _totals[f'stage:{name}:wall'] += wall
+        _totals[f'stage:{name}:cpu'] += cpu
+        _totals[f'stage:{name}:bytes_in'] += bytes_in
+        _totals[f'stage:{name}:bytes_out'] += bytes_out
+
+
+def add_since(name: str, start: Tuple[float, float], bytes_in: int = 0, bytes_out: int = 0,
+              calls: int = 1):
+    """
+    :param start: clock() at the start of the stage
+    """
+    wall, cpu = clock()
+    add(name, wall - start[0], cpu - start[1], bytes_in, bytes_out, calls)
+
+
+@contextmanager
+def stage(name: str, bytes_in: int = 0) -> Iterator[Span]:
+    """
+    Time the code in the with block as a call of stage name, on the calling thread.
+    """
+    span = Span(bytes_in)
+    start = clock()
+    try:
+        yield span
+    finally:
+        add_since(name, start, span.bytes_in, span.bytes_out)
+
+
+def timed(name: str):
+    """
+    Decorate a function to time each call as a call of stage name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def collect() -> Counter:
+    """
+    Take the totals accumulated since the last call.
+    """
+    with _lock:
+        totals = _totals.copy()
+        _totals.clear()
+    return totals
+
+
+def task(func):
+    """
+    Decorate a task run by the Scheduler, whose result is, or ends with, its stats Counter.
+    The stages run by the task, and its wall and CPU time, are added to the stats.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # drop whatever the process did before, e.g. inherited from the parent on fork
+        collect()
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func(*args, **kwargs)
+        stats = result[-1] if isinstance(result, tuple) else result
+        stats['wall_time'] += time.perf_counter() - wall
+        stats['cpu_time'] += time.process_time() - cpu
+        stats.update(collect())
+        return result
+
+    return wrapper
+
+
+def stages(stats: Counter) -> Dict[str, Dict[str, float]]:
+    """
+    :return: stage name -> field -> total, from the 'stage:' keys of stats
+    """
+    result: Dict[str, Dict[str, float]] = {}
+    for key, value in stats.items():
+        if not key.startswith('stage:'): continue
+        _, name, field = key.rsplit(':', 2)
+        result.setdefault(name, dict.fromkeys(FIELDS, 0))[field] = value
+    return dict(sorted(result.items()))
@@ -5,67 +5,117 @@ import toml
 import natsort
 from abc import ABC, abstractmethod
 from .const import IMAGE_EXT
+from .archive import is_archive, list_members, member_path
 from .comic import Page, Chapter, Comic
 import logging
+from typing import Any, Dict, List, Optional
+
+
+class SourceReader:
+    """
+    Reads the directories and metadata files of the source library for the parsers.
+    """
+    def scan_dir(self, path: str) -> Dict[str, bool]:
+        """
+        List a directory in one pass.
+
+        :return: name -> whether it is a directory, of each entry
+        """
+        with os.scandir(path) as it:
+            return {entry.name: entry.is_dir() for entry in it}
+
+    def load_json(self, path: str) -> Any:
+        with open(path, 'r') as f:
+            return json.loads(f.read())
+
+    def load_toml(self, path: str) -> Any:
+        return toml.load(path)
+
+    def list_archive(self, path: str) -> List[str]:
+        """
+        :return: names of the files in a zip/cbz archive
+        """
+        return list_members(path)
+
+    def scan_pages(self, chapter_path: str) -> List[Page]:
+        """
+        :return: pages of a chapter folder, in natural order of their file names
+        """
+        page_files = [
+            name for name in self.scan_dir(chapter_path) if os.path.splitext(name)[1] in IMAGE_EXT]
+        pages = []
+        for page_index, page_file in enumerate(natsort.os_sorted(page_files)):
+            page_title = os.path.splitext(page_file)[0]
+            pages.append(Page(page_index + 1, page_title, os.path.join(chapter_path, page_file)))
+        return pages
+
+
+def find_cover(path: str, listing: Dict[str, bool]) -> Optional[str]:
+    for ext in IMAGE_EXT:
+        if 'cover' + ext in listing:
+            return os.path.join(path, 'cover' + ext)
+    return None
+
+
+def sorted_dirs(listing: Dict[str, bool]) -> List[str]:
+    return natsort.os_sorted(name for name, is_dir in listing.items() if is_dir)
+
+
+def archive_pages(archive: str, members: List[str]) -> List[Page]:
+    """
+    :param members: names of members of archive
+    :return: pages of the images among members, in natural order of their names
+    """
+    names = [name for name in members if os.path.splitext(name)[1] in IMAGE_EXT]
+    pages = []
+    for page_index, name in enumerate(natsort.os_sorted(names)):
+        page_title = os.path.splitext(name.rsplit('/', 1)[-1])[0]
+        pages.append(Page(page_index + 1, page_title, member_path(archive, name)))
+    return pages
 
 
 class BaseParser:
     @classmethod
     @abstractmethod
-    def parse(cls, path: str) -> Comic:
+    def parse(cls, path: str, reader: Optional[SourceReader] = None) -> Comic:
+        """
+        :param reader: reads the source folder, a plain SourceReader if None
+        """
         raise NotImplementedError
 
 
 class GeneralParser(BaseParser):
     @classmethod
-    def parse(cls, path):
+    def parse(cls, path, reader=None):
+        reader = reader or SourceReader()
         comic_title = os.path.basename(path)
-        cover_path = None
-        for ext in IMAGE_EXT:
-            if os.path.exists(os.path.join(path, 'cover' + ext)):
-                cover_path = os.path.join(path, 'cover' + ext)
-                break
-        comic = Comic(comic_title, [], cover_path=cover_path)
-        chapter_index = 1
-        for chapter_title in natsort.os_sorted(os.listdir(path)):
+        listing = reader.scan_dir(path)
+        comic = Comic(comic_title, [], cover_path=find_cover(path, listing))
+        for chapter_index, chapter_title in enumerate(sorted_dirs(listing)):
             chapter_path = os.path.join(path, chapter_title)
-            if not os.path.isdir(chapter_path): continue
-            chapter = Chapter(chapter_index, chapter_title, [])
-            page_index = 1
-            for page_file in natsort.os_sorted(os.listdir(chapter_path)):
-                page_path = os.path.join(chapter_path, page_file)
-                page_title, ext = os.path.splitext(page_file)
-                if ext not in IMAGE_EXT: continue
-                page = Page(page_index, page_title, page_path)
-                chapter.pages.append(page)
-                page_index += 1
-            comic.chapters.append(chapter)
-            chapter_index += 1
+            comic.chapters.append(Chapter(chapter_index + 1, chapter_title,
+                                          reader.scan_pages(chapter_path)))
         return comic
 
 
 class TachiyomiParser(BaseParser):
     @classmethod
-    def parse(cls, path):
-        cover_path = None
-        for ext in IMAGE_EXT:
-            if os.path.exists(os.path.join(path, 'cover' + ext)):
-                cover_path = os.path.join(path, 'cover' + ext)
-                break
+    def parse(cls, path, reader=None):
+        reader = reader or SourceReader()
+        listing = reader.scan_dir(path)
+        cover_path = find_cover(path, listing)
         comic_title = ''
         authors = None
         subjects = None
         description = None
         flag = False
-        for file in os.listdir(path):
+        for file in listing:
             if os.path.splitext(file)[1] != '.json': continue
-            with open(os.path.join(path, file), 'r') as f:
-                js = f.read()
-                meta = json.loads(js)
-                if 'title' in meta: comic_title = meta['title']
-                if 'author' in meta: authors = re.split(r',|;', meta['author'])
-                if 'description' in meta: description = meta['description']
-                if 'genre' in meta: subjects = set(meta['genre'])
+            meta = reader.load_json(os.path.join(path, file))
+            if 'title' in meta: comic_title = meta['title']
+            if 'author' in meta: authors = re.split(r',|;', meta['author'])
+            if 'description' in meta: description = meta['description']
+            if 'genre' in meta: subjects = set(meta['genre'])
             flag = True
             break
         if not flag:
@@ -79,45 +129,30 @@ class TachiyomiParser(BaseParser):
             description=description,
             cover_path=cover_path,
         )
-        chapter_index = 1
-        for chapter_title in natsort.os_sorted(os.listdir(path)):
+        for chapter_index, chapter_title in enumerate(sorted_dirs(listing)):
             chapter_path = os.path.join(path, chapter_title)
-            if not os.path.isdir(chapter_path): continue
-            chapter = Chapter(chapter_index, chapter_title, [])
-            page_index = 1
-            for page_file in natsort.os_sorted(os.listdir(chapter_path)):
-                page_path = os.path.join(chapter_path, page_file)
-                page_title, ext = os.path.splitext(page_file)
-                if ext not in IMAGE_EXT: continue
-                page = Page(page_index, page_title, page_path)
-                chapter.pages.append(page)
-                page_index += 1
-            comic.chapters.append(chapter)
-            chapter_index += 1
+            comic.chapters.append(Chapter(chapter_index + 1, chapter_title,
+                                          reader.scan_pages(chapter_path)))
         return comic
 
 
 class DmzjBackupParser(BaseParser):
     @classmethod
-    def parse(cls, path):
-        cover_path = None
-        for ext in IMAGE_EXT:
-            if os.path.exists(os.path.join(path, 'cover' + ext)):
-                cover_path = os.path.join(path, 'cover' + ext)
-                break
-        if not os.path.exists(os.path.join(path, 'details.json')):
+    def parse(cls, path, reader=None):
+        reader = reader or SourceReader()
+        listing = reader.scan_dir(path)
+        cover_path = find_cover(path, listing)
+        if 'details.json' not in listing:
             raise UserWarning(f'missing details.json in {path}, please use GeneralParser instead')
-        with open(os.path.join(path, 'details.json'), 'r') as f:
-            js = f.read()
-            meta = json.loads(js)
-            comic_title = meta['title']
-            authors = re.split(r',|;', re.sub(r'\s', '', meta['author']))
-            description = meta['description']
-            subjects = set(meta['genre'])
-        if 'info.toml' not in os.listdir(path):
+        meta = reader.load_json(os.path.join(path, 'details.json'))
+        comic_title = meta['title']
+        authors = re.split(r',|;', re.sub(r'\s', '', meta['author']))
+        description = meta['description']
+        subjects = set(meta['genre'])
+        if 'info.toml' not in listing:
             raise UserWarning(
                 f'missing info.toml in {comic_title}, please use TachiyomiParser instead')
-        meta = toml.load(os.path.join(path, 'info.toml'))
+        meta = reader.load_toml(os.path.join(path, 'info.toml'))
         chapter_list = meta['chapter_list']
         comic = Comic(
             comic_title,
@@ -129,46 +164,33 @@ class DmzjBackupParser(BaseParser):
         )
         chapter_index = 1
         for chapter_title in chapter_list:
-            chapter_path = os.path.join(path, chapter_title)
-            if not os.path.isdir(chapter_path):
+            if not listing.get(chapter_title, False):
                 logging.getLogger('main.Parser').warning(
                     f'missing chapter {chapter_title} in {comic_title}')
                 continue
-            chapter = Chapter(chapter_index, chapter_title, [])
-            page_index = 1
-            for page_file in natsort.os_sorted(os.listdir(chapter_path)):
-                page_path = os.path.join(chapter_path, page_file)
-                page_title, ext = os.path.splitext(page_file)
-                if ext not in IMAGE_EXT: continue
-                page = Page(page_index, page_title, page_path)
-                chapter.pages.append(page)
-                page_index += 1
-            comic.chapters.append(chapter)
+            chapter_path = os.path.join(path, chapter_title)
+            comic.chapters.append(Chapter(chapter_index, chapter_title, reader.scan_pages(chapter_path)))
             chapter_index += 1
         return comic
 
 
 class ZMHBackupParser(BaseParser):
     @classmethod
-    def parse(cls, path):
-        cover_path = None
-        for ext in IMAGE_EXT:
-            if os.path.exists(os.path.join(path, 'cover' + ext)):
-                cover_path = os.path.join(path, 'cover' + ext)
-                break
-        if not os.path.exists(os.path.join(path, 'details.json')):
+    def parse(cls, path, reader=None):
+        reader = reader or SourceReader()
+        listing = reader.scan_dir(path)
+        cover_path = find_cover(path, listing)
+        if 'details.json' not in listing:
             raise UserWarning(f'missing details.json in {path}, please use GeneralParser instead')
-        with open(os.path.join(path, 'details.json'), 'r') as f:
-            js = f.read()
-            meta = json.loads(js)
-            comic_title = meta['title']
-            authors = re.split(r',|;', re.sub(r'\s', '', meta['author']))
-            description = meta['description']
-            subjects = set(meta['genre'])
-        if 'info.toml' not in os.listdir(path):
+        meta = reader.load_json(os.path.join(path, 'details.json'))
+        comic_title = meta['title']
+        authors = re.split(r',|;', re.sub(r'\s', '', meta['author']))
+        description = meta['description']
+        subjects = set(meta['genre'])
+        if 'info.toml' not in listing:
             raise UserWarning(
                 f'missing info.toml in {comic_title}, please use TachiyomiParser instead')
-        meta = toml.load(os.path.join(path, 'info.toml'))
+        meta = reader.load_toml(os.path.join(path, 'info.toml'))
         if 'chapter_id_list' not in meta:
             raise UserWarning(
                 f'missing chapter_id_list in info.toml of {comic_title}, please use DmzjBackupParser instead'
@@ -185,16 +207,17 @@ class ZMHBackupParser(BaseParser):
         chapter_index = 1
         # build chapter_id -> chapter_title mapping
         chapter_id_to_title = {}
-        for chapter_title in os.listdir(path):
+        chapter_listings = {}
+        for chapter_title in sorted_dirs(listing):
             chapter_path = os.path.join(path, chapter_title)
-            if not os.path.isdir(chapter_path): continue
-            meta_path = os.path.join(chapter_path, 'info.toml')
-            if not os.path.exists(meta_path):
+            chapter_listing = reader.scan_dir(chapter_path)
+            if 'info.toml' not in chapter_listing:
                 logging.getLogger('main.Parser').warning(
                     f'missing info.toml in chapter {chapter_title} of {comic_title}, skipping')
                 continue
-            chapter_meta = toml.load(meta_path)
+            chapter_meta = reader.load_toml(os.path.join(chapter_path, 'info.toml'))
             chapter_id_to_title[chapter_meta['chapter_id']] = chapter_title
+            chapter_listings[chapter_title] = (chapter_listing, chapter_meta)
         for chapter_id in chapter_id_list:
             if chapter_id not in chapter_id_to_title:
                 logging.getLogger('main.Parser').warning(
@@ -202,14 +225,18 @@ class ZMHBackupParser(BaseParser):
                 continue
             chapter_title = chapter_id_to_title[chapter_id]
             chapter_path = os.path.join(path, chapter_title)
-            meta_path = os.path.join(chapter_path, 'info.toml')
-            chapter_meta = toml.load(meta_path)
+            chapter_listing, chapter_meta = chapter_listings[chapter_title]
             page_list = chapter_meta['img_list']
             chapter = Chapter(chapter_index, chapter_title, [])
             page_index = 1
             for page_file in page_list:
                 page_path = os.path.join(chapter_path, page_file)
-                if not os.path.exists(page_path):
+                if '/' in page_file or os.sep in page_file:
+                    # in a subfolder, which the listing of the chapter does not cover
+                    exists = os.path.isfile(page_path)
+                else:
+                    exists = page_file in chapter_listing and not chapter_listing[page_file]
+                if not exists:
                     logging.getLogger('main.Parser').warning(
                         f'missing page {page_file} in chapter {chapter_title} of {comic_title}')
                     continue
@@ -225,24 +252,21 @@ class ZMHBackupParser(BaseParser):
 
 class BcdownParser(BaseParser):
     @classmethod
-    def parse(cls, path):
-        if not os.path.exists(os.path.join(path, 'meta.toml')):
+    def parse(cls, path, reader=None):
+        reader = reader or SourceReader()
+        listing = reader.scan_dir(path)
+        if 'meta.toml' not in listing:
             raise UserWarning(f'missing meta.toml in {path}, please use GeneralParser instead')
-        comic_meta = toml.load(os.path.join(path, 'meta.toml'))
-        cover_path = None
-        for ext in IMAGE_EXT:
-            if os.path.exists(os.path.join(path, 'cover' + ext)):
-                cover_path = os.path.join(path, 'cover' + ext)
-                break
-        comic = Comic(comic_meta['title'], [], cover_path=cover_path)
-        for chapter_id in os.listdir(path):
+        comic_meta = reader.load_toml(os.path.join(path, 'meta.toml'))
+        comic = Comic(comic_meta['title'], [], cover_path=find_cover(path, listing))
+        for chapter_id, is_dir in listing.items():
+            if not is_dir: continue
             chapter_path = os.path.join(path, chapter_id)
-            if not os.path.isdir(chapter_path): continue
-            if not os.path.exists(os.path.join(chapter_path, 'meta.toml')):
+            if 'meta.toml' not in reader.scan_dir(chapter_path):
                 raise UserWarning(
                     f'missing meta.toml in chapter {chapter_id} of {comic.title}, please use GeneralParser instead'
                 )
-            chapter_meta = toml.load(os.path.join(chapter_path, 'meta.toml'))
+            chapter_meta = reader.load_toml(os.path.join(chapter_path, 'meta.toml'))
             chapter = Chapter(chapter_meta['ord'], chapter_meta['title'], [])
             for index, page_file in enumerate(chapter_meta['paths']):
                 page_file = os.path.split(page_file)[1]
@@ -254,3 +278,54 @@ class BcdownParser(BaseParser):
             comic.chapters.append(chapter)
         comic.chapters.sort(key=lambda x: x.order)
         return comic
+
+
+class ArchiveParser(BaseParser):
+    """
+    Like GeneralParser, but chapters may be zip/cbz archives instead of folders, and a comic may
+    be a single archive whose folders are its chapters. Pages are read from the archives without
+    extracting them.
+    """
+    @classmethod
+    def parse(cls, path, reader=None):
+        reader = reader or SourceReader()
+        if is_archive(path) and os.path.isfile(path):
+            return cls.parse_archive(path, reader)
+        listing = reader.scan_dir(path)
+        comic = Comic(os.path.basename(path), [], cover_path=find_cover(path, listing))
+        names = natsort.os_sorted(
+            name for name, is_dir in listing.items() if is_dir or is_archive(name))
+        for chapter_index, name in enumerate(names):
+            chapter_path = os.path.join(path, name)
+            if listing[name]:
+                chapter = Chapter(chapter_index + 1, name, reader.scan_pages(chapter_path))
+            else:
+                chapter = Chapter(chapter_index + 1,
+                                  os.path.splitext(name)[0],
+                                  archive_pages(chapter_path, reader.list_archive(chapter_path)))
+            comic.chapters.append(chapter)
+        return comic
+
+    @classmethod
+    def parse_archive(cls, path: str, reader: SourceReader) -> Comic:
+        comic_title = os.path.splitext(os.path.basename(path))[0]
+        members = [
+            name for name in reader.list_archive(path) if os.path.splitext(name)[1] in IMAGE_EXT]
+        # folders containing everything, e.g. named after the comic, are not chapters
+        prefix = 0
+        for parts in zip(*(name.split('/')[:-1] for name in members)):
+            if len(set(parts)) > 1: break
+            prefix += 1
+        cover_path = None
+        folders: Dict[str, List[str]] = {}
+        for name in members:
+            parts = name.split('/')[prefix:]
+            if len(parts) == 1 and os.path.splitext(parts[0])[0] == 'cover':
+                cover_path = member_path(path, name)
+                continue
+            folders.setdefault(' '.join(parts[:-1]), []).append(name)
+        comic = Comic(comic_title, [], cover_path=cover_path)
+        for chapter_index, folder in enumerate(natsort.os_sorted(folders)):
+            comic.chapters.append(Chapter(chapter_index + 1, folder or comic_title,
+                                          archive_pages(path, folders[folder])))
+        return comic
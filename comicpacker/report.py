@@ -0,0 +1,142 @@
+import os
+import csv
+import json
+import tempfile
+from collections import Counter
+from typing import Dict, List
+from .metrics import FIELDS, stages
+
+
+def summary(stats: Counter, elapsed: float) -> dict:
+    """
+    :param elapsed: wall time of the stats, e.g. of the run or of the tasks of a comic
+    """
+    return {
+        'wall_time': elapsed,
+        'cpu_time': stats['cpu_time'],
+        'pages': stats['pages'],
+        'bytes_in': stats['bytes_in'],
+        'bytes_out': stats['output_bytes'],
+        'pages_per_s': stats['pages'] / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def stage_rows(stats: Counter) -> Dict[str, dict]:
+    rows = {}
+    for name, totals in stages(stats).items():
+        row = dict(totals)
+        row['calls_per_s'] = totals['calls'] / totals['wall'] if totals['wall'] > 0 else 0.0
+        rows[name] = row
+    return rows
+
+
+def build_report(stats: Counter, elapsed: float, jobs: Dict[str, Counter]) -> dict:
+    """
+    :param stats: stats of the run, aggregated from all tasks
+    :param elapsed: wall time of the run
+    :param jobs: name of each comic -> stats of its tasks
+    """
+    report = summary(stats, elapsed)
+    report['stages'] = stage_rows(stats)
+    report['comics'] = []
+    for name, job in jobs.items():
+        # time spent by the tasks of the comic, which may have run in parallel
+        row = summary(job, job['wall_time'])
+        row['name'] = name
+        row['stages'] = stage_rows(job)
+        report['comics'].append(row)
+    return report
+
+
+def write_atomic(path: str, write):
+    """
+    Write a file under a temporary name and rename it in place, so that readers, e.g. a
+    Prometheus textfile collector, never see it half written.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+            write(f)
+        # mkstemp creates the file readable by its owner only, unlike open()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_report(path: str, report: dict):
+    """
+    Write the report of build_report as JSON, or as CSV if path ends with .csv, with one row for
+    the run and for each comic, followed by one row for each of their stages.
+    """
+    if not path.lower().endswith('.csv'):
+        write_atomic(path, lambda f: json.dump(report, f, ensure_ascii=False, indent=2))
+        return
+
+    columns = ['comic', 'stage', 'wall_time', 'cpu_time', 'pages', 'bytes_in', 'bytes_out',
+               'pages_per_s', 'calls', 'calls_per_s']
+
+    def rows(name: str, item: dict) -> List[dict]:
+        result = [{'comic': name, 'stage': '', **{k: item[k] for k in columns[2:8]}}]
+        for stage, totals in item['stages'].items():
+            result.append({'comic': name, 'stage': stage, 'wall_time': totals['wall'],
+                           'cpu_time': totals['cpu'], 'bytes_in': totals['bytes_in'],
+                           'bytes_out': totals['bytes_out'], 'calls': totals['calls'],
+                           'calls_per_s': totals['calls_per_s']})
+        return result
+
+    def write(f):
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        # the run is the row with an empty comic
+        writer.writerows(rows('', report))
+        for comic in report['comics']:
+            writer.writerows(rows(comic['name'], comic))
+
+    write_atomic(path, write)
+
+
+def write_prometheus(path: str, report: dict):
+    """
+    Write the totals of the run in the Prometheus text format, for the textfile collector of
+    node_exporter.
+    """
+    lines = []
+
+    def metric(name: str, kind: str, help: str, values: Dict[str, float]):
+        lines.append(f'# HELP comicpacker_{name} {help}')
+        lines.append(f'# TYPE comicpacker_{name} {kind}')
+        for labels, value in values.items():
+            lines.append(f'comicpacker_{name}{labels} {value}')
+
+    metric('run_wall_seconds', 'gauge', 'Wall time of the last run.', {'': report['wall_time']})
+    metric('run_cpu_seconds', 'gauge', 'CPU time of the tasks of the last run.',
+           {'': report['cpu_time']})
+    metric('run_pages', 'gauge', 'Pages packed by the last run.', {'': report['pages']})
+    metric('run_bytes_in', 'gauge', 'Bytes of source pages read by the last run.',
+           {'': report['bytes_in']})
+    metric('run_bytes_out', 'gauge', 'Bytes of outputs written by the last run.',
+           {'': report['bytes_out']})
+    metric('run_pages_per_second', 'gauge', 'Throughput of the last run.',
+           {'': report['pages_per_s']})
+    help = {
+        'calls': 'Calls of each stage in the last run.',
+        'wall': 'Wall time spent in each stage in the last run, summed over threads.',
+        'cpu': 'CPU time spent in each stage in the last run.',
+        'bytes_in': 'Bytes going into each stage in the last run.',
+        'bytes_out': 'Bytes coming out of each stage in the last run.',
+    }
+    suffix = {'calls': '', 'wall': '_seconds', 'cpu': '_cpu_seconds', 'bytes_in': '_bytes_in',
+              'bytes_out': '_bytes_out'}
+    for field in FIELDS:
+        metric(f'stage{suffix[field] or "_calls"}', 'gauge', help[field], {
+            f'{{stage="{stage}"}}': totals[field]
+            for stage, totals in report['stages'].items()
+        })
+    write_atomic(path, lambda f: f.write('\n'.join(lines) + '\n'))
@@ -0,0 +1,171 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from .comic import Comic
+from .archive import stat_page
+
+# fixed cost of a page in bytes-equivalent, covers opening, writing and per-page overhead
+PAGE_COST = 1 << 16
+
+
+def stat_pages(paths: Iterable[str]) -> Dict[str, Tuple[int, int]]:
+    """
+    :return: path -> (size, mtime_ns) of the pages that exist, see archive.stat_page
+    """
+    stats = {}
+    for path in paths:
+        try:
+            stats[path] = stat_page(path)
+        except OSError:
+            pass
+    return stats
+
+
+def estimate_cost(comic: Comic,
+                  page_stats: Optional[Dict[str, Tuple[int, int]]] = None) -> Tuple[int, int]:
+    """
+    :param page_stats: stats of the pages from stat_pages, looked up if None
+    :return: number of pages and total bytes of the source images
+    """
+    paths = [] if comic.cover_path is None else [comic.cover_path]
+    for chapter in comic.chapters:
+        paths.extend(page.path for page in chapter.pages)
+    if page_stats is None:
+        page_stats = stat_pages(paths)
+    return len(paths), sum(page_stats[path][0] for path in paths if path in page_stats)
+
+
+@dataclass(eq=False)
+class Task:
+    name: str
+    cost: float
+    func: Callable
+    args: tuple
+    callback: Optional[Callable[[Any], None]] = None
+    # False if the pages of this task were already counted by its range tasks
+    count_throughput: bool = True
+
+
+@dataclass(eq=False)
+class Job:
+    task: Task
+    # tasks that have to finish before task is started
+    ranges: List[Task] = field(default_factory=list)
+    remaining: int = 0
+
+
+class Scheduler:
+    """
+    Dispatch tasks to a process pool, largest first.
+
+    At most max_queued tasks are handed to the pool at once, the rest wait in a priority queue,
+    so that a large comic submitted late still starts before the small ones queued earlier.
+    A job may come with range tasks, which are queued at the job's priority and picked up by
+    whichever worker is idle; the job's own task is started once all of them finished.
+    Every task returns (or ends its result with) a Counter with 'pages' and 'bytes_in', which
+    is used to report the throughput.
+    """
+    def __init__(self, processes: Optional[int] = None, max_queued: int = 0,
+                 report_interval: float = 30, maxtasksperchild: Optional[int] = None,
+                 initializer: Optional[Callable] = None, initargs: tuple = ()) -> None:
+        """
+        :param processes: number of worker processes, see cpus.plan_workers, os.cpu_count() if
+            None
+        :param initializer: called with initargs in each worker process when it starts
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.pool = Pool(processes, initializer, initargs, maxtasksperchild)
+        self.max_queued = max_queued if max_queued > 0 else processes * 2
+        self.report_interval = report_interval
+        self.logger = logging.getLogger('main.Scheduler')
+
+        self.queue: List[Tuple[float, int, Task, Optional[Job]]] = []
+        self.counter = itertools.count()
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+        self.stats: Counter = Counter()
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def submit(self, task: Task, ranges: Optional[List[Task]] = None):
+        with self.cond:
+            if ranges:
+                job = Job(task, ranges, len(ranges))
+                for range_task in ranges:
+                    self.__push(range_task, job, task.cost)
+            else:
+                self.__push(task, None, task.cost)
+            self.__pump()
+
+    def join(self):
+        with self.cond:
+            while self.inflight > 0 or len(self.queue) > 0:
+                self.cond.wait(self.report_interval)
+                self.__pump()
+                self.__report()
+        self.pool.close()
+        self.pool.join()
+        self.__report(final=True)
+
+    def __push(self, task: Task, job: Optional[Job], priority: float):
+        heapq.heappush(self.queue, (-priority, next(self.counter), task, job))
+
+    def __pump(self):
+        while self.inflight < self.max_queued and len(self.queue) > 0:
+            _, _, task, job = heapq.heappop(self.queue)
+            self.inflight += 1
+            self.pool.apply_async(task.func, task.args,
+                                  callback=lambda x, task=task, job=job: self.__done(task, job, x),
+                                  error_callback=lambda e, task=task, job=job: self.__failed(
+                                      task, job, e))
+
+    def __done(self, task: Task, job: Optional[Job], result):
+        # called from the result handler thread of the pool
+        stats = result[-1] if isinstance(result, tuple) else result
+        try:
+            if task.callback is not None:
+                task.callback(result)
+        except Exception as e:
+            # raised in the result handler thread, it would stop the results of every other task
+            self.logger.error(f'{task.name}: {e}')
+        with self.cond:
+            if task.count_throughput and isinstance(stats, Counter):
+                self.stats['pages'] += stats['pages']
+                self.stats['bytes_in'] += stats['bytes_in']
+            self.__finish(job)
+
+    def __failed(self, task: Task, job: Optional[Job], e: BaseException):
+        self.logger.error(f'{task.name}: {e}')
+        with self.cond:
+            self.__finish(job)
+
+    def __finish(self, job: Optional[Job]):
+        self.inflight -= 1
+        if job is not None:
+            job.remaining -= 1
+            if job.remaining == 0:
+                # the job goes before anything else, its pages are ready in the cache
+                self.__push(job.task, None, float('inf'))
+        self.__report()
+        self.__pump()
+        self.cond.notify_all()
+
+    def __report(self, final: bool = False):
+        now = time.time()
+        if not final and now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+        elapsed = max(now - self.start_time, 1e-6)
+        pages, mbytes = self.stats['pages'], self.stats['bytes_in'] / (1 << 20)
+        self.logger.info(f'{pages} pages, {mbytes:.1f} MB in {elapsed:.0f}s '
+                         f'({pages / elapsed:.1f} pages/s, {mbytes / elapsed:.2f} MB/s)' +
+                         ('' if final else f', {self.inflight} running, {len(self.queue)} queued'))
@@ -0,0 +1,58 @@
+import tempfile
+from typing import Dict, Optional, Tuple, Union
+
+
+class SpillStore:
+    """
+    Hold processed pages until they can be written, in memory up to max_memory bytes and in an
+    anonymous temporary file beyond that.
+
+    Pages are kept until the store is closed, as the same page may be read more than once.
+    """
+    def __init__(self, max_memory: int, dir: Optional[str] = None) -> None:
+        """
+        :param max_memory: max total size of the pages held in memory in bytes
+        :param dir: directory of the temporary file, default temporary directory if None
+        """
+        self.max_memory = max_memory
+        self.dir = dir
+        self.memory = 0
+        self.pages: Dict[str, Union[Tuple[bytes, str], UserWarning]] = {}
+        # key -> (offset, length, ext) of pages in the temporary file
+        self.spilled: Dict[str, Tuple[int, int, str]] = {}
+        self.file = None
+
+    def put(self, key: str, result: Union[Tuple[bytes, str], UserWarning]):
+        """
+        :param result: (data, ext) of the page, or the UserWarning raised by it
+        """
+        if key in self.pages or key in self.spilled: return
+        # a RawMember to be copied from its archive is small enough to keep
+        if isinstance(result, UserWarning) or not isinstance(result[0], bytes):
+            self.pages[key] = result
+            return
+        if self.memory + len(result[0]) <= self.max_memory:
+            self.pages[key] = result
+            self.memory += len(result[0])
+            return
+        data, ext = result
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.dir)
+        offset = self.file.seek(0, 2)
+        self.file.write(data)
+        self.spilled[key] = (offset, len(data), ext)
+
+    def get(self, key: str) -> Union[Tuple[bytes, str], UserWarning]:
+        if key in self.pages:
+            return self.pages[key]
+        offset, length, ext = self.spilled[key]
+        self.file.seek(offset)  # type: ignore
+        return self.file.read(length), ext  # type: ignore
+
+    def close(self):
+        self.pages.clear()
+        self.spilled.clear()
+        self.memory = 0
+        if self.file is not None:
+            self.file.close()
+            self.file = None
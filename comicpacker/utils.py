@@ -1,8 +1,18 @@
 import os
+import sys
 import errno
 import logging
 import datetime
-from PIL import Image
+import functools
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+from . import metrics
+from .archive import read_page
+
+T = TypeVar('T')
+D = TypeVar('D')
+R = TypeVar('R')
 
 
 def safe_makedirs(path):
@@ -36,10 +46,109 @@ def setup_logger(output_dir):
 
 
 def read_img(path):
-    with open(path, "rb") as file:
-        data = file.read()
+    """
+    Read a page from a file, or from an archive without extracting it, see archive.
+    """
+    with metrics.stage('read') as span:
+        data = read_page(path)
+        span.bytes_out = len(data)
         ext = os.path.splitext(path)[1]
-        return data, ext
+    if ext.lower() == '.avif':
+        enable_avif()
+    return data, ext
+
+
+# threads of each AVIF encoder and decoder of this process, 0 for the default of the plugin
+_encoder_threads = 0
+
+
+def set_encoder_threads(threads: int):
+    """
+    Limit the threads started by each AVIF encoder and decoder of this process, by default one
+    per CPU it may run on, in every worker process at once. The other encoders run on the
+    calling thread only.
+    """
+    global _encoder_threads
+    _encoder_threads = threads
+    _apply_encoder_threads()
+
+
+def _apply_encoder_threads():
+    for name in ('PIL.AvifImagePlugin', 'pillow_avif.AvifImagePlugin'):
+        module = sys.modules.get(name)
+        if module is not None and hasattr(module, 'DEFAULT_MAX_THREADS'):
+            module.DEFAULT_MAX_THREADS = _encoder_threads
+
+
+@functools.lru_cache(maxsize=None)
+def enable_avif():
+    """
+    Make AVIF images readable and writable, with pillow-avif-plugin if Pillow has no AVIF
+    support of its own. Called on the first AVIF image only, as most configs never see one.
+    """
+    from PIL import features
+    try:
+        native = features.check_module('avif')
+    except ValueError:
+        # Pillow too old to know about AVIF
+        native = False
+    if native:
+        from PIL import AvifImagePlugin  # noqa: F401
+    else:
+        import pillow_avif  # noqa: F401
+    _apply_encoder_threads()
+
+
+def ordered_map(executor: Executor, fn: Callable[[T], R], iterable: Iterable[T],
+                max_inflight: int) -> Iterator[R]:
+    """
+    Like executor.map, but submits at most max_inflight items ahead of the consumer,
+    so that results waiting to be consumed never pile up.
+    """
+    pending: deque = deque()
+    for item in iterable:
+        if len(pending) >= max_inflight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def stream_map(io_executor: Executor, read: Callable[[T], D], process: Callable[[T, D], R],
+               iterable: Iterable[T], size: Callable[[T], int], max_inflight: int,
+               max_bytes: int, executor: Optional[Executor] = None) -> Iterator[R]:
+    """
+    Like ordered_map, for items read then processed: each item is read on io_executor while the
+    items before it are processed, on executor, or by the consumer if None.
+
+    At most max_inflight items are read or processed ahead of the consumer, and their total size
+    is kept within max_bytes, except that an item is always let in when nothing is in flight, so
+    that an item larger than max_bytes still goes through.
+
+    :param size: size of an item in bytes, known before reading it
+    """
+    def submit(item: T) -> Future:
+        data = io_executor.submit(read, item)
+        if executor is None: return data
+        return executor.submit(lambda: process(item, data.result()))
+
+    def take() -> R:
+        nonlocal inflight
+        item, cost, future = pending.popleft()
+        result = future.result() if executor is not None else process(item, future.result())
+        inflight -= cost
+        return result
+
+    pending: deque = deque()
+    inflight = 0
+    for item in iterable:
+        cost = size(item)
+        while len(pending) > 0 and (len(pending) >= max_inflight or inflight + cost > max_bytes):
+            yield take()
+        pending.append((item, cost, submit(item)))
+        inflight += cost
+    while len(pending) > 0:
+        yield take()
 
 
 def get_jpg_quality(qdict: dict) -> int:
@@ -0,0 +1,201 @@
+import os
+import time
+import zlib
+import struct
+import zipfile
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Deque, Iterable, Optional, Tuple, Union
+from . import metrics
+from .archive import RawMember, open_archive
+
+# size of the fixed part of a local file header
+_LOCAL_HEADER_SIZE = struct.calcsize(zipfile.structFileHeader)
+
+
+def raw_stream(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> BinaryIO:
+    """
+    Position the file of archive at the compressed data of an entry.
+
+    :return: file of archive, info.compress_size bytes are to be read from it
+    """
+    fp = archive.fp
+    fp.seek(info.header_offset)  # type: ignore
+    header = struct.unpack(zipfile.structFileHeader, fp.read(_LOCAL_HEADER_SIZE))  # type: ignore
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:  # type: ignore
+        raise zipfile.BadZipFile(f'Bad local file header of {info.filename}')
+    fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH],  # type: ignore
+            1)
+    return fp  # type: ignore
+
+
+def copy_raw(src: zipfile.ZipFile, info: zipfile.ZipInfo, dst: zipfile.ZipFile,
+             buffer_size: int = 1 << 20, name: Optional[str] = None):
+    """
+    Copy an entry from src to dst as it is, without decompressing and compressing it again.
+
+    zipfile has no public API for this, so the entry is written the same way ZipFile.write
+    writes a directory entry, with its CRC and sizes known up front.
+
+    :param name: name of the entry in dst, default its name in src
+    """
+    zinfo = zipfile.ZipInfo(info.filename if name is None else name, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.extra = info.extra
+    zinfo.create_system = info.create_system
+    zinfo.create_version = info.create_version
+    zinfo.extract_version = info.extract_version
+    # sizes are written in the local header, no data descriptor follows the data
+    zinfo.flag_bits = info.flag_bits & ~0x08
+    zinfo.internal_attr = info.internal_attr
+    zinfo.external_attr = info.external_attr
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    with src._lock:  # type: ignore
+        fp = raw_stream(src, info)
+        write_raw(dst, zinfo, _read_chunks(fp, info, buffer_size))
+
+
+def _read_chunks(fp: BinaryIO, info: zipfile.ZipInfo, buffer_size: int) -> Iterable[bytes]:
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = fp.read(min(buffer_size, remaining))
+        if len(chunk) == 0:
+            raise zipfile.BadZipFile(f'Truncated entry {info.filename}')
+        yield chunk
+        remaining -= len(chunk)
+
+
+def write_raw(dst: zipfile.ZipFile, zinfo: zipfile.ZipInfo, chunks: Iterable[bytes]):
+    """
+    Write an entry whose data is already compressed, with CRC and sizes set in zinfo.
+    """
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    with metrics.stage('zip_write', zinfo.compress_size) as span, dst._lock:  # type: ignore
+        if dst._seekable:  # type: ignore
+            dst.fp.seek(dst.start_dir)  # type: ignore
+        zinfo.header_offset = dst.fp.tell()  # type: ignore
+        dst._writecheck(zinfo)  # type: ignore
+        dst._didModify = True  # type: ignore
+        dst.fp.write(zinfo.FileHeader(zip64))  # type: ignore
+        for chunk in chunks:
+            dst.fp.write(chunk)  # type: ignore
+        dst.start_dir = dst.fp.tell()  # type: ignore
+        span.bytes_out = dst.start_dir - zinfo.header_offset  # type: ignore
+        dst.filelist.append(zinfo)
+        dst.NameToInfo[zinfo.filename] = zinfo
+
+
+# entries worth deflating, everything else but mimetype is taken for an image
+TEXT_EXTENSIONS = {'.xhtml', '.html', '.opf', '.ncx', '.xml', '.css', '.json'}
+
+
+@dataclass(eq=False)
+class CompressionPolicy:
+    """
+    How each entry of an archive is compressed: mimetype and images are stored, text entries are
+    deflated at level. With try_images, images are deflated too and kept deflated only if that
+    saves at least min_saving of their size.
+    """
+    level: int = 6
+    try_images: bool = False
+    min_saving: float = 0.02
+
+    def compression(self) -> int:
+        """
+        :return: compression of the entries written by ZipFile itself, i.e. streamed text entries
+        """
+        return zipfile.ZIP_STORED if self.level == 0 else zipfile.ZIP_DEFLATED
+
+    def compress(self, name: str, data: bytes) -> Tuple[zipfile.ZipInfo, bytes]:
+        """
+        :return: info of the entry with CRC and sizes set, and its data as written to the archive
+        """
+        start = metrics.clock()
+        zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = len(data)
+        zinfo.CRC = zlib.crc32(data)
+        text = os.path.splitext(name)[1].lower() in TEXT_EXTENSIONS
+        if name != 'mimetype' and self.level != 0 and (text or self.try_images):
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            deflated = compressor.compress(data) + compressor.flush()
+            if text or len(deflated) <= len(data) * (1 - self.min_saving):
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                data = deflated
+        zinfo.compress_size = len(data)
+        metrics.add_since('compress', start, zinfo.file_size, zinfo.compress_size)
+        return zinfo, data
+
+
+class EntryWriter:
+    """
+    Compress entries on a thread pool, off the thread writing the archive, and write them in the
+    order they are added. zlib releases the GIL, so threads compress in parallel.
+
+    A RawMember is copied from its source archive as it is, in its turn.
+    """
+    def __init__(self, archive: zipfile.ZipFile, policy: CompressionPolicy, threads: int = 1,
+                 max_pending: int = 16) -> None:
+        """
+        :param threads: number of compression threads, compress on the calling thread if 0
+        :param max_pending: max number of entries compressed ahead of writing
+        """
+        self.archive = archive
+        self.policy = policy
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(threads) if threads > 0 else None
+        self.pending: Deque[Future] = deque()
+
+    def write(self, name: str, data: Union[bytes, str, RawMember]):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.executor is None:
+            if isinstance(data, RawMember):
+                self.__copy(name, data)
+            else:
+                zinfo, payload = self.policy.compress(name, data)
+                write_raw(self.archive, zinfo, (payload, ))
+            return
+        if isinstance(data, RawMember):
+            # nothing to compress, copied when its turn comes
+            copied: Future = Future()
+            copied.set_result((name, data))
+            self.pending.append(copied)
+        else:
+            self.pending.append(self.executor.submit(self.policy.compress, name, data))
+        while len(self.pending) > self.max_pending:
+            self.__write_next()
+
+    def __write_next(self):
+        entry, payload = self.pending.popleft().result()
+        if isinstance(payload, RawMember):
+            self.__copy(entry, payload)
+        else:
+            write_raw(self.archive, entry, (payload, ))
+
+    def __copy(self, name: str, member: RawMember):
+        with open_archive(member.archive) as archive:
+            copy_raw(archive, member.info, self.archive, name=name)
+
+    def flush(self):
+        """
+        Write all entries added so far, before anything is written to the archive directly.
+        """
+        while len(self.pending) > 0:
+            self.__write_next()
+
+    def close(self, discard: bool = False):
+        """
+        :param discard: drop entries not written yet instead of writing them
+        """
+        if discard:
+            self.pending.clear()
+        else:
+            self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=discard)
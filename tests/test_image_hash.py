@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from PIL import Image
+from comicpacker.image_hash import get_hasher
+
+# hashes of the images of make_images by imagededup 0.3.3, whose hashing methods cannot be
+# imported without its deep learning dependencies, so they are stored here
+EXPECTED = {
+    'phash': {'flat': 'ffffffffffffffff', 'gradient': 'aa75fe57fe5faa5d',
+              'lines': 'd5b255aa5dd54bc0', 'noise': 'fe45f7c9618c4b22'},
+    'ahash': {'flat': 'ffffffffffffffff', 'gradient': '000001071f7fffff',
+              'lines': '7eff7e7e7e7eff7e', 'noise': 'e8a0151348999683'},
+    'dhash': {'flat': '0000000000000000', 'gradient': 'ffffffffffffffff',
+              'lines': '8080808080808080', 'noise': '025025248931240b'},
+    'whash': {'flat': 'ffffffffffffffff', 'gradient': '000001071f7fffff',
+              'lines': '002e2e6e6e6e6e2e', 'noise': 'f8a8179b48b995c3'},
+}
+
+
+def make_images():
+    """
+    :return: name and pixels of a few pages: flat, gradient, line art and noise
+    """
+    y, x = np.mgrid[0:600, 0:420]
+    lines = np.full((600, 420), 255, dtype=np.uint8)
+    lines[::37, :] = 0
+    lines[:, ::23] = 0
+    gradient = np.stack([x * 255 // 419, y * 255 // 599, (x + y) * 255 // 1018], axis=-1)
+    # raw output of a bit generator is the same in every NumPy version, unlike distributions;
+    # the LL coefficients of this one have a near-tie at their median, see WHash
+    noise = np.random.PCG64(16).random_raw(400 * 300 * 3) % 256
+    return {
+        'flat': np.full((600, 420, 3), 200, dtype=np.uint8),
+        'gradient': gradient.astype(np.uint8),
+        'lines': lines,
+        'noise': noise.astype(np.uint8).reshape(400, 300, 3),
+    }
+
+
+@pytest.mark.parametrize('method', sorted(EXPECTED))
+def test_hash_matches_imagededup(tmp_path, method):
+    # PNG is lossless, so that the pixels hashed do not depend on the JPEG codec
+    paths = {}
+    for name, pixels in make_images().items():
+        paths[name] = str(tmp_path / f'{name}.png')
+        Image.fromarray(pixels).save(paths[name])
+    hasher = get_hasher(method)
+    expected = EXPECTED[method]
+    # one image at a time and as a batch
+    assert {name: hasher.encode_image(path) for name, path in paths.items()} == expected
+    thumbnails = [hasher.load_thumbnail(path) for path in paths.values()]
+    assert dict(zip(paths, hasher.encode_arrays(thumbnails))) == expected
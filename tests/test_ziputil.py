@@ -0,0 +1,110 @@
+import time
+import zipfile
+import numpy as np
+import pytest
+from comicpacker._comicepub import ComicEpub
+from comicpacker.comiccbz import ComicCbz
+from comicpacker.ziputil import CompressionPolicy
+
+# copy_raw and write_raw write entries through private ZipFile attributes, these tests compare
+# what they write with what ZipFile writes, so that a change of zipfile shows up here
+
+
+def make_pages(count):
+    """
+    :return: data of pages, incompressible and compressible ones alternating
+    """
+    rng = np.random.PCG64(7)
+    pages = []
+    for i in range(count):
+        if i % 2 == 0:
+            pages.append(rng.random_raw(512).astype(np.uint8).tobytes())
+        else:
+            pages.append(bytes(range(256)) * 8)
+    return pages
+
+
+def new_book(output_format, filename, **kwargs):
+    kwargs.update(compression=CompressionPolicy(6, try_images=True), compress_threads=0)
+    if output_format == 'epub':
+        return ComicEpub(filename, title=('title', 'title'), epubid='id',
+                         updated_date='2000-01-01T00:00:00', **kwargs)
+    return ComicCbz(filename, title='title', **kwargs)
+
+
+def add_pages(book, pages, first=0):
+    for i, data in enumerate(pages, first):
+        book.add_comic_page(data, '.jpg', chapter=f'c{i // 3}', page=str(i),
+                            nav_label=f'chapter {i // 3}' if i % 3 == 0 else None)
+
+
+def read_entries(filename):
+    with zipfile.ZipFile(filename) as archive:
+        assert archive.testzip() is None
+        return [(info.filename, info.compress_type, info.CRC, archive.read(info))
+                for info in archive.infolist()]
+
+
+@pytest.fixture
+def frozen_time(monkeypatch):
+    # entries are dated when they are written, two builds are only identical at the same time
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+
+
+@pytest.mark.parametrize('output_format', ['epub', 'cbz'])
+def test_append_matches_fresh_build(tmp_path, frozen_time, output_format):
+    pages = make_pages(7)
+    fresh = new_book(output_format, str(tmp_path / 'fresh' / 'book'))
+    add_pages(fresh, pages)
+    fresh.save()
+
+    appended = new_book(output_format, str(tmp_path / 'appended' / 'book'))
+    add_pages(appended, pages[:4])
+    appended.save()
+    appended = new_book(output_format, str(tmp_path / 'appended' / 'book'), append=True)
+    add_pages(appended, pages[4:], 4)
+    appended.save()
+
+    assert read_entries(appended.filename) == read_entries(fresh.filename)
+    with open(appended.filename, 'rb') as f, open(fresh.filename, 'rb') as g:
+        assert f.read() == g.read()
+
+
+@pytest.mark.parametrize('output_format', ['epub', 'cbz'])
+def test_fragments_match_single_writer(tmp_path, frozen_time, output_format):
+    from PIL import Image
+    from comicpacker.comic import Chapter, Comic, Page
+    from comicpacker.comic_pipeline import ComicProcessPipeline
+    from comicpacker.config import MyConfig
+    from comicpacker.convert import pack_comic, pack_fragment
+    from comicpacker.image_pipeline import ImagePipeline
+
+    paths = []
+    for i in range(8):
+        paths.append(str(tmp_path / f'{i}.png'))
+        Image.new('L', (40, 60), i * 30).save(paths[-1])
+    chapters = [paths[1:3], paths[3:]]
+    comic = Comic('comic', [
+        Chapter(c, f'chapter {c}', [Page(i, str(i), path) for i, path in enumerate(pages, 1)])
+        for c, pages in enumerate(chapters, 1)], cover_path=paths[0])
+    cfg = MyConfig()
+    cfg.output_format = output_format
+    cfg.max_task_pages = 3
+    image_pipeline = ImagePipeline()
+
+    single = str(tmp_path / 'single' / f'comic.{output_format}')
+    pack_comic(single, comic, ComicProcessPipeline(), image_pipeline, None, cfg)
+    # ranges as planned by convert, with the cover as page 0
+    bounds = list(range(0, len(paths), cfg.max_task_pages)) + [len(paths)]
+    fragments = [str(tmp_path / f'{i}.fragment.{output_format}') for i in range(len(bounds) - 1)]
+    for fragment, start, stop in zip(fragments, bounds[:-1], bounds[1:]):
+        pack_fragment(fragment, comic, start, stop, image_pipeline, None, cfg)
+    merged = str(tmp_path / 'merged' / f'comic.{output_format}')
+    pack_comic(merged, comic, ComicProcessPipeline(), image_pipeline, None, cfg,
+               fragments=fragments)
+
+    entries = read_entries(merged)
+    assert entries == read_entries(single)
+    if output_format == 'epub':
+        assert entries[0][:2] == ('mimetype', zipfile.ZIP_STORED)